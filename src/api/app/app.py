@@ -9,8 +9,17 @@ from fastapi.security.http import HTTPBearer
 
 from app.utils.logging import EndpointFilter, configure_logging
 from app.utils.telemetry import setup_telemetry
+from app.utils.appwrite import close_appwrite_client, initialise_appwrite_client
 from app.utils.cache.redis import close_redis_pool, initialise_redis_pool
 from app.utils.db.pool import initialise_db_pool, close_db_pool
+from app.utils.executor import parse_executor
+from app.utils.friend_graph import start_friend_graph, stop_friend_graph
+from app.utils.timetable_index import start_timetable_index, stop_timetable_index
+from app.utils.sync_jobs import start_sync_worker, stop_sync_worker
+from app.utils.notification_outbox import (
+    start_notification_dispatcher,
+    stop_notification_dispatcher,
+)
 from app.utils.env import getFromEnv
 
 from app.routers.auth.router import authRouter
@@ -37,11 +46,22 @@ async def app_startup_event():
     )
     await initialise_db_pool()
     await initialise_redis_pool()
+    await initialise_appwrite_client()
+    await start_notification_dispatcher()
+    await start_friend_graph()
+    await start_timetable_index()
+    await start_sync_worker()
 
 
 async def app_shutdown_event():
+    await stop_sync_worker()
+    await stop_timetable_index()
+    await stop_friend_graph()
+    await stop_notification_dispatcher()
     await close_db_pool()
     await close_redis_pool()
+    await close_appwrite_client()
+    parse_executor.shutdown()
 
 
 @contextlib.asynccontextmanager
@@ -1,18 +1,19 @@
 import asyncpg
 from fastapi import APIRouter
 from fastapi import Depends
-from appwrite.client import Client
-from appwrite.services.users import Users
 from appwrite.exception import AppwriteException
 from fastapi.responses import JSONResponse
 import redis
-import asyncio
 
 from app.utils.cache.redis import get_redis_conn
 from app.routers.admin.models.responses import AdminUserInfoResponse
-from app.utils.appwrite import get_admin_client
+from app.utils.appwrite import AsyncAppwriteClient, get_appwrite_client
 from app.utils.env import getFromEnv
+from app.utils.executor import upstream_executor
+from app.utils.upstream_limiter import runshaw_limiter
+from app.utils.db.friendships import get_friend_ids
 from app.utils.db.pool import get_db_conn
+from app.utils.db.sync_state import dead_letters, recent_sync_runs
 from app.utils.auth import isAdmin, jwtToken, validateToken
 
 
@@ -30,7 +31,7 @@ adminRouter = APIRouter(
 async def getUserInfo(
     user_id: str,
     conn: asyncpg.Connection = Depends(get_db_conn),
-    adminClient: Client = Depends(get_admin_client),
+    appwrite: AsyncAppwriteClient = Depends(get_appwrite_client),
     redisConn: redis.Redis = Depends(get_redis_conn),
 ):
     user_id = user_id.lower()
@@ -39,32 +40,16 @@ async def getUserInfo(
         "SELECT bus FROM extra_bus_subscriptions WHERE user_id = $1", user_id
     )
 
-    rows = await conn.fetch(
-        """SELECT * FROM friend_requests 
-                WHERE (sender_id = $1 OR receiver_id = $1)
-                AND status = 'accepted'
-                ORDER BY updated_at ASC
-            """,
-        user_id,
-    )
-    friendRequests = rows
-    # extract the other user's ID, because either sender_id or receiver_id will be equal to user_id
-    otherUserIDs = {
-        row["receiver_id"] if row["sender_id"] == user_id else row["sender_id"]
-        for row in friendRequests
-    }
+    otherUserIDs = await get_friend_ids(conn, user_id)
     friends = []
-    users = Users(adminClient)
     for otherUserID in otherUserIDs:
         try:
             name = await redisConn.get(f"user_name:{otherUserID}")
-            if name is not None:
-                user: dict = await asyncio.to_thread(users.get, otherUserID)
+            if name is None:
+                user = await appwrite.get_user(otherUserID)
                 name = user.name if user else None
                 if name:
                     await redisConn.set(f"user_name:{otherUserID}", name)
-                if name:
-                    await redisConn.set(f"user_name:{otherUserID}", name)
 
             friends.append(
                 {
@@ -96,7 +81,7 @@ async def getUserInfo(
 
     name = await redisConn.get(f"user_name:{user_id}")
     if name is None:
-        user: dict = await asyncio.to_thread(users.get, user_id)
+        user = await appwrite.get_user(user_id)
         name = user.name if user else None
         if name:
             await redisConn.set(f"user_name:{user_id}", name)
@@ -126,3 +111,34 @@ async def getUserInfo(
 async def isRequesterAdmin():
     # Check if the requester is an admin
     return JSONResponse({"is_admin": True})
+
+
+@adminRouter.get("/metrics")
+async def getMetrics():
+    # Saturation gauges for this worker's executors and upstream limiters (each uvicorn
+    # worker has its own)
+    return JSONResponse(
+        {
+            "upstream_executor": upstream_executor.stats(),
+            "runshaw_limiter": runshaw_limiter.stats(),
+        }
+    )
+
+
+@adminRouter.get("/sync/dead-letters")
+async def getSyncDeadLetters(
+    limit: int = 100,
+    conn: asyncpg.Connection = Depends(get_db_conn),
+):
+    # Timetables the sync engine has stopped trying, e.g. expired or mistyped URLs
+    rows = await dead_letters(conn, min(max(limit, 1), 1000))
+    return [dict(row) for row in rows]
+
+
+@adminRouter.get("/sync/runs")
+async def getSyncRuns(
+    limit: int = 20,
+    conn: asyncpg.Connection = Depends(get_db_conn),
+):
+    # What each recent sync engine run did and where its time went
+    return await recent_sync_runs(conn, min(max(limit, 1), 200))
@@ -6,11 +6,11 @@ import asyncpg
 from typing import Annotated
 from fastapi import Depends, APIRouter, Header, Request
 from fastapi.responses import JSONResponse
-from appwrite.client import Client
-from appwrite.services.users import Users
 
-from app.utils.appwrite import get_admin_client, run_appwrite_call
+from app.utils.appwrite import AsyncAppwriteClient, get_appwrite_client
 from app.utils.auth import validateToken, jwtToken
+from app.utils.cache.memberships import evict_membership
+from app.utils.cache.tokens import evict_user_tokens
 from app.utils.db.pool import get_db_conn
 from app.utils.env import getFromEnv
 from app.utils.logging import Logger
@@ -62,13 +62,12 @@ async def submit_wifi_speed_test_results(
     "/api/exists/{user_id}",
     tags=["Auth"],
 )
-def user_exists(
+async def user_exists(
     user_id: str,
-    adminClient: Client = Depends(get_admin_client),
+    appwrite: AsyncAppwriteClient = Depends(get_appwrite_client),
 ):
     try:
-        users = Users(adminClient)
-        users.get(user_id)
+        await appwrite.get_user(user_id)
         return JSONResponse({"exists": True})
     except Exception as e:
         return JSONResponse({"exists": False}, 404)
@@ -81,18 +80,18 @@ def user_exists(
 )
 async def close_account(
     req: Request,
-    adminClient: Client = Depends(get_admin_client),
+    appwrite: AsyncAppwriteClient = Depends(get_appwrite_client),
     conn: asyncpg.Connection = Depends(get_db_conn),
 ):
     """Close the authenticated user's account."""
     try:
-        users = Users(adminClient)
-        await run_appwrite_call(users.delete, req.state.user_id)
+        await appwrite.delete_user(req.state.user_id)
 
         await conn.execute(
             "DELETE FROM users WHERE user_id = $1",
             req.state.user_id,
         )
+        await evict_user_tokens(req.state.user_id)
 
         app_id = getFromEnv("ONESIGNAL_APP_ID")
         alias_label = "external_id"
@@ -194,6 +193,9 @@ async def handle_appwrite_user_change(
                     "DELETE FROM users WHERE user_id = $1",
                     user_id,
                 )
+                # revoked accounts must not keep authenticating from the token cache
+                await evict_user_tokens(user_id)
+                await evict_membership(user_id, getFromEnv("APPWRITE_ADMIN_TEAM_ID"))
                 return JSONResponse({"message": "Webhook received, user deleted"}, 200)
 
     except Exception:
@@ -3,10 +3,9 @@ from fastapi import Depends, APIRouter, Request
 from fastapi.responses import JSONResponse
 from app.utils.models import ExtraBusRequestBody
 from app.utils.auth import validateToken, jwtToken
+from app.utils.db.friendships import are_friends
 from app.utils.db.pool import get_db_conn
-from app.utils.appwrite import get_admin_client
-from appwrite.client import Client
-from appwrite.services.users import Users
+from app.utils.appwrite import AsyncAppwriteClient, get_appwrite_client
 
 
 busesRouter = APIRouter(
@@ -38,30 +37,20 @@ async def get_buses(
 async def get_bus_for(
     req: Request,
     user_id: str,
-    adminClient: Client = Depends(get_admin_client),
+    appwrite: AsyncAppwriteClient = Depends(get_appwrite_client),
     conn: asyncpg.Connection = Depends(get_db_conn),
 ):
     """
     Gets the bus number for a user with the given ID as a query parameter
     """
-    friendship = await conn.fetchrow(
-        """SELECT * FROM friend_requests
-        WHERE status = 'accepted'
-        AND ((sender_id = $1 AND receiver_id = $2)
-        OR (sender_id = $2 AND receiver_id = $1))
-        """,
-        req.state.user_id.lower(),
-        user_id.lower(),
-    )
-    if not friendship:
+    if not await are_friends(conn, req.state.user_id, user_id):
         return JSONResponse({"error": "Unauthorised access"}, 403)
 
     buses = await conn.fetch(
         "SELECT bus FROM extra_bus_subscriptions WHERE user_id = $1", user_id
     )
 
-    users = Users(adminClient)
-    user = users.get(user_id)
+    user = await appwrite.get_user(user_id)
 
     # preferences: dict = user.get("prefs", {"bus_number": None})
     preferences = user.prefs
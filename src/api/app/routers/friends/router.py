@@ -1,23 +1,38 @@
-import aiohttp
+import asyncio
+import datetime
+import os
 import asyncpg
-from fastapi import Depends, APIRouter, HTTPException, Request
+from fastapi import Depends, APIRouter, HTTPException, Request, Response
 from fastapi.responses import JSONResponse
 import redis
 from app.utils.cache.redis import get_redis_conn
-from app.utils.env import getFromEnv
 from app.utils.models import (
     BatchGetBody,
     BlockedID,
     FriendRequestBody,
     FriendRequestHandleBody,
 )
-from app.utils.notifications import sendNotification
+from app.utils.notification_outbox import enqueue_notification
 from app.utils.auth import validateToken, jwtToken
+from app.utils.db.friendships import (
+    FRIEND_REQUEST_ROWS_QUERY,
+    FRIEND_REQUEST_ROWS_VERSION_QUERY,
+    get_friend_ids,
+)
 from app.utils.db.pool import get_db_conn
-from app.utils.appwrite import get_admin_client
+from app.utils.db.timetable_events import LONDON, as_london_time
+from app.utils.friend_graph import FriendGraph, get_friend_graph, record_change
+from app.utils.timetable_index import get_day_indexes
+from app.utils.appwrite import AsyncAppwriteClient, get_appwrite_client
 from app.utils.logging import Logger
-from appwrite.client import Client
-from appwrite.services.users import Users
+from app.utils.pagination import (
+    decode_cursor,
+    encode_cursor,
+    etag_matches,
+    list_etag,
+    validate_limit,
+)
+from appwrite.exception import AppwriteException
 
 
 friendsRouter = APIRouter(
@@ -25,6 +40,9 @@ friendsRouter = APIRouter(
 )
 logger = Logger("friends_router")
 
+NAME_FETCH_CONCURRENCY = int(os.getenv("NAME_FETCH_CONCURRENCY", 10))
+MAX_SUGGESTIONS = 50
+
 
 @friendsRouter.get(
     "/api/friends",
@@ -33,26 +51,135 @@ logger = Logger("friends_router")
 )
 async def get_friends(
     req: Request,
+    response: Response,
+    limit: int | None = None,
+    after: str | None = None,
     conn: asyncpg.Connection = Depends(get_db_conn),
 ):
-    """Fetch friends for the authenticated user."""
+    """
+    Fetch friends for the authenticated user, oldest first. Pass `limit` to page
+    through them, then the `X-Next-Cursor` response header as `after`. Send the
+    ETag back as If-None-Match to get a 304 when nothing has changed.
+    """
+    limit = validate_limit(limit)
+    after_updated_at, after_id = decode_cursor(after)
+    user_id = req.state.user_id.lower()
     try:
+        version = await conn.fetchrow(FRIEND_REQUEST_ROWS_VERSION_QUERY, user_id)
+        etag = list_etag(
+            version["row_count"], version["newest_updated_at"], limit, after
+        )
+        if etag_matches(req, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
         rows = await conn.fetch(
-            """SELECT * FROM friend_requests 
-                WHERE (sender_id = $1 OR receiver_id = $1)
-                AND status = 'accepted'
-                ORDER BY updated_at ASC
-            """,
-            req.state.user_id.lower(),
+            FRIEND_REQUEST_ROWS_QUERY,
+            user_id,
+            after_updated_at,
+            after_id,
+            limit,
         )
+        response.headers["ETag"] = etag
+        if limit is not None and len(rows) == limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(
+                rows[-1]["updated_at"], rows[-1]["id"]
+            )
         return [dict(row) for row in rows]
     except Exception:
-        logger.exception(
-            f"Failed to fetch friends for user {req.state.user_id.lower()}"
-        )
+        logger.exception(f"Failed to fetch friends for user {user_id}")
         raise HTTPException(status_code=500, detail="Failed to fetch friends")
 
 
+@friendsRouter.get(
+    "/api/friends/now",
+    dependencies=[Depends(validateToken), Depends(jwtToken)],
+    tags=["Friends"],
+)
+async def get_friends_now(
+    req: Request,
+    at: datetime.datetime | None = None,
+    conn: asyncpg.Connection = Depends(get_db_conn),
+):
+    """
+    What each of the authenticated user's friends is doing right now (or at `at`):
+    `busy` with the event they're in, `free` with their next event today if any,
+    or `unknown` if they have no timetable.
+    """
+    moment = as_london_time(at) or datetime.datetime.now(LONDON)
+    friend_ids = await get_friend_ids(conn, req.state.user_id)
+    indexes = await get_day_indexes(
+        conn, friend_ids, moment.astimezone(LONDON).date()
+    )
+
+    timestamp = moment.timestamp()
+    friends = []
+    for friend_id in friend_ids:
+        index = indexes[friend_id]
+        if index is None:
+            friends.append({"user_id": friend_id, "status": "unknown"})
+            continue
+        event = index.current(timestamp)
+        if event is not None:
+            friends.append({"user_id": friend_id, "status": "busy", "event": event})
+        else:
+            friends.append(
+                {"user_id": friend_id, "status": "free", "next": index.next(timestamp)}
+            )
+    return friends
+
+
+@friendsRouter.get(
+    "/api/friends/suggestions",
+    dependencies=[Depends(validateToken), Depends(jwtToken)],
+    tags=["Friends"],
+)
+async def get_friend_suggestions(
+    req: Request,
+    limit: int = 20,
+    conn: asyncpg.Connection = Depends(get_db_conn),
+    graph: FriendGraph = Depends(get_friend_graph),
+):
+    """
+    Suggest people the authenticated user may know, ranked by how many friends they
+    have in common. People with a pending request either way are left out.
+    """
+    if not 1 <= limit <= MAX_SUGGESTIONS:
+        return JSONResponse(
+            {"error": f"limit must be between 1 and {MAX_SUGGESTIONS}"}, 400
+        )
+    user_id = req.state.user_id.lower()
+    pending = await conn.fetch(
+        """SELECT sender_id, receiver_id FROM friend_requests
+        WHERE (sender_id = $1 OR receiver_id = $1) AND status = 'pending'""",
+        user_id,
+    )
+    exclude = {row["sender_id"] for row in pending} | {
+        row["receiver_id"] for row in pending
+    }
+    return [
+        {"user_id": candidate, "mutual_friends": mutuals}
+        for candidate, mutuals in graph.suggestions(user_id, limit, exclude)
+    ]
+
+
+@friendsRouter.get(
+    "/api/friends/mutual/{user_id}",
+    dependencies=[Depends(validateToken), Depends(jwtToken)],
+    tags=["Friends"],
+)
+async def get_mutual_friends(
+    req: Request,
+    user_id: str,
+    graph: FriendGraph = Depends(get_friend_graph),
+):
+    """Fetch the IDs of friends the authenticated user has in common with another user."""
+    requester = req.state.user_id.lower()
+    user_id = user_id.lower()
+    if graph.is_blocked(requester, user_id):
+        return JSONResponse({"error": "Unauthorised access"}, 403)
+    return graph.mutual_friends(requester, user_id)
+
+
 @friendsRouter.get(
     "/api/name/get/{user_id}",
     dependencies=[Depends(validateToken), Depends(jwtToken)],
@@ -63,12 +190,11 @@ async def get_name(
     user_id: str,
     auth_user: dict = Depends(validateToken),
     conn: asyncpg.Connection = Depends(get_db_conn),
-    adminClient: Client = Depends(get_admin_client),
+    appwrite: AsyncAppwriteClient = Depends(get_appwrite_client),
 ):
     """Fetch the name of a user by their ID."""
     try:
-        users = Users(adminClient)
-        user: dict = users.get(user_id)
+        user = await appwrite.get_user(user_id)
         return JSONResponse({"name": user.name})
     except Exception:
         logger.exception(f"Failed to fetch user name for {user_id}")
@@ -85,6 +211,7 @@ async def get_names(
     body: BatchGetBody,
     auth_user: dict = Depends(validateToken),
     redis_conn: redis.Redis = Depends(get_redis_conn),
+    appwrite: AsyncAppwriteClient = Depends(get_appwrite_client),
 ):
     """Fetch the names of multiple users by their IDs. Called on app startup.
     Uses Redis for caching."""
@@ -95,52 +222,48 @@ async def get_names(
         # technically I don't need a TTL at all, but this is just in case the cache container goes down with appwrite staying up
         cache_ttl_seconds = 60 * 60 * 24 * 7
 
-        # step 1: check cache
-        for user_id in body.user_ids:
-            cached_name = await redis_conn.get(f"{cache_prefix}{user_id}")
+        # step 1: check cache, in a single round trip
+        unique_user_ids = list(dict.fromkeys(body.user_ids))
+        cached_names = (
+            await redis_conn.mget([f"{cache_prefix}{u}" for u in unique_user_ids])
+            if unique_user_ids
+            else []
+        )
+        for user_id, cached_name in zip(unique_user_ids, cached_names):
             if cached_name:
                 names[user_id] = cached_name
             else:
                 user_ids_to_fetch_from_appwrite.append(user_id)
 
-        # step 2: fetch from appwrite
+        # step 2: fetch misses from appwrite concurrently, bounded so a cold cache doesn't flood it
+        semaphore = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
+
+        async def fetch_name(user_id: str):
+            """Returns (user_id, name, cache TTL or None to skip caching)"""
+            async with semaphore:
+                try:
+                    user = await appwrite.get_user(user_id)
+                    return user_id, user.name, cache_ttl_seconds
+                except AppwriteException:
+                    return user_id, "Unknown User", 600  # prevents a bunch of requests
+                except Exception:
+                    logger.exception(
+                        f"Failed to fetch Appwrite name for user {user_id}"
+                    )
+                    return user_id, "Unknown User", None
+
         if user_ids_to_fetch_from_appwrite:
-            async with aiohttp.ClientSession() as session:
-                for user_id in user_ids_to_fetch_from_appwrite:
-                    try:
-                        api_res = await session.get(
-                            f"{getFromEnv('APPWRITE_ENDPOINT')}/users/{user_id}",
-                            headers={
-                                "x-appwrite-project": getFromEnv("APPWRITE_PROJECT_ID"),
-                                "x-appwrite-key": getFromEnv("APPWRITE_API_KEY"),
-                                "user-agent": "ApppwritePythonSDK/7.0.0",
-                                "x-sdk-name": "Python",
-                                "x-sdk-platform": "server",
-                                "x-sdk-language": "python",
-                                "x-sdk-version": "7.0.0",
-                                "content-type": "application/json",
-                            },
-                        )
-                        user_data = await api_res.json()
-                        if api_res.status == 200 and "name" in user_data:
-                            user_name = user_data["name"]
-                            names[user_id] = user_name
-                            # cache it
-                            await redis_conn.set(
-                                f"{cache_prefix}{user_id}",
-                                user_name,
-                                ex=cache_ttl_seconds,
-                            )
-                        else:
-                            names[user_id] = "Unknown User"
-                            await redis_conn.set(
-                                f"{cache_prefix}{user_id}", "Unknown User", ex=600
-                            )  # prevents a bunch of requests
-                    except Exception as e:
-                        logger.exception(
-                            f"Failed to fetch Appwrite name for user {user_id}"
-                        )
-                        names[user_id] = "Unknown User"
+            results = await asyncio.gather(
+                *(fetch_name(user_id) for user_id in user_ids_to_fetch_from_appwrite)
+            )
+
+            # step 3: cache them, again in a single round trip
+            async with redis_conn.pipeline(transaction=False) as pipe:
+                for user_id, name, ttl in results:
+                    names[user_id] = name
+                    if ttl is not None:
+                        pipe.set(f"{cache_prefix}{user_id}", name, ex=ttl)
+                await pipe.execute()
 
         # all requested user_ids must have an entry in the response
         for user_id in body.user_ids:
@@ -186,6 +309,8 @@ async def unfriend_user(
                 user_id,
                 target_id,
             )
+        record_change("unfriend", user_id, target_id)
+        record_change("block", user_id, target_id)
         return JSONResponse(
             {"message": "User blocked and friendship removed (if applicable)"},
             201,
@@ -215,6 +340,7 @@ async def unblock_user(
             user_id,
             target_id,
         )
+        record_change("unblock", user_id, target_id)
         return JSONResponse({"message": "User unblocked successfully"}, 200)
     except Exception:
         logger.exception(f"Failed to unblock user {target_id} for {user_id}")
@@ -230,7 +356,7 @@ async def send_friend_request(
     req: Request,
     request_body: FriendRequestBody,
     conn: asyncpg.Connection = Depends(get_db_conn),
-    adminClient: Client = Depends(get_admin_client),
+    appwrite: AsyncAppwriteClient = Depends(get_appwrite_client),
 ):
     """
     Send a friend request to a user by their ID.
@@ -245,8 +371,7 @@ async def send_friend_request(
         return JSONResponse({"error": "Cannot send a friend request to yourself"}, 400)
 
     try:
-        users = Users(adminClient)
-        users.get(receiver)
+        await appwrite.get_user(receiver)
     except Exception:
         logger.exception(f"Invalid friend request receiver {receiver}")
         return JSONResponse({"error": "Invalid receiver_id"}, 404)
@@ -261,20 +386,22 @@ async def send_friend_request(
         if existing_request:
             return JSONResponse({"error": "Friend request already exists"}, 409)
 
-        await conn.execute(
-            """
-                INSERT INTO friend_requests (sender_id, receiver_id) VALUES ($1, $2)
-            """,
-            sender,
-            receiver,
-        )
-        sendNotification(
-            message="You have a new friend request!",
-            userIds=[receiver],
-            title="Friend Request",
-            ttl=60 * 60 * 24 * 2,
-            small_icon="friend",  # Fun story: this used to default to a bus icon, which seemed vaguely threatening for android users!
-        )
+        async with conn.transaction():
+            await conn.execute(
+                """
+                    INSERT INTO friend_requests (sender_id, receiver_id) VALUES ($1, $2)
+                """,
+                sender,
+                receiver,
+            )
+            await enqueue_notification(
+                conn,
+                message="You have a new friend request!",
+                userIds=[receiver],
+                title="Friend Request",
+                ttl=60 * 60 * 24 * 2,
+                small_icon="friend",  # Fun story: this used to default to a bus icon, which seemed vaguely threatening for android users!
+            )
         return JSONResponse({"message": "Friend request sent"}, 201)
     except Exception:
         logger.exception(f"Failed to send friend request from {sender} to {receiver}")
@@ -290,16 +417,49 @@ async def send_friend_request(
 )
 async def get_friend_requests(
     req: Request,
+    response: Response,
     status: str = "pending",
+    limit: int | None = None,
+    after: str | None = None,
     conn: asyncpg.Connection = Depends(get_db_conn),
 ):
-    """Fetch friend requests for the authenticated user."""
+    """
+    Fetch friend requests for the authenticated user. Paginated and
+    revalidated the same way as `GET /api/friends`.
+    """
+    limit = validate_limit(limit)
+    after_updated_at, after_id = decode_cursor(after)
     try:
+        version = await conn.fetchrow(
+            """SELECT count(*) AS row_count, max(updated_at) AS newest_updated_at
+            FROM friend_requests WHERE receiver_id = $1 AND status = $2""",
+            req.state.user_id,
+            status,
+        )
+        etag = list_etag(
+            version["row_count"], version["newest_updated_at"], status, limit, after
+        )
+        if etag_matches(req, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
         rows = await conn.fetch(
-            "SELECT * FROM friend_requests WHERE receiver_id = $1 AND status = $2",
+            """SELECT id, sender_id, receiver_id, status, updated_at
+            FROM friend_requests
+            WHERE receiver_id = $1 AND status = $2
+            AND ($3::timestamptz IS NULL OR (updated_at, id) > ($3::timestamptz, $4::integer))
+            ORDER BY updated_at ASC, id ASC
+            LIMIT $5""",
             req.state.user_id,
             status,
+            after_updated_at,
+            after_id,
+            limit,
         )
+        response.headers["ETag"] = etag
+        if limit is not None and len(rows) == limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(
+                rows[-1]["updated_at"], rows[-1]["id"]
+            )
         return [dict(row) for row in rows]
     except Exception:
         logger.exception(
@@ -339,35 +499,40 @@ async def handle_friend_request(
         return JSONResponse({"error": "Friend request has already been handled"}, 409)
 
     if action == "accept":
-        await conn.execute(
-            "UPDATE friend_requests SET status = 'accepted' WHERE id = $1",
-            request_id,
-        )
-        sendNotification(
-            message="Your friend request has been accepted!",
-            userIds=[request["sender_id"]],
-            title="Friend Request Accepted",
-            ttl=60 * 60 * 24 * 2,
-            small_icon="friend",
-        )
-        return JSONResponse({"message": "Friend request accepted"}, 200)
-    else:
-        try:
+        async with conn.transaction():
             await conn.execute(
-                """DELETE FROM friend_requests 
-                WHERE (sender_id = $1 AND receiver_id = $2) 
-                    OR (sender_id = $2 AND receiver_id = $1)""",
-                request["sender_id"],
-                request["receiver_id"],
+                "UPDATE friend_requests SET status = 'accepted', updated_at = CURRENT_TIMESTAMP WHERE id = $1",
+                request_id,
             )
-
-            sendNotification(
-                message="Your friend request has been declined.",
+            await enqueue_notification(
+                conn,
+                message="Your friend request has been accepted!",
                 userIds=[request["sender_id"]],
-                title="Friend Request Declined",
+                title="Friend Request Accepted",
                 ttl=60 * 60 * 24 * 2,
                 small_icon="friend",
             )
+        record_change("friend", request["sender_id"], request["receiver_id"])
+        return JSONResponse({"message": "Friend request accepted"}, 200)
+    else:
+        try:
+            async with conn.transaction():
+                await conn.execute(
+                    """DELETE FROM friend_requests 
+                    WHERE (sender_id = $1 AND receiver_id = $2) 
+                        OR (sender_id = $2 AND receiver_id = $1)""",
+                    request["sender_id"],
+                    request["receiver_id"],
+                )
+
+                await enqueue_notification(
+                    conn,
+                    message="Your friend request has been declined.",
+                    userIds=[request["sender_id"]],
+                    title="Friend Request Declined",
+                    ttl=60 * 60 * 24 * 2,
+                    small_icon="friend",
+                )
             return JSONResponse({"message": "Friend request declined"}, 200)
         except Exception:
             logger.exception(
@@ -12,6 +12,11 @@ from app.utils.auth import validateToken
 from app.utils.auth import jwtToken
 from app.utils.db.pool import get_db_conn
 from app.utils.logging import Logger
+from app.utils.upstream_limiter import (
+    RUNSHAW_QUEUE_TIMEOUT_SECONDS,
+    LimiterBusy,
+    runshaw_limiter,
+)
 
 
 paymentRouter = APIRouter(tags=["Payments"], prefix="/api/payments")
@@ -61,9 +66,21 @@ async def get_balance(
 
     async with aiohttp.ClientSession() as session:
         try:
-            async with session.get(url, timeout=ClientTimeout(3)) as response:
+            async with runshaw_limiter.slot(
+                RUNSHAW_QUEUE_TIMEOUT_SECONDS
+            ), session.get(url, timeout=ClientTimeout(3)) as response:
                 response.raise_for_status()
                 html_content = await response.text()
+        except LimiterBusy as e:
+            logger.warning(
+                f"RunshawPay balance request for user {req.state.user_id.lower()} "
+                "gave up waiting for the upstream limiter"
+            )
+            raise HTTPException(
+                status_code=503,
+                detail="RunshawPay is busy right now. Please try again shortly.",
+                headers={"Retry-After": str(e.retry_after)},
+            )
         except asyncio.TimeoutError:
             logger.warning(
                 f"RunshawPay balance request timed out for user {req.state.user_id.lower()}"
@@ -143,7 +160,9 @@ async def get_transactions(
 
     async with aiohttp.ClientSession() as session:
         try:
-            async with session.get(url, timeout=ClientTimeout(5)) as response:
+            async with runshaw_limiter.slot(
+                RUNSHAW_QUEUE_TIMEOUT_SECONDS
+            ), session.get(url, timeout=ClientTimeout(5)) as response:
                 response.raise_for_status()
                 html_content = await response.text()
                 soup = BeautifulSoup(html_content, "lxml")
@@ -198,6 +217,16 @@ async def get_transactions(
                         transactions_list.append(transaction)
 
                 return JSONResponse(transactions_list)
+        except LimiterBusy as e:
+            logger.warning(
+                f"RunshawPay transactions request for user {req.state.user_id.lower()} "
+                "gave up waiting for the upstream limiter"
+            )
+            raise HTTPException(
+                status_code=503,
+                detail="RunshawPay is busy right now. Please try again shortly.",
+                headers={"Retry-After": str(e.retry_after)},
+            )
         except asyncio.TimeoutError:
             logger.warning(
                 f"RunshawPay transactions request timed out for user {req.state.user_id.lower()}"
@@ -1,15 +1,31 @@
+import datetime
+import json
 import re
-import sys
 import asyncpg
-from fastapi import Depends, APIRouter, Request
+import numpy as np
+from fastapi import Depends, APIRouter, Query, Request, Response
 from fastapi.responses import JSONResponse
-import json
-from app.sync import sync_timetable_for
 from app.utils.auth import validateToken, jwtToken
+from app.utils.db.friendships import are_friends, get_non_friend_ids
 from app.utils.db.pool import get_db_conn
+from app.utils.db.sync_state import reset_sync_state
+from app.utils.db.timetable_events import (
+    as_london_time,
+    busy_intervals,
+    events_in_window,
+)
+from app.utils.free_periods import common_free_periods
+from app.utils.pagination import if_none_match_tags
+from app.utils.sync_jobs import enqueue_sync_job, get_sync_job
+from app.utils.timetable_json import (
+    batch_timetable_response,
+    timetable_etag,
+    timetable_response,
+)
 from app.utils.models import (
     Timetable,
     BatchGetBody,
+    CommonFreeBody,
     TimetableAssociationBody,
 )
 
@@ -18,6 +34,10 @@ timetableRouter = APIRouter(
     tags=["Timetable"],
 )
 
+MAX_COMMON_FREE_USERS = 50
+# a little over a full term
+MAX_COMMON_FREE_DAYS = 120
+
 
 @timetableRouter.post(
     "/api/timetable",
@@ -54,11 +74,17 @@ async def add_timetable(
 async def get_timetable(
     req: Request,
     user_id: str | None = None,
+    start: datetime.datetime | None = Query(None, alias="from"),
+    end: datetime.datetime | None = Query(None, alias="to"),
     conn: asyncpg.Connection = Depends(get_db_conn),
 ):
     """
     Fetch the timetable for a user. If `user_id` is not provided, fetch the timetable
     for the requester. Only allow access if the requester is the user or their friend.
+    Send the ETag back as If-None-Match to get a 304 when it hasn't changed.
+
+    Pass `from` and/or `to` to only get events starting in that window. Times without
+    an offset are taken as London time.
     """
 
     user_id = (
@@ -67,26 +93,40 @@ async def get_timetable(
 
     if user_id != req.state.user_id:
         # not fetching the requester's timetable, so check friendship. viewing is only allowed if the user is a friend
-        friendship = await conn.fetchrow(
-            """SELECT * FROM friend_requests
-            WHERE status = 'accepted'
-            AND ((sender_id = $1 AND receiver_id = $2)
-            OR (sender_id = $2 AND receiver_id = $1))
-            """,
-            req.state.user_id.lower(),
-            user_id.lower(),
-        )
-        if not friendship:
+        if not await are_friends(conn, req.state.user_id, user_id):
             return JSONResponse({"error": "Unauthorised access"}, 403)
 
-    timetable = await conn.fetchval(
-        "SELECT timetable FROM timetables WHERE user_id = $1", user_id.lower()
+    if start is not None or end is not None:
+        start, end = as_london_time(start), as_london_time(end)
+        if start is not None and end is not None and start >= end:
+            return JSONResponse({"error": "from must be before to"}, 400)
+        data = await events_in_window(conn, user_id.lower(), start, end)
+        if data is None:
+            return JSONResponse({"error": "Timetable not found"}, 404)
+        return timetable_response(f'{{"data":{data}}}')
+
+    known_tags = if_none_match_tags(req)
+    # the body is only read out of Postgres when the client's copy is stale
+    row = await conn.fetchrow(
+        """
+        SELECT content_hash,
+            CASE WHEN $3 OR content_hash = ANY($2::text[]) THEN NULL
+            ELSE timetable::text END AS timetable
+        FROM timetables WHERE user_id = $1
+        """,
+        user_id.lower(),
+        list(known_tags),
+        "*" in known_tags,
     )
 
-    if not timetable:
+    if not row:
         return JSONResponse({"error": "Timetable not found"}, 404)
 
-    return JSONResponse({"timetable": json.loads(timetable)})
+    etag = timetable_etag(row["content_hash"])
+    if row["timetable"] is None:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return timetable_response(row["timetable"], headers={"ETag": etag})
 
 
 @timetableRouter.post(
@@ -99,55 +139,82 @@ async def batch_get_timetable(
     request_body: BatchGetBody,
     conn: asyncpg.Connection = Depends(get_db_conn),
 ):
-    """Fetch the timetables for multiple users. Called on app startup"""
+    """
+    Fetch the timetables for multiple users. Called on app startup. Pass
+    `known_versions` to only get back timetables that changed since then.
+    """
     user_ids = request_body.user_ids
     if not req.state.user_id:
         return JSONResponse({"error": "No user IDs provided"}, 400)
-    for user_id in user_ids:
-        friendship = await conn.fetchrow(
-            """SELECT * FROM friend_requests
-            WHERE status = 'accepted'
-            AND ((sender_id = $1 AND receiver_id = $2)
-            OR (sender_id = $2 AND receiver_id = $1))
-            """,
-            req.state.user_id.lower(),
-            user_id.lower(),
-        )
-        if not friendship and not user_id == req.state.user_id:
-            return JSONResponse({"error": "Unauthorised access"}, 403)
+    # one set-based check for the whole batch rather than a query per user
+    if await get_non_friend_ids(conn, req.state.user_id, user_ids):
+        return JSONResponse({"error": "Unauthorised access"}, 403)
 
+    # Postgres extracts each event list as JSON text, which is spliced into the response as-is.
+    # Timetables whose version the client already has are left out of the body
+    known_versions = request_body.known_versions
     timetables = await conn.fetch(
         """
-        SELECT user_id, timetable
+        SELECT user_id, content_hash AS version,
+            content_hash = ($2::jsonb ->> user_id) AS unchanged,
+            CASE WHEN content_hash = ($2::jsonb ->> user_id) THEN NULL
+            ELSE (timetable -> 'data')::text END AS data
         FROM timetables
         WHERE user_id = ANY($1::text[])
         """,
         user_ids,
+        json.dumps(known_versions or {}),
     )
 
-    # Ensure all requested users have a timetable entry
-    for user_id in user_ids:
-        if not any(row["user_id"] == user_id for row in timetables):
-            timetables.append(
-                {
-                    "user_id": user_id,
-                    "timetable": '{"data": []}',  # Ensuring valid JSON
-                }
-            )
+    # requested users without a timetable get an empty one
+    if known_versions is None:
+        return batch_timetable_response(timetables, user_ids)
+    return batch_timetable_response(
+        timetables,
+        user_ids,
+        unchanged=[row["user_id"] for row in timetables if row["unchanged"]],
+    )
+
+
+@timetableRouter.post(
+    "/api/timetable/common-free",
+    dependencies=[Depends(validateToken), Depends(jwtToken)],
+    tags=["Timetable"],
+)
+async def get_common_free(
+    req: Request,
+    body: CommonFreeBody,
+    conn: asyncpg.Connection = Depends(get_db_conn),
+):
+    """
+    Find the periods between `start` and `end` when the authenticated user and all of
+    `user_ids` are free. Pass `day_start` and `day_end` to only count college hours.
+    Times without an offset are taken as London time.
+    """
+    start, end = as_london_time(body.start), as_london_time(body.end)
+    if start >= end:
+        return JSONResponse({"error": "start must be before end"}, 400)
+    if end - start > datetime.timedelta(days=MAX_COMMON_FREE_DAYS):
+        return JSONResponse(
+            {"error": f"Range must be at most {MAX_COMMON_FREE_DAYS} days"}, 400
+        )
+    user_ids = list(
+        {req.state.user_id.lower(), *(user_id.lower() for user_id in body.user_ids)}
+    )
+    if len(user_ids) > MAX_COMMON_FREE_USERS:
+        return JSONResponse(
+            {"error": f"At most {MAX_COMMON_FREE_USERS} users can be compared"}, 400
+        )
+    # same rule as get_timetable: only friends' timetables can be read
+    if await get_non_friend_ids(conn, req.state.user_id, user_ids):
+        return JSONResponse({"error": "Unauthorised access"}, 403)
 
-    resp: JSONResponse = JSONResponse(
-        {
-            timetable["user_id"]: {
-                "data": (
-                    json.loads(timetable["timetable"] or '{"data": []}')["data"]
-                    if type(timetable["timetable"]) == str
-                    else timetable["timetable"]
-                )
-            }
-            for timetable in timetables
-        }
+    rows = await busy_intervals(conn, user_ids, start, end)
+    busy_starts = np.fromiter((row["dtstart"] for row in rows), float, len(rows))
+    busy_ends = np.fromiter((row["dtend"] for row in rows), float, len(rows))
+    return common_free_periods(
+        busy_starts, busy_ends, start, end, body.day_start, body.day_end
     )
-    return resp
 
 
 @timetableRouter.post(
@@ -160,26 +227,63 @@ async def get_meta(
     body: TimetableAssociationBody,
     conn: asyncpg.Connection = Depends(get_db_conn),
 ):
-    """New in version 1.3.0 as migration to daily updating of timetables begins"""
+    """
+    New in version 1.3.0 as migration to daily updating of timetables begins.
+    The first sync is queued rather than run here: returns 202 with the job's ID,
+    which can be polled at /api/timetable/sync-jobs/{job_id}.
+    """
     pattern = re.compile(r"https://webservices\.runshaw\.ac\.uk/timetable\.ashx\?id=.*")
     if not pattern.match(body.url):
         return JSONResponse(
             {"error": "Invalid URL. Must be a Runshaw timetable URL"}, 400
         )
     try:
-        await conn.execute(
-            """
-            INSERT INTO timetable_associations (user_id, url)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET url = $2
-            """,
-            req.state.user_id,
-            body.url,
+        async with conn.transaction():
+            await conn.execute(
+                """
+                INSERT INTO timetable_associations (user_id, url)
+                VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE SET url = $2,
+                    ics_etag = NULL, ics_last_modified = NULL, ics_hash = NULL,
+                    -- a sync engine worker mid-way through this user only writes back
+                    -- while it still holds the lease, so this stops it
+                    lease_owner = NULL, lease_expires_at = NULL
+                """,
+                req.state.user_id,
+                body.url,
+            )
+            # a new URL gets a clean slate, even if the old one was dead-lettered
+            await reset_sync_state(conn, req.state.user_id)
+            job_id = await enqueue_sync_job(conn, req.state.user_id, body.url)
+        return JSONResponse(
+            {"message": "Timetable URL associated successfully", "job_id": job_id},
+            202,
+            headers={"Location": f"/api/timetable/sync-jobs/{job_id}"},
         )
-
-        if not "pytest" in sys.modules:
-            # Don't actually sync the timetable during tests
-            await sync_timetable_for(req.state.user_id, body.url)
-        return JSONResponse({"message": "Timetable URL associated successfully"}, 201)
     except Exception as e:
         return JSONResponse({"error": "Failed to associate timetable URL"}, 500)
+
+
+@timetableRouter.get(
+    "/api/timetable/sync-jobs/{job_id}",
+    dependencies=[Depends(validateToken), Depends(jwtToken)],
+    tags=["Timetable"],
+)
+async def get_sync_job_status(
+    req: Request,
+    job_id: int,
+    conn: asyncpg.Connection = Depends(get_db_conn),
+):
+    """Status of one of the authenticated user's timetable sync jobs."""
+    job = await get_sync_job(conn, req.state.user_id, job_id)
+    if job is None:
+        return JSONResponse({"error": "Sync job not found"}, 404)
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "error": job["last_error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
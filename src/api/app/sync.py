@@ -6,23 +6,15 @@ Description: This script is used to fetch the timetable URLs from the database a
 """
 
 import aiohttp
-import asyncpg
 import json
 import uuid
-import os
-import dotenv
 import pytz
 from urllib.parse import urlparse
 from icalendar import Calendar
 
-dotenv.load_dotenv()
-
-DB_CONFIG = {
-    "user": "postgres",
-    "password": os.getenv("DATABASE_PWD"),
-    "host": "localhost",
-    "port": 5432,
-}
+from app.utils.db import pool
+from app.utils.executor import parse_executor
+from app.utils.upstream_limiter import runshaw_limiter
 
 ALLOWED_TIMETABLE_HOSTS = {"webservices.runshaw.ac.uk"}
 ALLOWED_TIMETABLE_PATH = "/timetable.ashx"
@@ -45,9 +37,31 @@ def validate_timetable_url(ics_url: str):
         raise ValueError("Timetable URL must include an id query parameter")
 
 
+# fixed so the same source event gets the same uid on every sync
+EVENT_UID_NAMESPACE = uuid.UUID("be5be16b-7938-436d-8dec-9539e36067e4")
+
+
+def event_uid(component, dtstart: str, dtend: str, seen: set) -> str:
+    """
+    Stable uid for an event: from the calendar's own UID and start time if it has one,
+    otherwise from what the event is. Repeats within one calendar are numbered.
+    """
+    source_uid = component.get("uid")
+    if source_uid:
+        name = f"{source_uid}|{dtstart}"
+    else:
+        name = f"{dtstart}|{dtend}|{component.get('summary')}|{component.get('location')}"
+    base, n = name, 1
+    while name in seen:
+        n += 1
+        name = f"{base}#{n}"
+    seen.add(name)
+    return str(uuid.uuid5(EVENT_UID_NAMESPACE, name))
+
+
 async def fetch_ics(ics_url):
     validate_timetable_url(ics_url)
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession() as session, runshaw_limiter:
         async with session.get(
             ics_url,
             timeout=aiohttp.ClientTimeout(total=10),
@@ -57,8 +71,12 @@ async def fetch_ics(ics_url):
             return await response.text()
 
 
-async def parse_timetable(ics_url):
-    ics_data = await fetch_ics(ics_url)
+def parse_ics(ics_data) -> str:
+    """
+    ICS text to the timetable JSON stored in the database. CPU-bound, so it runs in
+    parse_executor's worker processes; the result goes back as one compact JSON string
+    rather than a pickled tree of dicts.
+    """
     cal = Calendar.from_ical(ics_data)
 
     json_data = {
@@ -69,6 +87,7 @@ async def parse_timetable(ics_url):
     }
 
     london_tz = pytz.timezone("Europe/London")
+    seen_uids = set()
 
     for component in cal.walk():
         if component.name == "VEVENT":
@@ -97,7 +116,12 @@ async def parse_timetable(ics_url):
                 "dtstart": {"dt": dtstart.strftime("%Y%m%dT%H%M%S")},
                 "dtend": {"dt": dtend.strftime("%Y%m%dT%H%M%S")},
                 "dtstamp": {"dt": dtstamp.strftime("%Y%m%dT%H%M%S")},
-                "uid": str(uuid.uuid4()),
+                "uid": event_uid(
+                    component,
+                    dtstart.strftime("%Y%m%dT%H%M%S"),
+                    dtend.strftime("%Y%m%dT%H%M%S"),
+                    seen_uids,
+                ),
                 "created": (
                     {
                         "dt": component.get("created")
@@ -125,21 +149,27 @@ async def parse_timetable(ics_url):
             }
             json_data["data"].append(event)
 
-    return json.dumps(json_data, indent=0)
+    return json.dumps(json_data, separators=(",", ":"))
+
+
+async def parse_timetable(ics_url):
+    ics_data = await fetch_ics(ics_url)
+    return await parse_executor.run(parse_ics, ics_data)
 
 
 async def sync_timetable_for(user_id, url):
     json_timetable = await parse_timetable(url)
 
-    conn = await asyncpg.connect(**DB_CONFIG)
-    await conn.execute(
-        """
-        INSERT INTO timetables (user_id, timetable)
-        VALUES ($1, $2)
-        ON CONFLICT (user_id)
-        DO UPDATE SET timetable = $2, updated_at = CURRENT_TIMESTAMP
-        """,
-        user_id,
-        json_timetable,
-    )
-    await conn.close()
+    # only take a connection for the write, not for the fetch and parse before it
+    async with pool.db_pool.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO timetables (user_id, timetable)
+            VALUES ($1, $2)
+            ON CONFLICT (user_id)
+            DO UPDATE SET timetable = $2, updated_at = CURRENT_TIMESTAMP
+            WHERE timetables.timetable IS DISTINCT FROM EXCLUDED.timetable
+            """,
+            user_id,
+            json_timetable,
+        )
@@ -1,14 +1,45 @@
+import asyncio
+import base64
+import json
 import random
+import threading
+import time
 import uuid
+import aiohttp
+from fastapi import HTTPException, Request
 from httpx import AsyncClient, ASGITransport
 import pytest
 import pytest_asyncio
 from asgi_lifespan import LifespanManager
 
+from .utils import auth
+from .utils.cache import redis as redis_cache
+from .utils.cache import memberships
+from .utils.cache.memberships import cache_membership, get_cached_membership
+from .utils.cache.tokens import (
+    TOKEN_CACHE_PREFIX,
+    LocalTokenCache,
+    cache_user,
+    evict_user_tokens,
+    get_cached_user,
+    hash_token,
+    local_token_cache,
+)
 from .utils.db.pool import get_db_conn
+from .utils.db.friendships import (
+    FRIEND_IDS_QUERY,
+    FRIEND_REQUEST_ROWS_QUERY,
+    FRIENDSHIP_CHECK_QUERY,
+)
+from .utils.db.sync_state import dead_letters, recent_sync_runs
+from .utils.executor import BoundedExecutor, ExecutorSaturated
+from .utils.friend_graph import FriendGraph
+from .utils import notification_outbox
+from .utils.upstream_limiter import AdaptiveLimiter, LimiterBusy
 from . import app as main
 
 from appwrite.client import Client
+from appwrite.exception import AppwriteException
 from appwrite.services.users import Users
 from appwrite.query import Query
 from .utils.env import getFromEnv
@@ -19,6 +50,27 @@ HEADERS_USER1 = {"Authorization": f"Bearer {USER_ID.lower()}"}
 HEADERS_USER2 = {"Authorization": f"Bearer {SECOND_USER_ID.lower()}"}
 
 
+def make_jwt(exp: float) -> str:
+    """An unsigned JWT with just an `exp` claim; the caches only ever read that."""
+    claims = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode())
+    return f"header.{claims.rstrip(b'=').decode()}.signature"
+
+
+class CachedUser:
+    """Stands in for appwrite.models.User, which the caches only read `id` from."""
+
+    def __init__(self, user_id: str) -> None:
+        self.id = user_id
+
+    def to_json(self) -> str:
+        return json.dumps({"$id": self.id})
+
+
+def make_request(headers: dict[str, str]) -> Request:
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+    return Request({"type": "http", "headers": raw_headers})
+
+
 @pytest_asyncio.fixture(scope="function")
 async def client():
     """Create an AsyncClient with lifespan management for testing."""
@@ -134,7 +186,74 @@ async def test_onboarding_flow_routes(client: AsyncClient):
         json={"url": f"https://webservices.runshaw.ac.uk/timetable.ashx?id={USER_ID}"},
         headers=HEADERS_USER1,
     )
-    assert response.status_code == 201
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    assert response.headers["Location"] == f"/api/timetable/sync-jobs/{job_id}"
+
+
+@pytest.mark.asyncio
+async def test_sync_jobs_deduplicated(client: AsyncClient):
+    url = f"https://webservices.runshaw.ac.uk/timetable.ashx?id={USER_ID}"
+    first = await client.post(
+        "/api/timetable/associate", json={"url": url}, headers=HEADERS_USER1
+    )
+    # the worker doesn't run under pytest, so the first job is still queued
+    second = await client.post(
+        "/api/timetable/associate", json={"url": url + "x"}, headers=HEADERS_USER1
+    )
+    assert first.json()["job_id"] == second.json()["job_id"]
+
+    job_id = first.json()["job_id"]
+    response = await client.get(
+        f"/api/timetable/sync-jobs/{job_id}", headers=HEADERS_USER1
+    )
+    assert response.status_code == 200
+    assert response.json()["status"] == "queued"
+    assert response.json()["attempts"] == 0
+
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    assert (
+        await db_conn.fetchval("SELECT url FROM sync_jobs WHERE id = $1", job_id)
+        == url + "x"
+    )
+
+    # other users can't see it
+    response = await client.get(
+        f"/api/timetable/sync-jobs/{job_id}", headers=HEADERS_USER2
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_dead_lettered_sync_reset_by_association(client: AsyncClient):
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    # as the sync engine leaves it after too many failures in a row
+    await db_conn.execute(
+        """
+        INSERT INTO sync_state (user_id, last_error, last_error_at,
+            consecutive_failures, next_eligible_at, dead_lettered_at)
+        VALUES ($1, 'ClientResponseError: 404', now(), 6, now() + interval '30 days', now())
+        ON CONFLICT (user_id) DO UPDATE SET dead_lettered_at = now()
+        """,
+        USER_ID.lower(),
+    )
+    rows = await dead_letters(db_conn, 1000)
+    assert USER_ID.lower() in {row["user_id"] for row in rows}
+
+    response = await client.post(
+        "/api/timetable/associate",
+        json={"url": f"https://webservices.runshaw.ac.uk/timetable.ashx?id={USER_ID}"},
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 202
+    assert (
+        await db_conn.fetchval(
+            "SELECT 1 FROM sync_state WHERE user_id = $1", USER_ID.lower()
+        )
+        is None
+    )
 
 
 @pytest.mark.asyncio
@@ -209,6 +328,664 @@ async def test_friend_requests(client: AsyncClient):
     assert response.json()[0]["status"] == "accepted"
 
 
+@pytest.mark.asyncio
+async def test_friends_pagination_and_etag(client: AsyncClient):
+    response = await client.get("/api/friends", headers=HEADERS_USER2)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    # unchanged list revalidates to a 304
+    response = await client.get(
+        "/api/friends", headers={**HEADERS_USER2, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    # a full page hands back a cursor, which leads to the (empty) next page
+    response = await client.get("/api/friends?limit=1", headers=HEADERS_USER2)
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    cursor = response.headers["X-Next-Cursor"]
+
+    response = await client.get(
+        f"/api/friends?limit=1&after={cursor}", headers=HEADERS_USER2
+    )
+    assert response.status_code == 200
+    assert response.json() == []
+    assert "X-Next-Cursor" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_friendships_mirror_friend_requests(client: AsyncClient):
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    # accepted in test_friend_requests, so it should be stored once as an ordered pair
+    rows = await db_conn.fetch(
+        "SELECT * FROM friendships WHERE user_a = $1 OR user_b = $1",
+        USER_ID.lower(),
+    )
+    assert len(rows) == 1
+    assert rows[0]["user_a"] < rows[0]["user_b"]
+    assert {rows[0]["user_a"], rows[0]["user_b"]} == {
+        USER_ID.lower(),
+        SECOND_USER_ID.lower(),
+    }
+
+
+@pytest.mark.asyncio
+async def test_friend_request_notifications_queued(client: AsyncClient):
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    # the request and its acceptance in test_friend_requests each queue a notification
+    rows = await db_conn.fetch(
+        "SELECT user_ids, title FROM notification_outbox WHERE user_ids && $1::text[]",
+        [USER_ID.lower(), SECOND_USER_ID.lower()],
+    )
+    queued = {(row["title"], row["user_ids"][0]) for row in rows}
+    assert ("Friend Request", SECOND_USER_ID.lower()) in queued
+    assert ("Friend Request Accepted", USER_ID.lower()) in queued
+
+
+def test_friend_graph_suggestions():
+    graph = FriendGraph.build(
+        [("a", "b"), ("b", "c"), ("a", "d"), ("d", "c"), ("d", "e")],
+        blocks=[("f", "a")],
+    )
+    graph.add_friendship("b", "f")
+    assert graph.suggestions("a") == [("c", 2), ("e", 1)]
+    assert graph.suggestions("a", exclude=["c"]) == [("e", 1)]
+    assert graph.mutual_friends("a", "c") == ["b", "d"]
+
+    graph.remove_friendship("a", "d")
+    graph.remove_block("f", "a")
+    assert graph.suggestions("a") == [("c", 1), ("f", 1)]
+
+
+@pytest.mark.asyncio
+async def test_sync_runs_listed(client: AsyncClient):
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    worker_id = f"test:{uuid.uuid4().hex[:8]}"
+    summary = {
+        "worker_id": worker_id,
+        "written": 3,
+        "failures": [{"stage": "fetch", "class": "timeout", "count": 1}],
+        "histograms": {"sync_fetch_seconds": {"count": 4, "sum": 1.5}},
+    }
+    await db_conn.execute(
+        "INSERT INTO sync_runs (worker_id, started_at, summary) VALUES ($1, now(), $2)",
+        worker_id,
+        json.dumps(summary),
+    )
+    runs = await recent_sync_runs(db_conn, 200)
+    run = next(run for run in runs if run["worker_id"] == worker_id)
+    assert run["summary"] == summary
+    await db_conn.execute("DELETE FROM sync_runs WHERE worker_id = $1", worker_id)
+
+
+@pytest.mark.asyncio
+async def test_upstream_limiter_backs_off():
+    limiter = AdaptiveLimiter("test", 10, 20, 4, 8)
+    for _ in range(5):
+        async with limiter:
+            pass
+    assert limiter.stats()["rate"] > 10
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        async with limiter:
+            raise aiohttp.ClientResponseError(
+                None, (), status=429, headers={"Retry-After": "0.2"}
+            )
+    stats = limiter.stats()
+    assert stats["rate"] < 10 and stats["concurrency_limit"] == 2
+    assert stats["throttled"] == 1 and stats["paused_for_seconds"] > 0
+    assert stats["in_flight"] == 0
+
+    # a 404 is the caller's problem, not a sign of overload
+    with pytest.raises(aiohttp.ClientResponseError):
+        async with limiter:
+            raise aiohttp.ClientResponseError(None, (), status=404)
+    assert limiter.stats()["throttled"] == 1
+
+
+
+@pytest.mark.asyncio
+async def test_upstream_limiter_slot_gives_up():
+    limiter = AdaptiveLimiter("test", 10, 20, 1, 1)
+    async with limiter.slot(1):
+        # the only turn is taken, so a second caller times out
+        with pytest.raises(LimiterBusy) as busy:
+            async with limiter.slot(0.05):
+                pass
+    assert busy.value.retry_after >= 1
+    stats = limiter.stats()
+    assert stats["in_flight"] == 0 and stats["waiting"] == 0
+    async with limiter.slot(1):
+        pass
+    assert limiter.stats()["successes"] == 2
+
+def test_local_token_cache_expiry_and_lru():
+    cache = LocalTokenCache(2)
+    cache.set("a", CachedUser("a"), time.time() + 60)
+    cache.set("b", CachedUser("b"), time.time() + 60)
+    assert cache.get("a").id == "a"
+    # "b" is now the least recently used, so it makes way for "c"
+    cache.set("c", CachedUser("c"), time.time() + 60)
+    assert cache.get("b") is None
+    assert cache.get("a").id == "a" and cache.get("c").id == "c"
+
+    cache.evict_user("C")
+    assert cache.get("c") is None and len(cache) == 1
+    cache.set("d", CachedUser("d"), time.time() - 1)
+    assert cache.get("d") is None and len(cache) == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_tokens_expire_with_jwt(monkeypatch):
+    monkeypatch.setattr(redis_cache, "redis_pool", None)
+    user = CachedUser(f"token-{uuid.uuid4().hex[:8]}")
+
+    # well inside the local TTL, so the JWT's exp is what bounds the entry
+    exp = time.time() + 5
+    token = make_jwt(exp)
+    await cache_user(token, user)
+    assert await get_cached_user(token) is user
+    assert local_token_cache._entries[hash_token(token)][0] == exp
+
+    expired = make_jwt(time.time() - 1)
+    await cache_user(expired, user)
+    assert await get_cached_user(expired) is None
+
+    # no exp claim means no way to know when to stop trusting it
+    await cache_user("not-a-jwt", user)
+    assert await get_cached_user("not-a-jwt") is None
+
+
+@pytest.mark.asyncio
+async def test_evict_user_tokens(client: AsyncClient):
+    user = CachedUser(f"Evict-{uuid.uuid4().hex[:8]}")
+    other = CachedUser(f"keep-{uuid.uuid4().hex[:8]}")
+    tokens = [make_jwt(time.time() + 60 + n) for n in range(2)]
+    other_token = make_jwt(time.time() + 90)
+    for token in tokens:
+        await cache_user(token, user)
+    await cache_user(other_token, other)
+
+    await evict_user_tokens(user.id.lower())
+    for token in tokens:
+        assert local_token_cache.get(hash_token(token)) is None
+    assert local_token_cache.get(hash_token(other_token)) is other
+
+    redis_conn = redis_cache.redis_pool
+    if redis_conn is not None:
+        for token in tokens:
+            key = f"{TOKEN_CACHE_PREFIX}{hash_token(token)}"
+            assert not await redis_conn.exists(key)
+        key = f"{TOKEN_CACHE_PREFIX}{hash_token(other_token)}"
+        assert await redis_conn.exists(key)
+    await evict_user_tokens(other.id)
+
+
+@pytest.mark.asyncio
+async def test_admin_check_not_cached_on_appwrite_error(monkeypatch):
+    monkeypatch.setattr(redis_cache, "redis_pool", None)
+
+    class FailingAppwrite:
+        async def list_memberships(self, user_id):
+            raise aiohttp.ServerTimeoutError()
+
+    async def get_failing_appwrite():
+        return FailingAppwrite()
+
+    monkeypatch.setattr(auth, "get_appwrite_client", get_failing_appwrite)
+    user = CachedUser(f"admin-{uuid.uuid4().hex[:8]}")
+    request = make_request({})
+    request.state.user_id = user.id
+    with pytest.raises(HTTPException) as error:
+        await auth.isAdmin(request, user)
+    assert error.value.status_code == 503
+    admin_team_id = getFromEnv("APPWRITE_ADMIN_TEAM_ID")
+    assert await get_cached_membership(user.id, admin_team_id) is None
+
+
+@pytest.mark.asyncio
+async def test_membership_cache_ttls(client: AsyncClient):
+    member = f"member-{uuid.uuid4().hex[:8]}"
+    non_member = f"nonmember-{uuid.uuid4().hex[:8]}"
+    expected_ttls = {
+        member: memberships.MEMBERSHIP_CACHE_TTL_SECONDS,
+        non_member: memberships.MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS,
+    }
+
+    async def check_cached():
+        assert await get_cached_membership(member, "team") is True
+        assert await get_cached_membership(non_member, "team") is False
+        for user_id, ttl in expected_ttls.items():
+            expires_at, _ = memberships._local_memberships[(user_id, "team")]
+            assert expires_at - time.time() == pytest.approx(ttl, abs=5)
+
+    await cache_membership(member, "team", True)
+    await cache_membership(non_member, "team", False)
+    await check_cached()
+
+    if redis_cache.redis_pool is not None:
+        # a hit in Redis is kept locally for the TTL that matches the answer
+        for user_id in expected_ttls:
+            del memberships._local_memberships[(user_id, "team")]
+        await check_cached()
+
+        # ...but never for longer than the Redis entry has left
+        await redis_cache.redis_pool.expire(memberships._cache_key(member, "team"), 10)
+        del memberships._local_memberships[(member, "team")]
+        expected_ttls[member] = 10
+        await check_cached()
+
+    for user_id in expected_ttls:
+        await memberships.evict_membership(user_id, "team")
+
+
+@pytest.mark.asyncio
+async def test_membership_cache_bounded(monkeypatch):
+    monkeypatch.setattr(redis_cache, "redis_pool", None)
+    monkeypatch.setattr(memberships, "MEMBERSHIP_CACHE_MAX_ENTRIES", 2)
+    monkeypatch.setattr(memberships, "_local_memberships", memberships.OrderedDict())
+    await cache_membership("a", "team", True)
+    await cache_membership("b", "team", False)
+    assert await get_cached_membership("a", "team") is True
+    await cache_membership("c", "team", True)
+    assert await get_cached_membership("b", "team") is None
+    assert len(memberships._local_memberships) == 2
+
+
+@pytest.mark.asyncio
+async def test_validate_token_single_flight(monkeypatch):
+    # run the real validation path rather than the test bypass
+    monkeypatch.setenv("APP_ENV", "production")
+    monkeypatch.setattr(redis_cache, "redis_pool", None)
+    user = CachedUser(f"flight-{uuid.uuid4().hex[:8]}")
+    upstream_calls = 0
+    upstream_error = None
+    release = asyncio.Event()
+
+    async def slow_appwrite(token: str):
+        nonlocal upstream_calls
+        upstream_calls += 1
+        await release.wait()
+        if upstream_error is not None:
+            raise upstream_error
+        return user
+
+    monkeypatch.setattr(auth, "_get_user_from_jwt", slow_appwrite)
+
+    async def validate_concurrently(token: str, callers: int) -> list:
+        release.clear()
+        requests = [
+            asyncio.create_task(
+                auth.validateToken(make_request({"Authorization": f"Bearer {token}"}))
+            )
+            for _ in range(callers)
+        ]
+        await asyncio.sleep(0.05)  # let every caller join the lookup
+        release.set()
+        return await asyncio.gather(*requests, return_exceptions=True)
+
+    # tokens without an exp are never cached, so each round goes upstream
+    results = await validate_concurrently("no-exp-token", 10)
+    assert upstream_calls == 1
+    assert all(result is user for result in results)
+    assert auth._inflight_validations == {}
+
+    upstream_calls = 0
+    upstream_error = AppwriteException("Invalid token", 401, "user_jwt_invalid")
+    results = await validate_concurrently("no-exp-token", 10)
+    assert upstream_calls == 1
+    assert all(
+        isinstance(result, HTTPException) and result.status_code == 401
+        for result in results
+    )
+    assert auth._inflight_validations == {}
+
+
+@pytest.mark.asyncio
+async def test_bounded_executor_rejects_when_full():
+    executor = BoundedExecutor("test", max_workers=1, max_queue=1, retry_after=3)
+    first_done, second_done = threading.Event(), threading.Event()
+    running = asyncio.create_task(executor.run(first_done.wait, 5))
+    queued = asyncio.create_task(executor.run(second_done.wait, 5))
+    await asyncio.sleep(0.05)
+    assert executor.stats()["in_flight"] == 1 and executor.stats()["queued"] == 1
+
+    with pytest.raises(ExecutorSaturated) as error:
+        await executor.run(time.sleep, 0)
+    assert error.value.status_code == 503
+    assert error.value.headers == {"Retry-After": "3"}
+
+    # once the first call finishes the queued one starts, leaving a queue slot free
+    first_done.set()
+    assert await running is True
+    await asyncio.sleep(0.05)
+    assert executor.stats()["queued"] == 0
+    third = asyncio.create_task(executor.run(lambda: "ran"))
+    second_done.set()
+    assert await queued is True and await third == "ran"
+    assert executor.stats()["rejected"] == 1 and executor.stats()["completed"] == 3
+    executor._executor.shutdown()
+
+
+def test_notification_chunks_hold_whole_rows(monkeypatch):
+    monkeypatch.setattr(notification_outbox, "ONESIGNAL_MAX_RECIPIENTS", 3)
+    rows = [
+        {"id": 1, "user_ids": ["a", "b"]},
+        {"id": 2, "user_ids": ["b"]},
+        {"id": 3, "user_ids": ["c", "d"]},
+        {"id": 4, "user_ids": ["e"]},
+    ]
+    chunks = notification_outbox._chunk_rows(rows)
+    # a failed call only retries its own rows, so no one is sent a push twice
+    assert [[row["id"] for row in chunk] for chunk in chunks] == [[1, 2], [3, 4]]
+
+
+@pytest.mark.asyncio
+async def test_friend_suggestion_routes(client: AsyncClient):
+    # user 1 and user 2 are friends from test_friend_requests, with no one else around
+    response = await client.get("/api/friends/suggestions", headers=HEADERS_USER1)
+    assert response.status_code == 200
+    assert response.json() == []
+
+    response = await client.get(
+        f"/api/friends/mutual/{SECOND_USER_ID}", headers=HEADERS_USER1
+    )
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_friendship_queries_use_indexes(client: AsyncClient):
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    async with db_conn.transaction():
+        # tiny test tables would otherwise be seq scanned regardless of indexes
+        await db_conn.execute("SET LOCAL enable_seqscan = off")
+        for query, args in [
+            (FRIENDSHIP_CHECK_QUERY, (USER_ID.lower(), SECOND_USER_ID.lower())),
+            (FRIEND_IDS_QUERY, (USER_ID.lower(),)),
+            (FRIEND_REQUEST_ROWS_QUERY, (USER_ID.lower(), None, None, None)),
+        ]:
+            plan = "\n".join(
+                row[0] for row in await db_conn.fetch(f"EXPLAIN {query}", *args)
+            )
+            assert "Seq Scan" not in plan
+            assert "friendships_pkey" in plan or "friendships_user_b_idx" in plan
+
+
+@pytest.mark.asyncio
+async def test_batch_get_timetable_authorisation(client: AsyncClient):
+    response = await client.post(
+        "/api/timetable/batch_get",
+        json={"user_ids": [USER_ID.lower(), SECOND_USER_ID.lower()]},
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 200
+    assert set(response.json()) == {USER_ID.lower(), SECOND_USER_ID.lower()}
+
+    # a single non-friend in the batch rejects the whole request
+    response = await client.post(
+        "/api/timetable/batch_get",
+        json={"user_ids": [SECOND_USER_ID.lower(), f"{uuid.uuid4()}"]},
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_timetable_passed_through(client: AsyncClient):
+    timetable = {
+        "version": "2.0",
+        "data": [{"summary": "Computing – Room B1", "dtstart": {"dt": "20250901T090000"}}],
+    }
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    await db_conn.execute(
+        """INSERT INTO timetables (user_id, timetable) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET timetable = $2""",
+        SECOND_USER_ID.lower(),
+        json.dumps(timetable),
+    )
+
+    response = await client.get(
+        f"/api/timetable?user_id={SECOND_USER_ID.lower()}", headers=HEADERS_USER1
+    )
+    assert response.status_code == 200
+    assert response.json() == {"timetable": timetable}
+
+    response = await client.post(
+        "/api/timetable/batch_get",
+        json={"user_ids": [SECOND_USER_ID.lower(), USER_ID.lower()]},
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 200
+    version = response.json()[SECOND_USER_ID.lower()]["version"]
+    assert response.json() == {
+        SECOND_USER_ID.lower(): {"data": timetable["data"], "version": version},
+        USER_ID.lower(): {"data": [], "version": None},
+    }
+
+
+@pytest.mark.asyncio
+async def test_timetable_conditional_get(client: AsyncClient):
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    await db_conn.execute(
+        """INSERT INTO timetables (user_id, timetable) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET timetable = $2""",
+        SECOND_USER_ID.lower(),
+        json.dumps({"data": [{"summary": "Maths"}]}),
+    )
+
+    response = await client.get(
+        f"/api/timetable?user_id={SECOND_USER_ID.lower()}", headers=HEADERS_USER1
+    )
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = await client.get(
+        f"/api/timetable?user_id={SECOND_USER_ID.lower()}",
+        headers={**HEADERS_USER1, "If-None-Match": etag},
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    response = await client.post(
+        "/api/timetable/batch_get",
+        json={
+            "user_ids": [SECOND_USER_ID.lower()],
+            "known_versions": {SECOND_USER_ID.lower(): etag.strip('"')},
+        },
+        headers=HEADERS_USER1,
+    )
+    assert response.json() == {"timetables": {}, "unchanged": [SECOND_USER_ID.lower()]}
+
+    # a write changes the version
+    await db_conn.execute(
+        "UPDATE timetables SET timetable = $2 WHERE user_id = $1",
+        SECOND_USER_ID.lower(),
+        json.dumps({"data": [{"summary": "Physics"}]}),
+    )
+    response = await client.get(
+        f"/api/timetable?user_id={SECOND_USER_ID.lower()}",
+        headers={**HEADERS_USER1, "If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    response = await client.post(
+        "/api/timetable/batch_get",
+        json={
+            "user_ids": [SECOND_USER_ID.lower()],
+            "known_versions": {SECOND_USER_ID.lower(): etag.strip('"')},
+        },
+        headers=HEADERS_USER1,
+    )
+    body = response.json()
+    assert body["unchanged"] == []
+    assert body["timetables"][SECOND_USER_ID.lower()]["data"] == [{"summary": "Physics"}]
+    assert body["timetables"][SECOND_USER_ID.lower()]["version"] != etag.strip('"')
+
+
+@pytest.mark.asyncio
+async def test_timetable_window(client: AsyncClient):
+    events = [
+        {
+            "summary": f"Lesson {day}",
+            "dtstart": {"dt": f"202509{day:02d}T090000"},
+            "dtend": {"dt": f"202509{day:02d}T100000"},
+        }
+        for day in (1, 2, 3)
+    ]
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    await db_conn.execute(
+        """INSERT INTO timetables (user_id, timetable) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET timetable = $2""",
+        SECOND_USER_ID.lower(),
+        json.dumps({"data": events}),
+    )
+
+    response = await client.get(
+        f"/api/timetable?user_id={SECOND_USER_ID.lower()}&from=2025-09-02&to=2025-09-03",
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 200
+    assert response.json() == {"timetable": {"data": [events[1]]}}
+
+    response = await client.get(
+        f"/api/timetable?user_id={SECOND_USER_ID.lower()}&from=2025-09-02T09:30:00",
+        headers=HEADERS_USER1,
+    )
+    assert response.json() == {"timetable": {"data": [events[2]]}}
+
+    response = await client.get(
+        f"/api/timetable?user_id={SECOND_USER_ID.lower()}&from=2025-09-03&to=2025-09-02",
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_timetable_events_diffed_by_uid(client: AsyncClient):
+    events = [
+        {
+            "uid": f"event-{day}",
+            "summary": "Maths",
+            "dtstart": {"dt": f"202509{day:02d}T090000"},
+            "dtend": {"dt": f"202509{day:02d}T100000"},
+        }
+        for day in (1, 2, 3)
+    ]
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    upsert = """INSERT INTO timetables (user_id, timetable) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET timetable = $2"""
+    await db_conn.execute(upsert, SECOND_USER_ID.lower(), json.dumps({"data": events}))
+    versions = """SELECT uid, xmin::text AS version FROM timetable_events
+        WHERE user_id = $1 ORDER BY uid"""
+    before = dict(await db_conn.fetch(versions, SECOND_USER_ID.lower()))
+
+    # change one event, drop one and add one
+    events[0]["summary"] = "Further Maths"
+    events[2] = {**events[2], "uid": "event-4"}
+    await db_conn.execute(upsert, SECOND_USER_ID.lower(), json.dumps({"data": events}))
+    after = dict(await db_conn.fetch(versions, SECOND_USER_ID.lower()))
+
+    assert set(after) == {"event-1", "event-2", "event-4"}
+    assert after["event-2"] == before["event-2"]
+    assert after["event-1"] != before["event-1"]
+
+
+@pytest.mark.asyncio
+async def test_friends_now(client: AsyncClient):
+    event = {
+        "summary": "Biology",
+        "location": "Room S4",
+        "dtstart": {"dt": "20250901T090000"},
+        "dtend": {"dt": "20250901T100000"},
+    }
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    await db_conn.execute(
+        """INSERT INTO timetables (user_id, timetable) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET timetable = $2""",
+        SECOND_USER_ID.lower(),
+        json.dumps({"data": [event]}),
+    )
+
+    response = await client.get(
+        "/api/friends/now?at=2025-09-01T09:30:00", headers=HEADERS_USER1
+    )
+    assert response.status_code == 200
+    assert {
+        "user_id": SECOND_USER_ID.lower(),
+        "status": "busy",
+        "event": event,
+    } in response.json()
+
+    response = await client.get(
+        "/api/friends/now?at=2025-09-01T08:00:00", headers=HEADERS_USER1
+    )
+    assert {
+        "user_id": SECOND_USER_ID.lower(),
+        "status": "free",
+        "next": event,
+    } in response.json()
+
+
+@pytest.mark.asyncio
+async def test_common_free(client: AsyncClient):
+    db_gen = get_db_conn()
+    db_conn = await anext(db_gen)
+    await db_conn.execute(
+        """INSERT INTO timetables (user_id, timetable) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET timetable = $2""",
+        SECOND_USER_ID.lower(),
+        json.dumps(
+            {
+                "data": [
+                    {
+                        "summary": "Biology",
+                        "dtstart": {"dt": "20250901T090000"},
+                        "dtend": {"dt": "20250901T100000"},
+                    }
+                ]
+            }
+        ),
+    )
+
+    response = await client.post(
+        "/api/timetable/common-free",
+        json={
+            "user_ids": [SECOND_USER_ID.lower()],
+            "start": "2025-09-01T08:00:00",
+            "end": "2025-09-01T12:00:00",
+        },
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {"start": "2025-09-01T08:00:00+01:00", "end": "2025-09-01T09:00:00+01:00"},
+        {"start": "2025-09-01T10:00:00+01:00", "end": "2025-09-01T12:00:00+01:00"},
+    ]
+
+    response = await client.post(
+        "/api/timetable/common-free",
+        json={
+            "user_ids": [str(uuid.uuid4())],
+            "start": "2025-09-01T08:00:00",
+            "end": "2025-09-01T12:00:00",
+        },
+        headers=HEADERS_USER1,
+    )
+    assert response.status_code == 403
+
+
 @pytest.mark.asyncio
 async def test_account_deletion(client: AsyncClient):
     for userID in [USER_ID, SECOND_USER_ID]:
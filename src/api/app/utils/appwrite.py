@@ -1,19 +1,26 @@
-import asyncio
-from typing import Any, Callable
+import os
+import typing
+from typing import Any
 
+import aiohttp
 from appwrite.client import Client
-from appwrite.services.users import Users
+from appwrite.exception import AppwriteException
+from appwrite.models import User
+from fastapi import HTTPException
+
 from app.utils.env import getFromEnv
+from app.utils.logging import Logger
 
+logger = Logger("appwrite")
 
-async def run_appwrite_call(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
-    """Run blocking Appwrite SDK calls in a thread to avoid blocking the event loop."""
-    return await asyncio.to_thread(func, *args, **kwargs)
+APPWRITE_POOL_SIZE = int(os.getenv("APPWRITE_POOL_SIZE", 20))
+APPWRITE_TIMEOUT_SECONDS = float(os.getenv("APPWRITE_TIMEOUT_SECONDS", 10))
 
 
 def get_admin_client() -> Client:
     """
-    Get the Appwrite admin client
+    Get the (blocking) Appwrite SDK admin client. Request handlers should use
+    get_appwrite_client() instead; this is kept for scripts and tests.
     Returns:
         Client: The Appwrite admin client
     """
@@ -24,3 +31,126 @@ def get_admin_client() -> Client:
     adminClient.set_key(getFromEnv("APPWRITE_API_KEY"))
 
     return adminClient
+
+
+class AsyncAppwriteClient:
+    """
+    Minimal async Appwrite REST client covering the endpoints the API uses.
+    One instance lives for the lifetime of the app so every call reuses the
+    same pooled keep-alive connections instead of opening a new HTTPS
+    connection (and tying up a worker thread) per request.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        project_id: str,
+        api_key: str,
+        session: aiohttp.ClientSession,
+    ) -> None:
+        self._endpoint = endpoint.rstrip("/")
+        self._session = session
+        self._project_headers = {
+            "x-appwrite-project": project_id,
+            "x-sdk-name": "Python",
+            "x-sdk-platform": "server",
+            "x-sdk-language": "python",
+            "content-type": "application/json",
+        }
+        self._admin_headers = {**self._project_headers, "x-appwrite-key": api_key}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._session
+
+    async def _call(
+        self,
+        method: str,
+        path: str,
+        headers: dict[str, str],
+    ) -> Any:
+        async with self._session.request(
+            method, f"{self._endpoint}{path}", headers=headers
+        ) as response:
+            if response.content_type == "application/json":
+                data = await response.json()
+            else:
+                data = await response.text()
+
+            if response.status >= 400:
+                # same exception type as the SDK, so existing handlers keep working
+                if isinstance(data, dict):
+                    raise AppwriteException(
+                        data.get("message", ""),
+                        response.status,
+                        data.get("type"),
+                        data,
+                    )
+                raise AppwriteException(data, response.status, None, data)
+            return data
+
+    async def get_user(self, user_id: str) -> User:
+        data = await self._call("GET", f"/users/{user_id}", self._admin_headers)
+        return User.with_data(data)
+
+    async def get_account(self, jwt: str) -> User:
+        """Fetch the user a JWT belongs to. Deliberately doesn't send the API key."""
+        data = await self._call(
+            "GET", "/account", {**self._project_headers, "x-appwrite-jwt": jwt}
+        )
+        return User.with_data(data)
+
+    async def list_memberships(self, user_id: str) -> list[dict]:
+        # returned as raw JSON; the SDK models fail validation on some membership fields
+        data = await self._call(
+            "GET", f"/users/{user_id}/memberships", self._admin_headers
+        )
+        return data.get("memberships", []) if isinstance(data, dict) else []
+
+    async def delete_user(self, user_id: str) -> None:
+        await self._call("DELETE", f"/users/{user_id}", self._admin_headers)
+
+
+appwrite_client: typing.Optional[AsyncAppwriteClient] = None
+
+
+async def initialise_appwrite_client():
+    global appwrite_client
+    if appwrite_client is None:
+        logger.info("Initializing Appwrite client...")
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=APPWRITE_POOL_SIZE, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=APPWRITE_TIMEOUT_SECONDS),
+        )
+        appwrite_client = AsyncAppwriteClient(
+            getFromEnv("APPWRITE_ENDPOINT"),
+            getFromEnv("APPWRITE_PROJECT_ID"),
+            getFromEnv("APPWRITE_API_KEY"),
+            session,
+        )
+        logger.info("Appwrite client initialized.")
+    else:
+        logger.info("Appwrite client already initialized.")
+
+
+async def close_appwrite_client():
+    global appwrite_client
+    if appwrite_client:
+        logger.info("Closing Appwrite client...")
+        try:
+            await appwrite_client.session.close()
+            logger.info("Appwrite client closed.")
+        except Exception:
+            logger.exception("Failed to close Appwrite client.")
+            raise
+        finally:
+            appwrite_client = None
+
+
+async def get_appwrite_client() -> AsyncAppwriteClient:
+    if not appwrite_client:
+        logger.error("Appwrite client is not initialized.")
+        raise HTTPException(status_code=503, detail="Auth service unavailable")
+    return appwrite_client
@@ -1,31 +1,66 @@
+import asyncio
 import sys
 import os
-import appwrite
-from fastapi import HTTPException, Request
-from appwrite.client import Client
+import aiohttp
+from fastapi import Depends, HTTPException, Request
 from appwrite.exception import AppwriteException
 from fastapi.security import HTTPBearer
 from app.utils.env import getFromEnv
-from app.utils.appwrite import run_appwrite_call, get_admin_client
+from app.utils.appwrite import get_appwrite_client
+from app.utils.cache.memberships import cache_membership, get_cached_membership
+from app.utils.cache.tokens import cache_user, get_cached_user, hash_token
 from app.utils.logging import Logger
-from appwrite.services.account import Account
-from appwrite.services.users import Users
 
 logger = Logger("auth")
 
 
-def _get_user_from_jwt(token: str):
-    """Build and call Appwrite Account client in the same worker thread."""
-    authClient = Client()
-    authClient.set_endpoint(getFromEnv("APPWRITE_ENDPOINT"))
-    authClient.set_project(getFromEnv("APPWRITE_PROJECT_ID"))
-    authClient.set_jwt(token)
-    account = Account(authClient)
-    return account.get()
+async def _get_user_from_jwt(token: str):
+    """Ask Appwrite which user a JWT belongs to."""
+    client = await get_appwrite_client()
+    return await client.get_account(token)
+
+
+# Appwrite lookups currently running in this worker, keyed by token hash. The app fires
+# several requests with the same token at launch, and they should share one round trip.
+_inflight_validations: dict[str, asyncio.Task] = {}
+
+
+async def _fetch_and_cache_user(token: str):
+    user = await _get_user_from_jwt(token)
+    if user is not None and user.id:
+        await cache_user(token, user)
+    return user
+
+
+def _forget_inflight_validation(key: str, task: asyncio.Task) -> None:
+    if _inflight_validations.get(key) is task:
+        del _inflight_validations[key]
+    if not task.cancelled():
+        task.exception()  # mark as retrieved even if every waiter went away
+
+
+async def _validate_with_appwrite(token: str):
+    """Single-flight wrapper: concurrent callers with the same token share one Appwrite call,
+    and all of them see its result or its exception."""
+    key = hash_token(token)
+    task = _inflight_validations.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_and_cache_user(token))
+        _inflight_validations[key] = task
+        task.add_done_callback(lambda t: _forget_inflight_validation(key, t))
+    # shield so one disconnecting client doesn't cancel the lookup for everyone else
+    return await asyncio.shield(task)
 
 
 async def validateToken(req: Request):
-    """Authenticate users with their JWT from Appwrite"""
+    """
+    Authenticate users with their JWT from Appwrite. The user is memoized on
+    `req.state`, so calling this again later in the same request is free.
+    """
+    memoized_user = getattr(req.state, "user", None)
+    if memoized_user is not None:
+        return memoized_user
+
     app_env = os.getenv("APP_ENV", "").lower()
     is_production = app_env in {"prod", "production"}
 
@@ -37,7 +72,8 @@ async def validateToken(req: Request):
         else:
             user_id = auth_header
         req.state.user_id = user_id
-        return {"$id": user_id, "name": "Test User"}
+        req.state.user = {"$id": user_id, "name": "Test User"}
+        return req.state.user
 
     token = ""
     try:
@@ -59,10 +95,13 @@ async def validateToken(req: Request):
         if not token:
             raise HTTPException(status_code=401, detail="Unauthorized; missing token.")
 
-        user = await run_appwrite_call(_get_user_from_jwt, token)
+        user = await get_cached_user(token)
+        if user is None:
+            user = await _validate_with_appwrite(token)
 
         if user is not None and user.id:
             req.state.user_id = user.id.lower()
+            req.state.user = user
         else:
             raise HTTPException(
                 status_code=401, detail="Unauthorized; invalid user data."
@@ -81,56 +120,45 @@ async def validateToken(req: Request):
         raise HTTPException(status_code=401, detail="Unauthorized; invalid token.")
 
 
-async def isAdmin(req: Request):
-    authedUser = await validateToken(req)
-
-    adminClient = get_admin_client()
-
-    users = Users(adminClient)
-
-    memberships = None
-    try:
-        result = await run_appwrite_call(users.list_memberships, user_id=authedUser.id)
-        # SDK may return a model object with `.memberships` or a dict-like result (bad, I know!)
-        if hasattr(result, "memberships"):
-            memberships = result.memberships
-        elif isinstance(result, dict):
-            memberships = result.get("memberships", [])
-    except AppwriteException as e:
-        # Appwrite SDK sometimes fails Pydantic validation for newer/partial fields - awaiting upstream fix
-        # Fall back to raw client call to get the JSON payload and inspect memberships.
-        logger.warning(
-            f"Appwrite membership parse failed, falling back to raw call: {e}"
-        )
-        try:
-            raw = await run_appwrite_call(
-                adminClient.call, "get", f"/users/{authedUser.id}/memberships"
-            )
-            import json
-
-            if isinstance(raw, str):
-                raw = json.loads(raw)
-            if isinstance(raw, dict):
-                memberships = raw.get("memberships", [])
-        except Exception as e2:
-            logger.warning(f"Raw memberships call failed: {e2}")
-            memberships = []
-
-    if not memberships:
-        raise HTTPException(status_code=403, detail="Forbidden; not an admin!")
-
-    for membership in memberships:
-        # same situation as above
-        teamid = None
+def _membership_team_ids(memberships) -> list:
+    team_ids = []
+    for membership in memberships or []:
+        # raw JSON from the async client, but tolerate SDK model objects too
         if hasattr(membership, "teamid"):
-            teamid = membership.teamid
+            team_ids.append(membership.teamid)
         elif isinstance(membership, dict):
-            teamid = membership.get("teamid") or membership.get("teamId")
+            team_ids.append(membership.get("teamid") or membership.get("teamId"))
+    return team_ids
 
-        if teamid == getFromEnv("APPWRITE_ADMIN_TEAM_ID"):
-            return True
 
-    raise HTTPException(status_code=403, detail="Forbidden; not an admin!")
+async def _fetch_memberships(user_id: str):
+    client = await get_appwrite_client()
+    try:
+        return await client.list_memberships(user_id)
+    except (AppwriteException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Memberships call failed for user {user_id}: {e!r}")
+        # no answer either way, so the caller mustn't cache this as "not a member"
+        raise HTTPException(status_code=503, detail="Auth service unavailable")
+
+
+async def isAdmin(req: Request, authedUser=Depends(validateToken)):
+    """
+    Require the requester to be in the admin team. Membership is cached per user and
+    team, so warm admin requests don't call Appwrite at all.
+    """
+    admin_team_id = getFromEnv("APPWRITE_ADMIN_TEAM_ID")
+    user_id = req.state.user_id
+
+    is_member = await get_cached_membership(user_id, admin_team_id)
+    if is_member is None:
+        # Appwrite IDs are case-sensitive, so look up by the ID as Appwrite returned it
+        memberships = await _fetch_memberships(getattr(authedUser, "id", user_id))
+        is_member = admin_team_id in _membership_team_ids(memberships)
+        await cache_membership(user_id, admin_team_id, is_member)
+
+    if not is_member:
+        raise HTTPException(status_code=403, detail="Forbidden; not an admin!")
+    return True
 
 
 jwtToken = HTTPBearer(
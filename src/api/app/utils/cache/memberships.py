@@ -0,0 +1,104 @@
+import os
+import time
+import typing
+from collections import OrderedDict
+
+from app.utils.cache import redis as redis_cache
+from app.utils.logging import Logger
+
+logger = Logger("membership_cache")
+
+MEMBERSHIP_CACHE_PREFIX = "team_member:"
+# Admin grants are rare, so members are remembered for longer than non-members;
+# a newly added admin only has to wait out the shorter negative TTL.
+MEMBERSHIP_CACHE_TTL_SECONDS = int(os.getenv("MEMBERSHIP_CACHE_TTL_SECONDS", 300))
+MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS = int(
+    os.getenv("MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS", 60)
+)
+MEMBERSHIP_CACHE_MAX_ENTRIES = int(os.getenv("MEMBERSHIP_CACHE_MAX_ENTRIES", 10000))
+
+# LRU of (user, team) -> (expires_at, is_member), per worker
+_local_memberships: "OrderedDict[tuple[str, str], tuple[float, bool]]" = OrderedDict()
+
+
+def _cache_key(user_id: str, team_id: str) -> str:
+    return f"{MEMBERSHIP_CACHE_PREFIX}{team_id}:{user_id.lower()}"
+
+
+def _ttl(is_member: bool) -> int:
+    return (
+        MEMBERSHIP_CACHE_TTL_SECONDS
+        if is_member
+        else MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS
+    )
+
+
+def _remember_locally(
+    user_id: str, team_id: str, is_member: bool, ttl: typing.Optional[float] = None
+) -> None:
+    key = (user_id.lower(), team_id)
+    ttl = _ttl(is_member) if ttl is None else min(ttl, _ttl(is_member))
+    _local_memberships[key] = (time.time() + ttl, is_member)
+    _local_memberships.move_to_end(key)
+    while len(_local_memberships) > MEMBERSHIP_CACHE_MAX_ENTRIES:
+        _local_memberships.popitem(last=False)
+
+
+async def get_cached_membership(user_id: str, team_id: str) -> typing.Optional[bool]:
+    """Whether `user_id` is in `team_id`, or None if it isn't cached."""
+    key = (user_id.lower(), team_id)
+    entry = _local_memberships.get(key)
+    if entry is not None:
+        expires_at, is_member = entry
+        if expires_at > time.time():
+            _local_memberships.move_to_end(key)
+            return is_member
+        del _local_memberships[key]
+
+    redis_conn = redis_cache.redis_pool
+    if redis_conn is None:
+        return None
+    try:
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.get(_cache_key(user_id, team_id))
+            pipe.pttl(_cache_key(user_id, team_id))
+            raw, pttl = await pipe.execute()
+    except Exception:
+        logger.exception("Failed to read team membership from Redis")
+        return None
+    if raw is None:
+        return None
+
+    is_member = raw == "1"
+    # never outlive the Redis entry, so a revoked admin drops out of both tiers together
+    _remember_locally(
+        user_id, team_id, is_member, pttl / 1000 if pttl and pttl > 0 else None
+    )
+    return is_member
+
+
+async def cache_membership(user_id: str, team_id: str, is_member: bool) -> None:
+    _remember_locally(user_id, team_id, is_member)
+
+    redis_conn = redis_cache.redis_pool
+    if redis_conn is None:
+        return
+    try:
+        await redis_conn.set(
+            _cache_key(user_id, team_id), "1" if is_member else "0", ex=_ttl(is_member)
+        )
+    except Exception:
+        logger.exception("Failed to write team membership to Redis")
+
+
+async def evict_membership(user_id: str, team_id: str) -> None:
+    """Forget a cached membership, e.g. when the user's account is deleted."""
+    _local_memberships.pop((user_id.lower(), team_id), None)
+
+    redis_conn = redis_cache.redis_pool
+    if redis_conn is None:
+        return
+    try:
+        await redis_conn.delete(_cache_key(user_id, team_id))
+    except Exception:
+        logger.exception(f"Failed to evict cached membership for user {user_id}")
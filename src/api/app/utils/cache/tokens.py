@@ -0,0 +1,159 @@
+import base64
+import hashlib
+import json
+import os
+import time
+import typing
+from collections import OrderedDict
+
+from appwrite.models import User
+
+from app.utils.cache import redis as redis_cache
+from app.utils.logging import Logger
+
+logger = Logger("token_cache")
+
+TOKEN_CACHE_PREFIX = "auth_token:"
+USER_TOKENS_PREFIX = "auth_user_tokens:"
+
+# Upper bound on how long a token Appwrite has accepted is trusted without asking again.
+# Entries are always cut short at the JWT's own `exp` claim.
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", 300))
+# The in-process tier lives in each uvicorn worker, but the user-delete webhook only
+# reaches one of them, so it's kept much shorter than the Redis tier.
+TOKEN_CACHE_LOCAL_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_LOCAL_TTL_SECONDS", 30))
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", 10000))
+
+
+def hash_token(token: str) -> str:
+    """Cache key for a token; raw JWTs are never stored."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def get_token_expiry(token: str) -> typing.Optional[float]:
+    """
+    Read the `exp` claim (unix seconds) from a JWT without verifying the signature.
+    Only ever used to bound the lifetime of tokens Appwrite has already accepted.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+
+class LocalTokenCache:
+    """Small LRU of verified users keyed by token hash, with a hard expiry per entry."""
+
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple[float, User]]" = OrderedDict()
+
+    def get(self, key: str) -> typing.Optional[User]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return user
+
+    def set(self, key: str, user: User, expires_at: float) -> None:
+        self._entries[key] = (expires_at, user)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def evict_user(self, user_id: str) -> None:
+        user_id = user_id.lower()
+        for key in [k for k, (_, u) in self._entries.items() if u.id.lower() == user_id]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+local_token_cache = LocalTokenCache(TOKEN_CACHE_MAX_ENTRIES)
+
+
+async def get_cached_user(token: str) -> typing.Optional[User]:
+    """Look a token up in the local tier, then Redis. Returns None on any miss."""
+    key = hash_token(token)
+    user = local_token_cache.get(key)
+    if user is not None:
+        return user
+
+    redis_conn = redis_cache.redis_pool
+    if redis_conn is None:
+        return None
+    try:
+        raw = await redis_conn.get(f"{TOKEN_CACHE_PREFIX}{key}")
+        if raw is None:
+            return None
+        user = User.with_data(json.loads(raw))
+    except Exception:
+        logger.exception("Failed to read verified token from Redis")
+        return None
+
+    expiry = get_token_expiry(token)
+    if expiry is not None:
+        local_token_cache.set(
+            key, user, min(expiry, time.time() + TOKEN_CACHE_LOCAL_TTL_SECONDS)
+        )
+    return user
+
+
+async def cache_user(token: str, user: User) -> None:
+    """Remember that Appwrite accepted `token` for `user`, never past the token's expiry."""
+    expiry = get_token_expiry(token)
+    if expiry is None:
+        # can't prove when it stops being valid, so don't trust it beyond this request
+        return
+
+    now = time.time()
+    ttl = int(min(expiry - now, TOKEN_CACHE_TTL_SECONDS))
+    if ttl <= 0:
+        return
+
+    key = hash_token(token)
+    local_token_cache.set(
+        key, user, min(expiry, now + TOKEN_CACHE_LOCAL_TTL_SECONDS)
+    )
+
+    redis_conn = redis_cache.redis_pool
+    if redis_conn is None:
+        return
+    try:
+        index_key = f"{USER_TOKENS_PREFIX}{user.id.lower()}"
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.set(f"{TOKEN_CACHE_PREFIX}{key}", user.to_json(), ex=ttl)
+            # per-user index so the delete webhook can find every cached token
+            pipe.sadd(index_key, key)
+            pipe.expire(index_key, TOKEN_CACHE_TTL_SECONDS)
+            await pipe.execute()
+    except Exception:
+        logger.exception("Failed to write verified token to Redis")
+
+
+async def evict_user_tokens(user_id: str) -> None:
+    """Drop every cached token for a user, e.g. when their account is deleted."""
+    local_token_cache.evict_user(user_id)
+
+    redis_conn = redis_cache.redis_pool
+    if redis_conn is None:
+        return
+    try:
+        index_key = f"{USER_TOKENS_PREFIX}{user_id.lower()}"
+        keys = await redis_conn.smembers(index_key)
+        await redis_conn.delete(
+            index_key, *[f"{TOKEN_CACHE_PREFIX}{key}" for key in keys]
+        )
+    except Exception:
+        logger.exception(f"Failed to evict cached tokens for user {user_id}")
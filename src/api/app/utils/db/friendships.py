@@ -0,0 +1,83 @@
+"""
+Accepted friendships live in the `friendships` table as one ordered pair per
+friendship (user_a < user_b), maintained from `friend_requests` by a trigger
+(see init_db). Every friendship check and listing should go through here so
+they hit its indexes instead of OR-scanning friend_requests.
+"""
+
+import asyncpg
+
+# primary key lookup on (user_a, user_b)
+FRIENDSHIP_CHECK_QUERY = """
+    SELECT 1 FROM friendships
+    WHERE user_a = LEAST($1::text, $2::text)
+    AND user_b = GREATEST($1::text, $2::text)
+"""
+
+# index-only scans on the primary key and friendships_user_b_idx (both cover request_id too)
+FRIEND_IDS_QUERY = """
+    SELECT user_b AS friend_id FROM friendships WHERE user_a = $1
+    UNION ALL
+    SELECT user_a AS friend_id FROM friendships WHERE user_b = $1
+"""
+
+# the accepted friend_requests rows behind a user's friendships, for responses that expose them.
+# $2/$3 are an optional (updated_at, id) keyset cursor and $4 an optional page size.
+FRIEND_REQUEST_ROWS_QUERY = """
+    SELECT fr.id, fr.sender_id, fr.receiver_id, fr.status, fr.updated_at
+    FROM friend_requests fr
+    JOIN (
+        SELECT request_id FROM friendships WHERE user_a = $1
+        UNION ALL
+        SELECT request_id FROM friendships WHERE user_b = $1
+    ) f ON fr.id = f.request_id
+    WHERE $2::timestamptz IS NULL OR (fr.updated_at, fr.id) > ($2::timestamptz, $3::integer)
+    ORDER BY fr.updated_at ASC, fr.id ASC
+    LIMIT $4
+"""
+
+# row count and newest updated_at over the same rows, for ETags
+FRIEND_REQUEST_ROWS_VERSION_QUERY = """
+    SELECT count(*) AS row_count, max(fr.updated_at) AS newest_updated_at
+    FROM friend_requests fr
+    JOIN (
+        SELECT request_id FROM friendships WHERE user_a = $1
+        UNION ALL
+        SELECT request_id FROM friendships WHERE user_b = $1
+    ) f ON fr.id = f.request_id
+"""
+
+# requested IDs (other than the requester) with no friendship row, via one PK probe each
+NON_FRIEND_IDS_QUERY = """
+    SELECT requested.user_id FROM unnest($2::text[]) AS requested(user_id)
+    WHERE requested.user_id <> $1
+    AND NOT EXISTS (
+        SELECT 1 FROM friendships
+        WHERE user_a = LEAST($1::text, requested.user_id)
+        AND user_b = GREATEST($1::text, requested.user_id)
+    )
+"""
+
+
+async def are_friends(conn: asyncpg.Connection, user_id: str, other_id: str) -> bool:
+    return (
+        await conn.fetchval(FRIENDSHIP_CHECK_QUERY, user_id.lower(), other_id.lower())
+        is not None
+    )
+
+
+async def get_friend_ids(conn: asyncpg.Connection, user_id: str) -> list[str]:
+    rows = await conn.fetch(FRIEND_IDS_QUERY, user_id.lower())
+    return [row["friend_id"] for row in rows]
+
+
+async def get_non_friend_ids(
+    conn: asyncpg.Connection, user_id: str, other_ids: list[str]
+) -> list[str]:
+    """Which of `other_ids` the user isn't friends with (their own ID always passes)."""
+    rows = await conn.fetch(
+        NON_FRIEND_IDS_QUERY,
+        user_id.lower(),
+        list({other_id.lower() for other_id in other_ids}),
+    )
+    return [row["user_id"] for row in rows]
@@ -30,6 +30,12 @@ async def init_db(db_pool, logger):
             )
             """)
 
+        # keyset pagination of incoming requests in GET /api/friend-requests
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS friend_requests_receiver_status_idx
+            ON friend_requests (receiver_id, status, updated_at, id)
+            """)
+
         # cache helper
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS profile_pics (
@@ -59,6 +65,117 @@ async def init_db(db_pool, logger):
             UPDATE friend_requests
             SET sender_id = LOWER(sender_id),
                 receiver_id = LOWER(receiver_id)
+            WHERE sender_id <> LOWER(sender_id)
+                OR receiver_id <> LOWER(receiver_id)
+            """)
+
+        # Canonical accepted friendships: each pair stored once, ordered, so checks are a primary key lookup
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS friendships (
+                user_a TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                user_b TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                request_id INTEGER NOT NULL REFERENCES friend_requests(id) ON DELETE CASCADE,
+                created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_a, user_b) INCLUDE (request_id),
+                CHECK (user_a < user_b)
+            )
+            """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS friendships_user_b_idx
+            ON friendships (user_b, user_a) INCLUDE (request_id)
+            """)
+        # used by the sync trigger and the cascade from friend_requests
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS friendships_request_id_idx
+            ON friendships (request_id)
+            """)
+
+        # friend_requests stays the source of truth; this trigger mirrors accepted rows into friendships
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION sync_friendships() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'accepted' THEN
+                    DELETE FROM friendships WHERE request_id = OLD.id;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'accepted'
+                    AND NEW.sender_id <> NEW.receiver_id THEN
+                    INSERT INTO friendships (user_a, user_b, request_id)
+                    VALUES (
+                        LEAST(NEW.sender_id, NEW.receiver_id),
+                        GREATEST(NEW.sender_id, NEW.receiver_id),
+                        NEW.id
+                    )
+                    ON CONFLICT (user_a, user_b) DO UPDATE SET request_id = EXCLUDED.request_id;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """)
+        await conn.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger WHERE tgname = 'friend_requests_sync_friendships'
+                ) THEN
+                    CREATE TRIGGER friend_requests_sync_friendships
+                    AFTER INSERT OR UPDATE OR DELETE ON friend_requests
+                    FOR EACH ROW EXECUTE FUNCTION sync_friendships();
+                    -- backfill anything accepted before the trigger existed, once
+                    INSERT INTO friendships (user_a, user_b, request_id, created_at)
+                    SELECT LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id),
+                        id, updated_at
+                    FROM friend_requests
+                    WHERE status = 'accepted' AND sender_id <> receiver_id
+                    ON CONFLICT (user_a, user_b) DO NOTHING;
+                END IF;
+            END
+            $$
+            """)
+
+        # Keeps each worker's in-memory friend graph (app/utils/friend_graph.py) up to date
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION notify_friend_graph() RETURNS trigger AS $$
+            DECLARE
+                op TEXT;
+                user_a TEXT;
+                user_b TEXT;
+            BEGIN
+                IF TG_TABLE_NAME = 'friendships' THEN
+                    op := CASE WHEN TG_OP = 'INSERT' THEN 'friend' ELSE 'unfriend' END;
+                    user_a := COALESCE(NEW.user_a, OLD.user_a);
+                    user_b := COALESCE(NEW.user_b, OLD.user_b);
+                ELSE
+                    op := CASE WHEN TG_OP = 'INSERT' THEN 'block' ELSE 'unblock' END;
+                    user_a := COALESCE(NEW.blocker_id, OLD.blocker_id);
+                    user_b := COALESCE(NEW.blocked_id, OLD.blocked_id);
+                END IF;
+                PERFORM pg_notify(
+                    'friend_graph',
+                    json_build_object('op', op, 'a', user_a, 'b', user_b)::text
+                );
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """)
+        await conn.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger WHERE tgname = 'friendships_notify_friend_graph'
+                ) THEN
+                    CREATE TRIGGER friendships_notify_friend_graph
+                    AFTER INSERT OR DELETE ON friendships
+                    FOR EACH ROW EXECUTE FUNCTION notify_friend_graph();
+                END IF;
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger WHERE tgname = 'blocked_users_notify_friend_graph'
+                ) THEN
+                    CREATE TRIGGER blocked_users_notify_friend_graph
+                    AFTER INSERT OR DELETE ON blocked_users
+                    FOR EACH ROW EXECUTE FUNCTION notify_friend_graph();
+                END IF;
+            END
+            $$
             """)
 
         # set up the timetables
@@ -73,6 +190,140 @@ async def init_db(db_pool, logger):
             )
             """)
 
+        # Content hash of each timetable, used as its version for ETags and batch_get's known_versions.
+        # Set by trigger so every writer (sync engine, sync_timetable_for) keeps it current
+        await conn.execute("""
+            ALTER TABLE timetables ADD COLUMN IF NOT EXISTS content_hash TEXT
+            """)
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION set_timetable_content_hash() RETURNS trigger AS $$
+            BEGIN
+                NEW.content_hash := md5(NEW.timetable::text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+            """)
+        await conn.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger WHERE tgname = 'timetables_set_content_hash'
+                ) THEN
+                    CREATE TRIGGER timetables_set_content_hash
+                    BEFORE INSERT OR UPDATE OF timetable ON timetables
+                    FOR EACH ROW EXECUTE FUNCTION set_timetable_content_hash();
+                END IF;
+            END
+            $$
+            """)
+        await conn.execute("""
+            UPDATE timetables SET content_hash = md5(timetable::text)
+            WHERE content_hash IS NULL
+            """)
+
+        # One row per timetable event so a date window is an index range scan rather than a
+        # full-document decode. Event times are stored as London wall clock, like the JSON
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS timetable_events (
+                user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                uid TEXT NOT NULL,
+                dtstart TIMESTAMPTZ NOT NULL,
+                dtend TIMESTAMPTZ NOT NULL,
+                event JSONB NOT NULL
+            )
+            """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS timetable_events_user_dtstart_idx
+            ON timetable_events (user_id, dtstart)
+            """)
+        # events are matched between syncs by uid
+        await conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS timetable_events_user_uid_idx
+            ON timetable_events (user_id, uid)
+            """)
+
+        # timetables stays the source of truth; this trigger applies each write to a user's events
+        # as a diff by uid, so only inserted, changed and removed events touch the table
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION timetable_event_time(dt TEXT) RETURNS TIMESTAMPTZ AS $$
+                SELECT to_timestamp(dt, 'YYYYMMDD"T"HH24MISS')::timestamp AT TIME ZONE 'Europe/London'
+            $$ LANGUAGE sql STABLE
+            """)
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION sync_timetable_events() RETURNS trigger AS $$
+            DECLARE
+                changed INTEGER;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    DELETE FROM timetable_events WHERE user_id = OLD.user_id;
+                    GET DIAGNOSTICS changed = ROW_COUNT;
+                ELSE
+                    WITH incoming AS (
+                        SELECT DISTINCT ON (uid) uid, e
+                        FROM (
+                            SELECT COALESCE(e ->> 'uid', md5(e::text)) AS uid, e
+                            FROM jsonb_array_elements(
+                                CASE WHEN jsonb_typeof(NEW.timetable -> 'data') = 'array'
+                                THEN NEW.timetable -> 'data' ELSE '[]'::jsonb END
+                            ) AS e
+                            WHERE e -> 'dtstart' ->> 'dt' ~ '^\\d{8}T\\d{6}$'
+                                AND e -> 'dtend' ->> 'dt' ~ '^\\d{8}T\\d{6}$'
+                        ) AS parsed
+                        ORDER BY uid
+                    ),
+                    removed AS (
+                        DELETE FROM timetable_events t
+                        WHERE t.user_id = NEW.user_id
+                            AND NOT EXISTS (SELECT 1 FROM incoming i WHERE i.uid = t.uid)
+                        RETURNING 1
+                    ),
+                    upserted AS (
+                        INSERT INTO timetable_events (user_id, uid, dtstart, dtend, event)
+                        SELECT
+                            NEW.user_id,
+                            uid,
+                            timetable_event_time(e -> 'dtstart' ->> 'dt'),
+                            timetable_event_time(e -> 'dtend' ->> 'dt'),
+                            e
+                        FROM incoming
+                        ON CONFLICT (user_id, uid) DO UPDATE
+                        SET dtstart = EXCLUDED.dtstart, dtend = EXCLUDED.dtend, event = EXCLUDED.event
+                        WHERE timetable_events.event IS DISTINCT FROM EXCLUDED.event
+                        RETURNING 1
+                    )
+                    SELECT (SELECT count(*) FROM removed) + (SELECT count(*) FROM upserted)
+                    INTO changed;
+                END IF;
+                IF changed > 0 THEN
+                    -- drops the user's entry in each worker's timetable index (app/utils/timetable_index.py)
+                    PERFORM pg_notify('timetable_events', COALESCE(NEW.user_id, OLD.user_id));
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """)
+        await conn.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger WHERE tgname = 'timetables_sync_timetable_events'
+                ) THEN
+                    CREATE TRIGGER timetables_sync_timetable_events
+                    AFTER INSERT OR UPDATE OF timetable OR DELETE ON timetables
+                    FOR EACH ROW EXECUTE FUNCTION sync_timetable_events();
+                    -- backfill timetables written before the trigger existed. Only here, when
+                    -- the trigger is created: a timetable with no usable events never gets rows,
+                    -- so "has no events" can't tell us whether it has been backfilled
+                    UPDATE timetables SET timetable = timetable
+                    WHERE jsonb_array_length(
+                        CASE WHEN jsonb_typeof(timetable -> 'data') = 'array'
+                        THEN timetable -> 'data' ELSE '[]'::jsonb END
+                    ) > 0;
+                END IF;
+            END
+            $$
+            """)
+
         # New in v1.3.0 - timetable association table to link a user id (string) to a timetable url (string)
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS timetable_associations (
@@ -85,6 +336,86 @@ async def init_db(db_pool, logger):
             )
             """)
 
+        # What the sync engine last downloaded for each association, so unchanged calendars
+        # can be skipped with a conditional request or a hash of the raw ICS body
+        await conn.execute("""
+            ALTER TABLE timetable_associations
+                ADD COLUMN IF NOT EXISTS ics_etag TEXT,
+                ADD COLUMN IF NOT EXISTS ics_last_modified TEXT,
+                ADD COLUMN IF NOT EXISTS ics_hash TEXT
+            """)
+
+        # Sync engine workers lease associations in batches so several can run at once;
+        # a lease past its expiry belongs to a dead worker and can be taken over
+        await conn.execute("""
+            ALTER TABLE timetable_associations
+                ADD COLUMN IF NOT EXISTS lease_owner TEXT,
+                ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ
+            """)
+
+        # How each association's syncs have been going (see app/utils/db/sync_state.py).
+        # The sync engine skips users until next_eligible_at, and for good once dead-lettered
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                user_id TEXT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+                last_success_at TIMESTAMPTZ,
+                last_error TEXT,
+                last_error_at TIMESTAMPTZ,
+                consecutive_failures INTEGER NOT NULL DEFAULT 0,
+                next_eligible_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                dead_lettered_at TIMESTAMPTZ
+            )
+            """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS sync_state_dead_lettered_idx
+            ON sync_state (dead_lettered_at)
+            WHERE dead_lettered_at IS NOT NULL
+            """)
+
+        # One row per sync engine run (per worker), with its counts, failure classes and
+        # timing histograms as written by the engine's RunStats.as_dict()
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_runs (
+                id BIGSERIAL PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                started_at TIMESTAMPTZ NOT NULL,
+                finished_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                summary JSONB NOT NULL
+            )
+            """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS sync_runs_started_at_idx
+            ON sync_runs (started_at DESC)
+            """)
+
+        # On-demand syncs queued by /api/timetable/associate, run by app/utils/sync_jobs.py.
+        # A user has at most one queued job, so repeated requests share it
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                url TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued'
+                    CHECK (status IN ('queued', 'running', 'succeeded', 'failed')),
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMPTZ,
+                finished_at TIMESTAMPTZ
+            )
+            """)
+        await conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS sync_jobs_queued_user_idx
+            ON sync_jobs (user_id)
+            WHERE status = 'queued'
+            """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS sync_jobs_pending_idx
+            ON sync_jobs (next_attempt_at, id)
+            WHERE status IN ('queued', 'running')
+            """)
+
         # Bus subscriptions
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS bus (
@@ -102,6 +433,29 @@ async def init_db(db_pool, logger):
             )
             """)
 
+        # Push notifications written in the same transaction as the change they announce,
+        # sent by the dispatcher in app/utils/notification_outbox.py
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                user_ids TEXT[] NOT NULL,
+                title TEXT NOT NULL,
+                message TEXT NOT NULL,
+                ttl INTEGER NOT NULL,
+                small_icon TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                sent_at TIMESTAMPTZ,
+                created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS notification_outbox_pending_idx
+            ON notification_outbox (next_attempt_at, id)
+            WHERE sent_at IS NULL
+            """)
+
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS wifi_speed_test_results (
                 id SERIAL PRIMARY KEY,
@@ -23,6 +23,18 @@ async def connect_db_internal():
         raise
 
 
+async def connect_listener() -> asyncpg.Connection:
+    """
+    A connection of its own for LISTEN. A listener holds its connection for as long as
+    the app runs, so it mustn't take one of the pool's.
+    """
+    return await asyncpg.connect(
+        DATABASE_URL,
+        user="postgres",
+        password=getFromEnv("DATABASE_PWD"),
+    )
+
+
 async def initialise_db_pool():
     global db_pool
     if db_pool is None:
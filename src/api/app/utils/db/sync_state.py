@@ -0,0 +1,58 @@
+"""
+Each association's sync health lives in `sync_state`, written by the sync engine after
+every attempt: when it last worked, the last error, and how many times in a row it has
+failed. The engine backs off from failing calendars and stops trying ("dead-letters")
+after enough failures in a row; a new association or a successful on-demand sync
+starts the user afresh. Each run of the engine also leaves a summary in `sync_runs`.
+"""
+
+import json
+
+import asyncpg
+
+RECORD_SYNC_SUCCESS_QUERY = """
+    INSERT INTO sync_state (user_id, last_success_at)
+    VALUES ($1, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET
+        last_success_at = EXCLUDED.last_success_at,
+        consecutive_failures = 0,
+        next_eligible_at = CURRENT_TIMESTAMP,
+        dead_lettered_at = NULL
+"""
+
+DEAD_LETTERS_QUERY = """
+    SELECT s.user_id, a.url, s.consecutive_failures, s.last_error, s.last_error_at,
+        s.last_success_at, s.dead_lettered_at
+    FROM sync_state s
+    JOIN timetable_associations a ON a.user_id = s.user_id
+    WHERE s.dead_lettered_at IS NOT NULL
+    ORDER BY s.dead_lettered_at DESC
+    LIMIT $1
+"""
+
+RECENT_SYNC_RUNS_QUERY = """
+    SELECT id, worker_id, started_at, finished_at, summary::text AS summary
+    FROM sync_runs
+    ORDER BY started_at DESC
+    LIMIT $1
+"""
+
+
+async def record_sync_success(conn: asyncpg.Connection, user_id: str):
+    await conn.execute(RECORD_SYNC_SUCCESS_QUERY, user_id)
+
+
+async def reset_sync_state(conn: asyncpg.Connection, user_id: str):
+    await conn.execute("DELETE FROM sync_state WHERE user_id = $1", user_id)
+
+
+async def dead_letters(conn: asyncpg.Connection, limit: int) -> list[asyncpg.Record]:
+    """Associations the sync engine has given up on, most recent first."""
+    return await conn.fetch(DEAD_LETTERS_QUERY, limit)
+
+
+async def recent_sync_runs(conn: asyncpg.Connection, limit: int) -> list[dict]:
+    return [
+        {**dict(row), "summary": json.loads(row["summary"])}
+        for row in await conn.fetch(RECENT_SYNC_RUNS_QUERY, limit)
+    ]
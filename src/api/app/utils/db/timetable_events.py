@@ -0,0 +1,71 @@
+"""
+Timetable events live one per row in `timetable_events`, rebuilt from
+`timetables` by a trigger whenever a timetable is written (see init_db). Queries
+for part of a timetable should go through here so they are range scans on
+(user_id, dtstart) instead of decoding the whole year's JSON.
+"""
+
+import datetime
+import typing
+
+import asyncpg
+import pytz
+
+LONDON = pytz.timezone("Europe/London")
+
+# events starting in [$2, $3) as a JSON array, or NULL if the user has no timetable at all
+EVENTS_IN_WINDOW_QUERY = """
+    SELECT (
+        SELECT coalesce(jsonb_agg(event ORDER BY dtstart), '[]'::jsonb)::text
+        FROM timetable_events
+        WHERE user_id = $1
+        AND dtstart >= coalesce($2::timestamptz, '-infinity')
+        AND dtstart < coalesce($3::timestamptz, 'infinity')
+    ) AS data
+    FROM timetables WHERE user_id = $1
+"""
+
+# busy time overlapping [$2, $3) for several users as epoch seconds; lessons never run
+# past a day, so the lower bound on dtstart keeps this a range scan on the index
+BUSY_INTERVALS_QUERY = """
+    SELECT extract(epoch FROM dtstart)::float8 AS dtstart,
+        extract(epoch FROM dtend)::float8 AS dtend
+    FROM timetable_events
+    WHERE user_id = ANY($1::text[])
+    AND dtstart >= $2::timestamptz - interval '1 day'
+    AND dtstart < $3::timestamptz
+    AND dtend > $2::timestamptz
+"""
+
+
+def as_london_time(
+    moment: typing.Optional[datetime.datetime],
+) -> typing.Optional[datetime.datetime]:
+    """Times without an offset are London wall clock, like the timetables themselves."""
+    if moment is None or moment.tzinfo is not None:
+        return moment
+    return LONDON.localize(moment)
+
+
+async def events_in_window(
+    conn: asyncpg.Connection,
+    user_id: str,
+    start: typing.Optional[datetime.datetime],
+    end: typing.Optional[datetime.datetime],
+) -> typing.Optional[str]:
+    """JSON text of the user's events starting in [start, end); either bound may be open."""
+    return await conn.fetchval(
+        EVENTS_IN_WINDOW_QUERY,
+        user_id,
+        as_london_time(start),
+        as_london_time(end),
+    )
+
+
+async def busy_intervals(
+    conn: asyncpg.Connection,
+    user_ids: list[str],
+    start: datetime.datetime,
+    end: datetime.datetime,
+) -> list[asyncpg.Record]:
+    return await conn.fetch(BUSY_INTERVALS_QUERY, user_ids, start, end)
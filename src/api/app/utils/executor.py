@@ -0,0 +1,166 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from fastapi import HTTPException
+
+from app.utils.logging import Logger
+
+logger = Logger("executor")
+
+UPSTREAM_EXECUTOR_WORKERS = int(os.getenv("UPSTREAM_EXECUTOR_WORKERS", 8))
+UPSTREAM_EXECUTOR_MAX_QUEUE = int(os.getenv("UPSTREAM_EXECUTOR_MAX_QUEUE", 32))
+UPSTREAM_EXECUTOR_RETRY_AFTER_SECONDS = int(
+    os.getenv("UPSTREAM_EXECUTOR_RETRY_AFTER_SECONDS", 2)
+)
+ICS_PARSE_PROCESSES = int(os.getenv("ICS_PARSE_PROCESSES", 2))
+
+
+class ExecutorSaturated(HTTPException):
+    """Raised instead of queueing work on a full executor; FastAPI turns it into a 503."""
+
+    def __init__(self, name: str, retry_after: int) -> None:
+        super().__init__(
+            status_code=503,
+            detail=f"Service busy ({name}); please try again shortly.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class BoundedExecutor:
+    """
+    A named thread pool for blocking calls to upstream services, kept apart from
+    the default executor so a slow upstream can't starve unrelated thread work.
+    At most `max_workers` calls run at once and `max_queue` more may wait;
+    anything beyond that fails fast with ExecutorSaturated.
+    """
+
+    def __init__(
+        self, name: str, max_workers: int, max_queue: int, retry_after: int
+    ) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = 0
+        self._rejected = 0
+        self._completed = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def _run_and_track(self, submitted_at: float, func, *args, **kwargs):
+        wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self._queued -= 1
+            self._in_flight += 1
+            self._total_wait_seconds += wait
+            self._max_wait_seconds = max(self._max_wait_seconds, wait)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            if self._in_flight + self._queued >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                saturated = True
+            else:
+                self._queued += 1
+                saturated = False
+        if saturated:
+            logger.warning(f"Executor {self.name} saturated; rejecting call")
+            raise ExecutorSaturated(self.name, self.retry_after)
+
+        future = self._executor.submit(
+            functools.partial(
+                self._run_and_track, time.perf_counter(), func, *args, **kwargs
+            )
+        )
+        future.add_done_callback(self._untrack_if_cancelled)
+        return await asyncio.wrap_future(future)
+
+    def _untrack_if_cancelled(self, future) -> None:
+        # a call cancelled while still waiting never reaches _run_and_track
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            started = self._completed + self._in_flight
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "mean_wait_ms": (
+                    round(self._total_wait_seconds / started * 1000, 3)
+                    if started
+                    else 0.0
+                ),
+                "max_wait_ms": round(self._max_wait_seconds * 1000, 3),
+            }
+
+
+upstream_executor = BoundedExecutor(
+    "upstream",
+    UPSTREAM_EXECUTOR_WORKERS,
+    UPSTREAM_EXECUTOR_MAX_QUEUE,
+    UPSTREAM_EXECUTOR_RETRY_AFTER_SECONDS,
+)
+
+
+class ParseExecutor:
+    """
+    A pool of worker processes for CPU-bound parsing, so a large calendar doesn't hold
+    the event loop (and every other request on this worker) for the length of the parse.
+    The pool is started on first use; arguments and results are pickled across the
+    process boundary, so callers should pass and return flat bytes/str payloads.
+    """
+
+    def __init__(self, name: str, processes: int) -> None:
+        self.name = name
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # forkserver rather than fork: the API process has threads and open
+                # sockets that a forked child shouldn't inherit
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+                logger.info(f"Started {self.name} pool of {self.processes} processes")
+            return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), func, *args
+        )
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+
+parse_executor = ParseExecutor("parse", ICS_PARSE_PROCESSES)
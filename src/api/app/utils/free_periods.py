@@ -0,0 +1,116 @@
+"""
+Common free periods across several timetables. Everyone is free exactly when nobody
+is busy, so the busy intervals of all users are merged into one sorted union and the
+gaps in it are the answer. Both steps are NumPy array operations over epoch seconds,
+so a term of events for a group of friends is a single sort rather than a Python loop
+per event.
+"""
+
+import datetime
+import typing
+import zoneinfo
+
+import numpy as np
+
+from app.utils.db.timetable_events import LONDON
+
+LONDON_ZONE = zoneinfo.ZoneInfo("Europe/London")
+
+
+def merge_intervals(
+    starts: np.ndarray, ends: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Union of [start, end) intervals as sorted, non-overlapping, non-touching blocks."""
+    if starts.size == 0:
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    # latest end seen so far; a block closes wherever the next start is past it
+    reach = np.maximum.accumulate(ends)
+    breaks = starts[1:] > reach[:-1]
+    block_starts = starts[np.concatenate(([True], breaks))]
+    block_ends = reach[np.concatenate((breaks, [True]))]
+    return block_starts, block_ends
+
+
+def free_intervals(
+    busy_starts: np.ndarray,
+    busy_ends: np.ndarray,
+    window_start: float,
+    window_end: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Gaps in the busy intervals within [window_start, window_end)."""
+    busy_starts = np.clip(busy_starts, window_start, window_end)
+    busy_ends = np.clip(busy_ends, window_start, window_end)
+    keep = busy_ends > busy_starts
+    block_starts, block_ends = merge_intervals(busy_starts[keep], busy_ends[keep])
+    free_starts = np.concatenate(([window_start], block_ends))
+    free_ends = np.concatenate((block_starts, [window_end]))
+    keep = free_ends > free_starts
+    return free_starts[keep], free_ends[keep]
+
+
+def outside_hours(
+    start: datetime.datetime,
+    end: datetime.datetime,
+    day_start: typing.Optional[datetime.time],
+    day_end: typing.Optional[datetime.time],
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The time between one London day's `day_end` and the next day's `day_start` as
+    busy intervals, so free periods can be limited to the college day.
+    """
+    if day_start is None and day_end is None:
+        return np.empty(0), np.empty(0)
+    first = start.astimezone(LONDON).date()
+    days = [
+        first + datetime.timedelta(days=offset)
+        for offset in range((end.astimezone(LONDON).date() - first).days + 1)
+    ]
+    # zoneinfo rather than pytz here: localize() is slow enough to dominate a term's worth of days
+    opens = np.array(
+        [
+            datetime.datetime.combine(day, day_start or datetime.time(), LONDON_ZONE)
+            .timestamp()
+            for day in days
+        ]
+    )
+    closes = np.array(
+        [
+            datetime.datetime.combine(day, day_end, LONDON_ZONE).timestamp()
+            if day_end is not None
+            else datetime.datetime.combine(
+                day + datetime.timedelta(days=1), datetime.time(), LONDON_ZONE
+            ).timestamp()
+            for day in days
+        ]
+    )
+    return (
+        np.concatenate(([-np.inf], closes)),
+        np.concatenate((opens, [np.inf])),
+    )
+
+
+def common_free_periods(
+    busy_starts: np.ndarray,
+    busy_ends: np.ndarray,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    day_start: typing.Optional[datetime.time] = None,
+    day_end: typing.Optional[datetime.time] = None,
+) -> list[dict]:
+    """Free periods shared by everyone whose events are in `busy_*`, as London ISO times."""
+    closed_starts, closed_ends = outside_hours(start, end, day_start, day_end)
+    free_starts, free_ends = free_intervals(
+        np.concatenate((busy_starts, closed_starts)),
+        np.concatenate((busy_ends, closed_ends)),
+        start.timestamp(),
+        end.timestamp(),
+    )
+    return [
+        {
+            "start": datetime.datetime.fromtimestamp(free_start, LONDON).isoformat(),
+            "end": datetime.datetime.fromtimestamp(free_end, LONDON).isoformat(),
+        }
+        for free_start, free_end in zip(free_starts.tolist(), free_ends.tolist())
+    ]
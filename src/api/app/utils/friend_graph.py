@@ -0,0 +1,285 @@
+"""
+In-process friend graph for suggestions and mutual friends, which would otherwise
+need a friends-of-friends self-join on every request.
+
+User IDs are interned to dense integers and each user's friends are kept as a sorted
+array('I'), so 50k users with a few dozen friends each take tens of megabytes.
+The graph is loaded from the friendships and blocked_users tables at startup and
+kept current from Postgres notifications (see the triggers in init_db), so every
+worker process sees changes made by the others.
+"""
+
+import asyncio
+import bisect
+import heapq
+import itertools
+import json
+import os
+import time
+import typing
+from array import array
+from collections import Counter
+
+import asyncpg
+from fastapi import HTTPException
+
+from app.utils.db import pool
+from app.utils.logging import Logger
+
+logger = Logger("friend_graph")
+
+FRIEND_GRAPH_CHANNEL = "friend_graph"
+# full reloads are a safety net for notifications missed while the listener reconnects
+FRIEND_GRAPH_RELOAD_SECONDS = int(os.getenv("FRIEND_GRAPH_RELOAD_SECONDS", 60 * 60))
+FRIEND_GRAPH_HEALTHCHECK_SECONDS = 10
+FRIEND_GRAPH_STARTUP_TIMEOUT_SECONDS = 30
+
+
+class FriendGraph:
+    def __init__(self):
+        self._index: dict[str, int] = {}
+        self._user_ids: list[str] = []
+        self._friends: list[array] = []
+        # blocks are rare, so they're kept sparse and directional
+        self._blocking: dict[int, set[int]] = {}
+        self._blocked_by: dict[int, set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def _intern(self, user_id: str) -> int:
+        node = self._index.get(user_id)
+        if node is None:
+            node = len(self._user_ids)
+            self._index[user_id] = node
+            self._user_ids.append(user_id)
+            self._friends.append(array("I"))
+        return node
+
+    @classmethod
+    def build(
+        cls,
+        friendships: typing.Iterable[tuple[str, str]],
+        blocks: typing.Iterable[tuple[str, str]] = (),
+    ) -> "FriendGraph":
+        """Bulk load; sorts each adjacency array once instead of inserting in order."""
+        graph = cls()
+        edges = [(graph._intern(a), graph._intern(b)) for a, b in friendships]
+        adjacency: list[list[int]] = [[] for _ in graph._user_ids]
+        for a, b in edges:
+            if a != b:
+                adjacency[a].append(b)
+                adjacency[b].append(a)
+        graph._friends = [array("I", sorted(set(friends))) for friends in adjacency]
+        for blocker, blocked in blocks:
+            graph.add_block(blocker, blocked)
+        return graph
+
+    def add_friendship(self, user_a: str, user_b: str):
+        a, b = self._intern(user_a), self._intern(user_b)
+        if a == b:
+            return
+        for node, other in ((a, b), (b, a)):
+            friends = self._friends[node]
+            i = bisect.bisect_left(friends, other)
+            if i == len(friends) or friends[i] != other:
+                friends.insert(i, other)
+
+    def remove_friendship(self, user_a: str, user_b: str):
+        a, b = self._index.get(user_a), self._index.get(user_b)
+        if a is None or b is None:
+            return
+        for node, other in ((a, b), (b, a)):
+            friends = self._friends[node]
+            i = bisect.bisect_left(friends, other)
+            if i < len(friends) and friends[i] == other:
+                del friends[i]
+
+    def add_block(self, blocker: str, blocked: str):
+        a, b = self._intern(blocker), self._intern(blocked)
+        self._blocking.setdefault(a, set()).add(b)
+        self._blocked_by.setdefault(b, set()).add(a)
+
+    def remove_block(self, blocker: str, blocked: str):
+        a, b = self._index.get(blocker), self._index.get(blocked)
+        if a is None or b is None:
+            return
+        self._blocking.get(a, set()).discard(b)
+        self._blocked_by.get(b, set()).discard(a)
+
+    def _hidden(self, node: int) -> set[int]:
+        return self._blocking.get(node, set()) | self._blocked_by.get(node, set())
+
+    def is_blocked(self, user_a: str, user_b: str) -> bool:
+        a, b = self._index.get(user_a), self._index.get(user_b)
+        if a is None or b is None:
+            return False
+        return b in self._hidden(a)
+
+    def friend_ids(self, user_id: str) -> list[str]:
+        node = self._index.get(user_id)
+        if node is None:
+            return []
+        return [self._user_ids[friend] for friend in self._friends[node]]
+
+    def mutual_friends(self, user_a: str, user_b: str) -> list[str]:
+        a, b = self._index.get(user_a), self._index.get(user_b)
+        if a is None or b is None:
+            return []
+        smaller, larger = sorted((self._friends[a], self._friends[b]), key=len)
+        common = set(smaller).intersection(larger)
+        return sorted(self._user_ids[node] for node in common)
+
+    def suggestions(
+        self,
+        user_id: str,
+        limit: int = 20,
+        exclude: typing.Iterable[str] = (),
+    ) -> list[tuple[str, int]]:
+        """
+        Friends of friends ranked by mutual-friend count, skipping existing friends,
+        blocked users in either direction and anything in `exclude`.
+        """
+        node = self._index.get(user_id)
+        if node is None:
+            return []
+        friends = self._friends[node]
+        counts = Counter(
+            itertools.chain.from_iterable(self._friends[friend] for friend in friends)
+        )
+        for skip in itertools.chain((node,), friends, self._hidden(node)):
+            counts.pop(skip, None)
+        for skip_id in exclude:
+            skip = self._index.get(skip_id)
+            if skip is not None:
+                counts.pop(skip, None)
+        # ties go to the lowest node ID so results are stable between calls
+        best = heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+        return [(self._user_ids[candidate], mutuals) for candidate, mutuals in best]
+
+
+friend_graph: typing.Optional[FriendGraph] = None
+_graph_task: typing.Optional[asyncio.Task] = None
+_graph_loaded: typing.Optional[asyncio.Event] = None
+# notifications that arrive during a (re)load are replayed on top of the new snapshot
+_pending_changes: typing.Optional[list[dict]] = None
+
+
+def _apply_change(graph: FriendGraph, change: dict):
+    op, user_a, user_b = change["op"], change["a"], change["b"]
+    if op == "friend":
+        graph.add_friendship(user_a, user_b)
+    elif op == "unfriend":
+        graph.remove_friendship(user_a, user_b)
+    elif op == "block":
+        graph.add_block(user_a, user_b)
+    elif op == "unblock":
+        graph.remove_block(user_a, user_b)
+
+
+def record_change(op: str, user_a: str, user_b: str):
+    """
+    Apply a change this process just committed without waiting for its notification,
+    so the requester sees it straight away. Applying it twice is harmless.
+    """
+    if friend_graph is not None:
+        _apply_change(friend_graph, {"op": op, "a": user_a, "b": user_b})
+
+
+def _on_notification(connection, pid, channel, payload):
+    try:
+        change = json.loads(payload)
+    except ValueError:
+        logger.warning(f"Ignoring malformed friend graph notification: {payload}")
+        return
+    if _pending_changes is not None:
+        _pending_changes.append(change)
+    if friend_graph is not None:
+        _apply_change(friend_graph, change)
+
+
+async def load_friend_graph(conn: asyncpg.Connection) -> FriendGraph:
+    global friend_graph, _pending_changes
+    start = time.perf_counter()
+    _pending_changes = []
+    try:
+        friendships = await conn.fetch("SELECT user_a, user_b FROM friendships")
+        blocks = await conn.fetch("SELECT blocker_id, blocked_id FROM blocked_users")
+        graph = FriendGraph.build(
+            ((row["user_a"], row["user_b"]) for row in friendships),
+            ((row["blocker_id"], row["blocked_id"]) for row in blocks),
+        )
+        for change in _pending_changes:
+            _apply_change(graph, change)
+        friend_graph = graph
+        if _graph_loaded is not None:
+            _graph_loaded.set()
+    finally:
+        _pending_changes = None
+    logger.info(
+        f"Friend graph loaded: {len(graph)} users, {len(friendships)} friendships "
+        f"in {(time.perf_counter() - start) * 1000:.0f}ms"
+    )
+    return graph
+
+
+async def _run_friend_graph():
+    while True:
+        try:
+            conn = await pool.connect_listener()
+            try:
+                # listen first so nothing committed during the load is lost
+                await conn.add_listener(FRIEND_GRAPH_CHANNEL, _on_notification)
+                await load_friend_graph(conn)
+                last_loaded = time.monotonic()
+                while not conn.is_closed():
+                    await asyncio.sleep(FRIEND_GRAPH_HEALTHCHECK_SECONDS)
+                    if time.monotonic() - last_loaded > FRIEND_GRAPH_RELOAD_SECONDS:
+                        await load_friend_graph(conn)
+                        last_loaded = time.monotonic()
+            finally:
+                await conn.close()
+            logger.warning("Friend graph listener connection closed, reconnecting...")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Friend graph listener failed, retrying...")
+            await asyncio.sleep(FRIEND_GRAPH_HEALTHCHECK_SECONDS)
+
+
+async def start_friend_graph():
+    global _graph_task, _graph_loaded
+    if _graph_task is None:
+        logger.info("Starting friend graph...")
+        _graph_loaded = asyncio.Event()
+        _graph_task = asyncio.create_task(_run_friend_graph())
+        try:
+            await asyncio.wait_for(_graph_loaded.wait(), FRIEND_GRAPH_STARTUP_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            # keep starting up; suggestions return 503 until the load finishes
+            logger.warning("Friend graph is still loading, continuing startup.")
+    else:
+        logger.info("Friend graph already running.")
+
+
+async def stop_friend_graph():
+    global _graph_task, _graph_loaded, friend_graph
+    if _graph_task:
+        logger.info("Stopping friend graph...")
+        _graph_task.cancel()
+        try:
+            await _graph_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            _graph_task = None
+            _graph_loaded = None
+            friend_graph = None
+        logger.info("Friend graph stopped.")
+
+
+async def get_friend_graph() -> FriendGraph:
+    if friend_graph is None:
+        logger.error("Friend graph is not loaded.")
+        raise HTTPException(status_code=503, detail="Friend suggestions unavailable")
+    return friend_graph
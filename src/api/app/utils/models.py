@@ -1,3 +1,4 @@
+import datetime
 import typing
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -12,6 +13,17 @@ class Timetable(BaseModel):
 
 class BatchGetBody(BaseModel):
     user_ids: typing.List[str]
+    # user_id -> version the client already has; those timetables come back as "unchanged"
+    known_versions: typing.Optional[typing.Dict[str, str]] = None
+
+
+class CommonFreeBody(BaseModel):
+    user_ids: typing.List[str]
+    start: datetime.datetime
+    end: datetime.datetime
+    # optionally only count time within each day's college hours, e.g. 09:00-16:00
+    day_start: typing.Optional[datetime.time] = None
+    day_end: typing.Optional[datetime.time] = None
 
 
 class ExtraBusRequestBody(BaseModel):
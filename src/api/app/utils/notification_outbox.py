@@ -0,0 +1,243 @@
+import asyncio
+import os
+import time
+import typing
+
+import asyncpg
+
+from app.utils.db import pool
+from app.utils.logging import Logger
+from app.utils.notifications import sendNotification
+
+logger = Logger("notification_outbox")
+
+NOTIFICATION_DISPATCH_INTERVAL_SECONDS = float(
+    os.getenv("NOTIFICATION_DISPATCH_INTERVAL_SECONDS", 2)
+)
+NOTIFICATION_DISPATCH_BATCH_SIZE = int(os.getenv("NOTIFICATION_DISPATCH_BATCH_SIZE", 100))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_MAX_ATTEMPTS", 8))
+NOTIFICATION_RETRY_BASE_SECONDS = 5
+NOTIFICATION_RETRY_MAX_SECONDS = 60 * 60
+# sent and given-up rows are kept for a while for debugging, then pruned
+NOTIFICATION_RETENTION = "7 days"
+NOTIFICATION_PRUNE_INTERVAL_SECONDS = 60 * 60
+
+# OneSignal accepts up to 2000 external IDs per notification
+ONESIGNAL_MAX_RECIPIENTS = 2000
+
+_dispatcher_task: typing.Optional[asyncio.Task] = None
+
+
+async def enqueue_notification(
+    conn: asyncpg.Connection,
+    message: str,
+    userIds: list,
+    title: str = "Notification",
+    ttl: int = 60 * 10,
+    small_icon: str = "ic_stat_onesignal_default",
+):
+    """
+    Queue a push notification. Call this inside the same transaction as the change
+    it announces: it is only sent if that change commits, and the request never waits
+    on OneSignal. Arguments mirror sendNotification.
+    """
+    # one row per OneSignal call at most, so a row is only ever sent (or retried) whole
+    await conn.executemany(
+        """
+        INSERT INTO notification_outbox (user_ids, title, message, ttl, small_icon)
+        VALUES ($1, $2, $3, $4, $5)
+        """,
+        [
+            (
+                userIds[start : start + ONESIGNAL_MAX_RECIPIENTS],
+                title,
+                message,
+                ttl,
+                small_icon,
+            )
+            for start in range(0, len(userIds), ONESIGNAL_MAX_RECIPIENTS)
+        ],
+    )
+
+
+def _retry_delay_seconds(attempts: int) -> int:
+    return min(
+        NOTIFICATION_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0),
+        NOTIFICATION_RETRY_MAX_SECONDS,
+    )
+
+
+async def _claim_batch(conn: asyncpg.Connection) -> list:
+    # SKIP LOCKED lets every uvicorn worker run a dispatcher without sending twice.
+    # Claimed rows are pushed into the future, so if this worker dies they're retried later.
+    return await conn.fetch(
+        """
+        UPDATE notification_outbox
+        SET attempts = attempts + 1,
+            next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2)
+        WHERE id IN (
+            SELECT id FROM notification_outbox
+            WHERE sent_at IS NULL
+            AND attempts < $3
+            AND next_attempt_at <= CURRENT_TIMESTAMP
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_ids, title, message, ttl, small_icon, attempts
+        """,
+        NOTIFICATION_DISPATCH_BATCH_SIZE,
+        NOTIFICATION_RETRY_MAX_SECONDS,
+        NOTIFICATION_MAX_ATTEMPTS,
+    )
+
+
+def _chunk_rows(rows: list) -> list[list]:
+    """
+    Pack rows with the same content into as few OneSignal calls as fit the recipient
+    limit. Each row lands in exactly one call, so a failed call only retries its own rows.
+    """
+    chunks, chunk, recipients = [], [], set()
+    for row in rows:
+        if chunk and len(recipients | set(row["user_ids"])) > ONESIGNAL_MAX_RECIPIENTS:
+            chunks.append(chunk)
+            chunk, recipients = [], set()
+        chunk.append(row)
+        recipients.update(row["user_ids"])
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def _send_chunk(rows: list) -> typing.Optional[str]:
+    """Send rows that share the same content as one notification; returns an error or None."""
+    first = rows[0]
+    try:
+        await sendNotification(
+            message=first["message"],
+            userIds=list(dict.fromkeys(u for row in rows for u in row["user_ids"])),
+            title=first["title"],
+            ttl=first["ttl"],
+            small_icon=first["small_icon"],
+        )
+        return None
+    except Exception as e:
+        return repr(e)
+
+
+async def _record_results(sent_ids: list, failed: list):
+    async with pool.db_pool.acquire() as conn:
+        if sent_ids:
+            await conn.execute(
+                """
+                UPDATE notification_outbox
+                SET sent_at = CURRENT_TIMESTAMP, last_error = NULL
+                WHERE id = ANY($1::bigint[])
+                """,
+                sent_ids,
+            )
+        if failed:
+            await conn.executemany(
+                """
+                UPDATE notification_outbox
+                SET last_error = $3,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2)
+                WHERE id = $1
+                """,
+                [
+                    (row_id, _retry_delay_seconds(attempts), error)
+                    for row_id, attempts, error in failed
+                ],
+            )
+
+
+async def dispatch_pending_notifications() -> int:
+    """Send one batch of due notifications. Returns how many rows were claimed."""
+    if pool.db_pool is None:
+        return 0
+
+    # the claim keeps these rows from other dispatchers, so the connection can go back
+    # to the pool while OneSignal is called; a slow OneSignal mustn't starve requests
+    async with pool.db_pool.acquire() as conn:
+        rows = await _claim_batch(conn)
+    if not rows:
+        return 0
+
+    # e.g. several "new friend request" pushes become one OneSignal call
+    groups: dict[tuple, list] = {}
+    for row in rows:
+        key = (row["title"], row["message"], row["ttl"], row["small_icon"])
+        groups.setdefault(key, []).append(row)
+    chunks = [chunk for group in groups.values() for chunk in _chunk_rows(group)]
+
+    results = await asyncio.gather(*(_send_chunk(chunk) for chunk in chunks))
+
+    sent_ids, failed = [], []
+    for chunk, error in zip(chunks, results):
+        if error is None:
+            sent_ids.extend(row["id"] for row in chunk)
+        else:
+            logger.warning(f"Failed to send {len(chunk)} notification(s): {error}")
+            failed.extend((row["id"], row["attempts"], error) for row in chunk)
+
+    await _record_results(sent_ids, failed)
+    return len(rows)
+
+
+async def _prune_notifications():
+    # rows that used up their attempts are kept as long as sent ones, then go too
+    async with pool.db_pool.acquire() as conn:
+        await conn.execute(
+            f"""
+            DELETE FROM notification_outbox
+            WHERE sent_at < CURRENT_TIMESTAMP - INTERVAL '{NOTIFICATION_RETENTION}'
+            OR (
+                sent_at IS NULL
+                AND attempts >= $1
+                AND created_at < CURRENT_TIMESTAMP - INTERVAL '{NOTIFICATION_RETENTION}'
+            )
+            """,
+            NOTIFICATION_MAX_ATTEMPTS,
+        )
+
+
+async def _run_dispatcher():
+    last_pruned = 0.0
+    while True:
+        try:
+            claimed = await dispatch_pending_notifications()
+            if time.monotonic() - last_pruned > NOTIFICATION_PRUNE_INTERVAL_SECONDS:
+                await _prune_notifications()
+                last_pruned = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Notification dispatcher iteration failed")
+            claimed = 0
+
+        # a full batch means there's probably more waiting, so go again straight away
+        if claimed < NOTIFICATION_DISPATCH_BATCH_SIZE:
+            await asyncio.sleep(NOTIFICATION_DISPATCH_INTERVAL_SECONDS)
+
+
+async def start_notification_dispatcher():
+    global _dispatcher_task
+    if _dispatcher_task is None:
+        logger.info("Starting notification dispatcher...")
+        _dispatcher_task = asyncio.create_task(_run_dispatcher())
+    else:
+        logger.info("Notification dispatcher already running.")
+
+
+async def stop_notification_dispatcher():
+    global _dispatcher_task
+    if _dispatcher_task:
+        logger.info("Stopping notification dispatcher...")
+        _dispatcher_task.cancel()
+        try:
+            await _dispatcher_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            _dispatcher_task = None
+        logger.info("Notification dispatcher stopped.")
@@ -5,6 +5,7 @@ from onesignal.model.filter import Filter
 import dotenv
 import os
 
+from app.utils.executor import upstream_executor
 from app.utils.logging import Logger
 
 dotenv.load_dotenv()
@@ -20,7 +21,7 @@ onesignal_api = default_api.DefaultApi(
 )
 
 
-def sendNotification(
+async def sendNotification(
     message,
     userIds: list = [],
     title: str = "Notification",
@@ -52,7 +53,10 @@ def sendNotification(
     )
 
     try:
-        response = onesignal_api.create_notification(notification)
+        # the OneSignal SDK is blocking, so keep it off the event loop
+        response = await upstream_executor.run(
+            onesignal_api.create_notification, notification
+        )
         return response
     except Exception:
         logger.exception("Failed to send OneSignal notification")
@@ -0,0 +1,67 @@
+import base64
+import datetime
+import hashlib
+import typing
+
+from fastapi import HTTPException, Request
+
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(updated_at: datetime.datetime, row_id: int) -> str:
+    """Opaque keyset cursor pointing just past the row (updated_at, id)."""
+    raw = f"{updated_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(
+    cursor: typing.Optional[str],
+) -> tuple[typing.Optional[datetime.datetime], typing.Optional[int]]:
+    if not cursor:
+        return None, None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        updated_at, row_id = raw.rsplit("|", 1)
+        return datetime.datetime.fromisoformat(updated_at), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def validate_limit(limit: typing.Optional[int]) -> typing.Optional[int]:
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}"
+        )
+    return limit
+
+
+def list_etag(
+    row_count: int,
+    newest_updated_at: typing.Optional[datetime.datetime],
+    *page_args: typing.Any,
+) -> str:
+    """
+    Weak ETag for a list that only ever changes by rows being added, removed or
+    having updated_at bumped. Page arguments are folded in so each page validates separately.
+    """
+    newest = newest_updated_at.isoformat() if newest_updated_at else "-"
+    digest = hashlib.sha1(
+        "|".join(str(arg) for arg in (row_count, newest, *page_args)).encode()
+    ).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def if_none_match_tags(req: Request) -> set[str]:
+    """Entity tags listed in If-None-Match, without W/ prefixes or quotes."""
+    if_none_match = req.headers.get("If-None-Match")
+    if not if_none_match:
+        return set()
+    return {
+        tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")
+    }
+
+
+def etag_matches(req: Request, etag: str) -> bool:
+    """Weak comparison against If-None-Match, as RFC 9110 requires for GETs."""
+    tags = if_none_match_tags(req)
+    return "*" in tags or etag.removeprefix("W/").strip('"') in tags
@@ -0,0 +1,215 @@
+"""
+On-demand timetable syncs, queued in `sync_jobs` rather than run inside the request.
+/api/timetable/associate enqueues a job and returns straight away; the worker here,
+started in every uvicorn worker, claims jobs with SKIP LOCKED and runs them. The
+nightly sync engine leaves users with a pending job alone, so a fresh association is
+never held up behind (or overwritten by) the batch.
+"""
+
+import asyncio
+import os
+import sys
+import time
+import typing
+
+import asyncpg
+
+from app.sync import sync_timetable_for
+from app.utils.db import pool
+from app.utils.db.sync_state import record_sync_success
+from app.utils.logging import Logger
+
+logger = Logger("sync_jobs")
+
+SYNC_JOB_POLL_INTERVAL_SECONDS = float(os.getenv("SYNC_JOB_POLL_INTERVAL_SECONDS", 1))
+SYNC_JOB_BATCH_SIZE = int(os.getenv("SYNC_JOB_BATCH_SIZE", 8))
+SYNC_JOB_MAX_ATTEMPTS = int(os.getenv("SYNC_JOB_MAX_ATTEMPTS", 3))
+SYNC_JOB_RETRY_BASE_SECONDS = 10
+# a running job whose worker hasn't finished it by then is assumed lost and claimed again
+SYNC_JOB_LEASE_SECONDS = 120
+# finished jobs are kept so their status can still be read, then pruned
+SYNC_JOB_RETENTION = "7 days"
+SYNC_JOB_PRUNE_INTERVAL_SECONDS = 60 * 60
+
+_worker_task: typing.Optional[asyncio.Task] = None
+
+
+async def enqueue_sync_job(conn: asyncpg.Connection, user_id: str, url: str) -> int:
+    """
+    Queue a sync of the user's timetable and return the job's ID. A user has at most
+    one queued job: asking again before it starts returns the same job, now for `url`.
+    """
+    return await conn.fetchval(
+        """
+        INSERT INTO sync_jobs (user_id, url)
+        VALUES ($1, $2)
+        ON CONFLICT (user_id) WHERE status = 'queued'
+        DO UPDATE SET url = EXCLUDED.url, next_attempt_at = CURRENT_TIMESTAMP
+        RETURNING id
+        """,
+        user_id,
+        url,
+    )
+
+
+async def get_sync_job(
+    conn: asyncpg.Connection, user_id: str, job_id: int
+) -> typing.Optional[asyncpg.Record]:
+    return await conn.fetchrow(
+        """
+        SELECT id, status, attempts, last_error, created_at, started_at, finished_at
+        FROM sync_jobs
+        WHERE id = $1 AND user_id = $2
+        """,
+        job_id,
+        user_id,
+    )
+
+
+async def _claim_batch(conn: asyncpg.Connection) -> list:
+    return await conn.fetch(
+        """
+        UPDATE sync_jobs
+        SET status = 'running',
+            attempts = attempts + 1,
+            started_at = CURRENT_TIMESTAMP,
+            next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2)
+        WHERE id IN (
+            SELECT id FROM sync_jobs
+            WHERE status IN ('queued', 'running')
+            AND next_attempt_at <= CURRENT_TIMESTAMP
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_id, url, attempts
+        """,
+        SYNC_JOB_BATCH_SIZE,
+        SYNC_JOB_LEASE_SECONDS,
+    )
+
+
+async def _finish_job(job: asyncpg.Record, error: typing.Optional[str]):
+    async with pool.db_pool.acquire() as conn:
+        if error is None:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    UPDATE sync_jobs
+                    SET status = 'succeeded', last_error = NULL,
+                        finished_at = CURRENT_TIMESTAMP
+                    WHERE id = $1
+                    """,
+                    job["id"],
+                )
+                await record_sync_success(conn, job["user_id"])
+            return
+        logger.warning(f"Sync job {job['id']} for {job['user_id']} failed: {error}")
+        async with conn.transaction():
+            # back in the queue for another go, unless the user has queued a newer
+            # job since, which will sync the timetable anyway
+            retried = job["attempts"] < SYNC_JOB_MAX_ATTEMPTS and await conn.fetchval(
+                """
+                UPDATE sync_jobs
+                SET status = 'queued', last_error = $2,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $3)
+                WHERE id = $1
+                AND NOT EXISTS (
+                    SELECT 1 FROM sync_jobs
+                    WHERE user_id = $4 AND status = 'queued'
+                )
+                RETURNING true
+                """,
+                job["id"],
+                error,
+                SYNC_JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1),
+                job["user_id"],
+            )
+            if not retried:
+                await conn.execute(
+                    """
+                    UPDATE sync_jobs
+                    SET status = 'failed', last_error = $2,
+                        finished_at = CURRENT_TIMESTAMP
+                    WHERE id = $1
+                    """,
+                    job["id"],
+                    error,
+                )
+
+
+async def _run_job(job: asyncpg.Record):
+    try:
+        await sync_timetable_for(job["user_id"], job["url"])
+        error = None
+    except Exception as e:
+        error = repr(e)
+    await _finish_job(job, error)
+
+
+async def run_pending_sync_jobs() -> int:
+    """Run one batch of due jobs concurrently. Returns how many were claimed."""
+    if pool.db_pool is None:
+        return 0
+
+    async with pool.db_pool.acquire() as conn:
+        jobs = await _claim_batch(conn)
+    # the connection goes back to the pool first: a sync can take seconds upstream
+    await asyncio.gather(*(_run_job(job) for job in jobs))
+    return len(jobs)
+
+
+async def _prune_finished_jobs():
+    async with pool.db_pool.acquire() as conn:
+        await conn.execute(
+            f"""
+            DELETE FROM sync_jobs
+            WHERE status IN ('succeeded', 'failed')
+            AND finished_at < CURRENT_TIMESTAMP - INTERVAL '{SYNC_JOB_RETENTION}'
+            """
+        )
+
+
+async def _run_worker():
+    last_pruned = 0.0
+    while True:
+        try:
+            claimed = await run_pending_sync_jobs()
+            if time.monotonic() - last_pruned > SYNC_JOB_PRUNE_INTERVAL_SECONDS:
+                await _prune_finished_jobs()
+                last_pruned = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Sync job worker iteration failed")
+            claimed = 0
+
+        # a full batch means there's probably more waiting, so go again straight away
+        if claimed < SYNC_JOB_BATCH_SIZE:
+            await asyncio.sleep(SYNC_JOB_POLL_INTERVAL_SECONDS)
+
+
+async def start_sync_worker():
+    global _worker_task
+    if "pytest" in sys.modules:
+        # Don't actually sync timetables during tests
+        return
+    if _worker_task is None:
+        logger.info("Starting sync job worker...")
+        _worker_task = asyncio.create_task(_run_worker())
+    else:
+        logger.info("Sync job worker already running.")
+
+
+async def stop_sync_worker():
+    global _worker_task
+    if _worker_task:
+        logger.info("Stopping sync job worker...")
+        _worker_task.cancel()
+        try:
+            await _worker_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            _worker_task = None
+        logger.info("Sync job worker stopped.")
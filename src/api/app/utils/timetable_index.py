@@ -0,0 +1,240 @@
+"""
+In-process interval index of each user's events for a day, so "what is each friend
+doing right now" is a bisect per friend rather than a read of their timetable.
+
+A user's index for a London day is built from timetable_events the first time it's
+needed. When their timetable is written again, the sync trigger on timetables (see
+init_db) notifies every worker, which drops that user's entry straight away and then
+rebuilds the days it had cached, so users who are being looked at are re-indexed at
+sync time rather than on the next request.
+"""
+
+import asyncio
+import bisect
+import datetime
+import os
+import typing
+from array import array
+from collections import OrderedDict
+
+import asyncpg
+
+from app.utils.db import pool
+from app.utils.db.timetable_events import LONDON
+from app.utils.logging import Logger
+
+logger = Logger("timetable_index")
+
+TIMETABLE_EVENTS_CHANNEL = "timetable_events"
+TIMETABLE_INDEX_MAX_USERS = int(os.getenv("TIMETABLE_INDEX_MAX_USERS", 20000))
+TIMETABLE_INDEX_HEALTHCHECK_SECONDS = 10
+
+# every requested user with a timetable gets at least one row; users with no events that day get NULLs
+DAY_EVENTS_QUERY = """
+    SELECT t.user_id, e.dtstart, e.dtend,
+        e.event ->> 'summary' AS summary,
+        e.event ->> 'location' AS location,
+        e.event -> 'dtstart' ->> 'dt' AS start_dt,
+        e.event -> 'dtend' ->> 'dt' AS end_dt
+    FROM timetables t
+    LEFT JOIN timetable_events e
+        ON e.user_id = t.user_id AND e.dtstart >= $2 AND e.dtstart < $3
+    WHERE t.user_id = ANY($1::text[])
+    ORDER BY t.user_id, e.dtstart
+"""
+
+
+class DayIndex:
+    """One user's events for one day as parallel arrays sorted by start time."""
+
+    __slots__ = ("starts", "ends", "reach", "events")
+
+    def __init__(self):
+        self.starts = array("d")
+        self.ends = array("d")
+        # reach[i] is the latest end among events 0..i, so overlap searches can stop early
+        self.reach = array("d")
+        self.events: list[dict] = []
+
+    def add(self, start: float, end: float, event: dict):
+        """Events must be added in start order."""
+        self.starts.append(start)
+        self.ends.append(end)
+        self.reach.append(max(end, self.reach[-1]) if self.reach else end)
+        self.events.append(event)
+
+    def current(self, moment: float) -> typing.Optional[dict]:
+        """The latest-starting event in progress at `moment`, if any."""
+        i = bisect.bisect_right(self.starts, moment) - 1
+        while i >= 0 and self.reach[i] > moment:
+            if self.ends[i] > moment:
+                return self.events[i]
+            i -= 1
+        return None
+
+    def next(self, moment: float) -> typing.Optional[dict]:
+        """The first event starting after `moment`, if any."""
+        i = bisect.bisect_right(self.starts, moment)
+        return self.events[i] if i < len(self.events) else None
+
+
+# user_id -> {day: index, or None if they have no timetable}, least recently used first
+_indexes: OrderedDict[str, dict[datetime.date, typing.Optional[DayIndex]]] = OrderedDict()
+# users whose timetable changed while a load was in flight, so its result isn't cached
+_loads_in_flight: list[set[str]] = []
+# users to re-index after a write, with the days they had cached
+_pending_rebuilds: dict[str, set[datetime.date]] = {}
+_rebuild_wanted: typing.Optional[asyncio.Event] = None
+_index_task: typing.Optional[asyncio.Task] = None
+
+
+def day_bounds(day: datetime.date) -> tuple[datetime.datetime, datetime.datetime]:
+    start = LONDON.localize(datetime.datetime.combine(day, datetime.time()))
+    end = LONDON.localize(
+        datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+    )
+    return start, end
+
+
+def invalidate(user_id: str):
+    _indexes.pop(user_id, None)
+    for changed in _loads_in_flight:
+        changed.add(user_id)
+
+
+async def _load(
+    conn: asyncpg.Connection, user_ids: list[str], day: datetime.date
+) -> dict[str, typing.Optional[DayIndex]]:
+    start, end = day_bounds(day)
+    rows = await conn.fetch(DAY_EVENTS_QUERY, user_ids, start, end)
+    loaded: dict[str, typing.Optional[DayIndex]] = dict.fromkeys(user_ids)
+    for row in rows:
+        index = loaded[row["user_id"]]
+        if index is None:
+            index = loaded[row["user_id"]] = DayIndex()
+        if row["dtstart"] is not None:
+            index.add(
+                row["dtstart"].timestamp(),
+                row["dtend"].timestamp(),
+                {
+                    "summary": row["summary"],
+                    "location": row["location"],
+                    "dtstart": {"dt": row["start_dt"]},
+                    "dtend": {"dt": row["end_dt"]},
+                },
+            )
+    return loaded
+
+
+async def get_day_indexes(
+    conn: asyncpg.Connection, user_ids: typing.Iterable[str], day: datetime.date
+) -> dict[str, typing.Optional[DayIndex]]:
+    """Each user's index for `day` (London), or None for users without a timetable."""
+    user_ids = list(dict.fromkeys(user_ids))
+    found: dict[str, typing.Optional[DayIndex]] = {}
+    missing = []
+    for user_id in user_ids:
+        days = _indexes.get(user_id)
+        if days is not None and day in days:
+            found[user_id] = days[day]
+            _indexes.move_to_end(user_id)
+        else:
+            missing.append(user_id)
+    if not missing:
+        return found
+
+    changed: set[str] = set()
+    _loads_in_flight.append(changed)
+    try:
+        loaded = await _load(conn, missing, day)
+    finally:
+        _loads_in_flight.remove(changed)
+
+    for user_id, index in loaded.items():
+        found[user_id] = index
+        if user_id not in changed:
+            # only the newest couple of days are worth keeping per user
+            days = _indexes.setdefault(user_id, {})
+            days[day] = index
+            for stale in sorted(days)[:-2]:
+                del days[stale]
+            _indexes.move_to_end(user_id)
+    while len(_indexes) > TIMETABLE_INDEX_MAX_USERS:
+        _indexes.popitem(last=False)
+    return found
+
+
+def _on_notification(connection, pid, channel, payload):
+    days = _indexes.get(payload)
+    invalidate(payload)
+    if days:
+        _pending_rebuilds.setdefault(payload, set()).update(days)
+        if _rebuild_wanted is not None:
+            _rebuild_wanted.set()
+
+
+async def _rebuild_pending(conn: asyncpg.Connection):
+    by_day: dict[datetime.date, list[str]] = {}
+    while _pending_rebuilds:
+        user_id, days = _pending_rebuilds.popitem()
+        for day in days:
+            by_day.setdefault(day, []).append(user_id)
+    for day, user_ids in by_day.items():
+        # caches them again, unless they're written to once more while this loads
+        await get_day_indexes(conn, user_ids, day)
+
+
+async def _run_timetable_index():
+    global _rebuild_wanted
+    _rebuild_wanted = asyncio.Event()
+    while True:
+        try:
+            # a connection of its own: LISTEN would otherwise hold one of the pool's
+            conn = await pool.connect_listener()
+            try:
+                await conn.add_listener(TIMETABLE_EVENTS_CHANNEL, _on_notification)
+                # anything written while we weren't listening may be stale
+                _indexes.clear()
+                _pending_rebuilds.clear()
+                while not conn.is_closed():
+                    try:
+                        await asyncio.wait_for(
+                            _rebuild_wanted.wait(), TIMETABLE_INDEX_HEALTHCHECK_SECONDS
+                        )
+                    except asyncio.TimeoutError:
+                        continue
+                    _rebuild_wanted.clear()
+                    await _rebuild_pending(conn)
+            finally:
+                await conn.close()
+            logger.warning("Timetable index listener connection closed, reconnecting...")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Timetable index listener failed, retrying...")
+            await asyncio.sleep(TIMETABLE_INDEX_HEALTHCHECK_SECONDS)
+
+
+async def start_timetable_index():
+    global _index_task
+    if _index_task is None:
+        logger.info("Starting timetable index listener...")
+        _index_task = asyncio.create_task(_run_timetable_index())
+    else:
+        logger.info("Timetable index listener already running.")
+
+
+async def stop_timetable_index():
+    global _index_task
+    if _index_task:
+        logger.info("Stopping timetable index listener...")
+        _index_task.cancel()
+        try:
+            await _index_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            _index_task = None
+            _indexes.clear()
+            _pending_rebuilds.clear()
+        logger.info("Timetable index listener stopped.")
@@ -0,0 +1,63 @@
+"""
+Timetables are the largest payloads we serve and are already stored as JSON, so the
+routes splice Postgres' JSON text straight into the response body rather than
+decoding it and encoding it again.
+"""
+
+import json
+import typing
+
+from fastapi import Response
+
+EMPTY_TIMETABLE_DATA = "[]"
+
+
+def timetable_etag(content_hash: str) -> str:
+    """Strong ETag for a timetable, from the content hash stored alongside it."""
+    return f'"{content_hash}"'
+
+
+def timetable_response(timetable: str, status_code: int = 200, **kwargs) -> Response:
+    """`{"timetable": <stored timetable>}` for GET /api/timetable."""
+    body = b'{"timetable":' + timetable.encode() + b"}"
+    return Response(
+        body, status_code=status_code, media_type="application/json", **kwargs
+    )
+
+
+def batch_timetable_response(
+    rows: typing.Iterable,
+    user_ids: typing.Iterable[str],
+    unchanged: typing.Optional[typing.Iterable[str]] = None,
+    **kwargs,
+) -> Response:
+    """
+    `{user_id: {"data": [...], "version": ...}}` for every requested user, from rows of
+    (user_id, version, data) where data is already JSON text. Users without a row get
+    no events and a null version.
+
+    If `unchanged` is given, those users are left out and the body becomes
+    `{"timetables": {...}, "unchanged": [...]}`.
+    """
+    skipped = set(unchanged or ())
+    found = {
+        row["user_id"]: (row["version"], row["data"])
+        for row in rows
+        if row["user_id"] not in skipped
+    }
+    parts = []
+    for user_id in dict.fromkeys([*found, *user_ids]):
+        if user_id in skipped:
+            continue
+        version, data = found.get(user_id, (None, None))
+        parts.append(
+            f'{json.dumps(user_id)}:{{"data":{data or EMPTY_TIMETABLE_DATA},'
+            f'"version":{json.dumps(version)}}}'
+        )
+    timetables = "{" + ",".join(parts) + "}"
+
+    if unchanged is None:
+        body = timetables
+    else:
+        body = f'{{"timetables":{timetables},"unchanged":{json.dumps(sorted(skipped))}}}'
+    return Response(body.encode(), media_type="application/json", **kwargs)
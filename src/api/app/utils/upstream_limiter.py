@@ -0,0 +1,210 @@
+"""
+Pacing for calls to the college's webservices.runshaw.ac.uk, which serves both the
+timetable feeds and RunshawPay. A token bucket spaces requests out and an AIMD window
+caps how many are in flight; both grow a little with every prompt answer and halve
+when the college pushes back (429, 5xx or a timeout), so we find the rate it's happy
+with rather than guessing one. Each process has its own limiter; the sync engine keeps
+a copy of this class for the nightly run.
+
+    async with runshaw_limiter:
+        async with session.get(url) as response:
+            response.raise_for_status()
+
+Errors raised inside the block are what it learns from, so raise_for_status belongs
+inside it. Request handlers should use `slot(timeout)` instead, which gives up with
+LimiterBusy rather than keeping a user waiting behind a backed-off upstream.
+"""
+
+import asyncio
+import collections
+import contextlib
+import math
+import os
+import time
+import typing
+
+import aiohttp
+
+from app.utils.logging import Logger
+
+logger = Logger("upstream_limiter")
+
+RUNSHAW_RATE = float(os.getenv("RUNSHAW_RATE", 5))
+RUNSHAW_MAX_RATE = float(os.getenv("RUNSHAW_MAX_RATE", 20))
+RUNSHAW_CONCURRENCY = float(os.getenv("RUNSHAW_CONCURRENCY", 4))
+RUNSHAW_MAX_CONCURRENCY = float(os.getenv("RUNSHAW_MAX_CONCURRENCY", 16))
+# one halving per this long, however many in-flight requests fail together
+DECREASE_COOLDOWN_SECONDS = 1.0
+MAX_RETRY_AFTER_SECONDS = 60.0
+RUNSHAW_QUEUE_TIMEOUT_SECONDS = float(os.getenv("RUNSHAW_QUEUE_TIMEOUT_SECONDS", 5))
+
+
+def is_throttled(error: typing.Optional[BaseException]) -> bool:
+    """Whether an error means the upstream wants us to slow down."""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return False
+
+
+class LimiterBusy(Exception):
+    """Raised by `slot` when no turn came up in time."""
+
+    def __init__(self, name: str, retry_after: int) -> None:
+        super().__init__(f"Timed out waiting for a turn at {name}")
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket plus AIMD concurrency limit for one upstream host. Not tied to an
+    event loop, so a module-level instance can be shared by everything in the process.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        max_rate: float,
+        concurrency: float,
+        max_concurrency: float,
+        min_rate: float = 0.5,
+        min_concurrency: float = 1.0,
+    ) -> None:
+        self.name = name
+        self.min_rate, self.max_rate = min_rate, max_rate
+        self.min_concurrency, self.max_concurrency = min_concurrency, max_concurrency
+        self._rate = rate
+        self._concurrency = concurrency
+        self._tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._waiters: collections.deque = collections.deque()
+        self._successes = 0
+        self._throttled = 0
+
+    def _refill(self, now: float) -> None:
+        # a second's worth of burst at most
+        self._tokens = min(
+            self._tokens + (now - self._refilled_at) * self._rate, max(self._rate, 1.0)
+        )
+        self._refilled_at = now
+
+    async def acquire(self) -> None:
+        while True:
+            if self._in_flight >= int(self._concurrency):
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    # woken just as we were cancelled: pass the turn on
+                    if waiter.done() and not waiter.cancelled():
+                        self._wake_next()
+                    raise
+                finally:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                continue
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+            elif self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+            else:
+                self._tokens -= 1
+                self._in_flight += 1
+                return
+
+    def release(self, error: typing.Optional[BaseException] = None) -> None:
+        self._in_flight -= 1
+        if is_throttled(error):
+            self._throttled += 1
+            self._decrease(error)
+        elif error is None:
+            self._successes += 1
+            # additive increase: about +1 per window's worth of successes
+            self._rate = min(self._rate + 1 / self._rate, self.max_rate)
+            self._concurrency = min(
+                self._concurrency + 1 / self._concurrency, self.max_concurrency
+            )
+        self._wake_next()
+
+    def _wake_next(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _decrease(self, error: BaseException) -> None:
+        now = time.monotonic()
+        retry_after = None
+        if isinstance(error, aiohttp.ClientResponseError) and error.headers:
+            try:
+                retry_after = float(error.headers.get("Retry-After", ""))
+            except ValueError:
+                pass
+        if retry_after:
+            self._paused_until = max(
+                self._paused_until, now + min(retry_after, MAX_RETRY_AFTER_SECONDS)
+            )
+        if now - self._last_decrease < DECREASE_COOLDOWN_SECONDS:
+            return
+        self._last_decrease = now
+        self._rate = max(self._rate / 2, self.min_rate)
+        self._concurrency = max(self._concurrency / 2, self.min_concurrency)
+        logger.warning(
+            f"{self.name} is pushing back ({error!r}); now "
+            f"{self._rate:.2f} req/s, {int(self._concurrency)} at once"
+        )
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        self.release(exc)
+        return False
+
+    @contextlib.asynccontextmanager
+    async def slot(self, timeout: float) -> typing.AsyncIterator["AdaptiveLimiter"]:
+        """Like `async with limiter`, but waits at most `timeout` seconds for a turn."""
+        try:
+            async with asyncio.timeout(timeout):
+                await self.acquire()
+        except TimeoutError:
+            paused_for = self._paused_until - time.monotonic()
+            raise LimiterBusy(self.name, max(math.ceil(paused_for), 1)) from None
+        try:
+            yield self
+        except BaseException as e:
+            self.release(e)
+            raise
+        self.release()
+
+    def stats(self) -> dict:
+        return {
+            "rate": round(self._rate, 3),
+            "concurrency_limit": int(self._concurrency),
+            "in_flight": self._in_flight,
+            "waiting": len(self._waiters),
+            "paused_for_seconds": round(
+                max(self._paused_until - time.monotonic(), 0.0), 3
+            ),
+            "successes": self._successes,
+            "throttled": self._throttled,
+        }
+
+
+runshaw_limiter = AdaptiveLimiter(
+    "webservices.runshaw.ac.uk",
+    RUNSHAW_RATE,
+    RUNSHAW_MAX_RATE,
+    RUNSHAW_CONCURRENCY,
+    RUNSHAW_MAX_CONCURRENCY,
+)
@@ -0,0 +1,137 @@
+"""
+Measures per-request latency of validateToken with and without the verified-token cache,
+and how many Appwrite calls concurrent launch bursts make with single-flight coalescing.
+Appwrite is replaced by a stub that sleeps for APPWRITE_RTT_MS, so the numbers show the
+round trip the cache saves rather than anything about the network this runs on.
+
+Run from src/api with: python -m benchmarks.bench_auth_cache
+"""
+
+import asyncio
+import base64
+import json
+import os
+import statistics
+import time
+
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+
+from appwrite.models import User
+from starlette.requests import Request
+
+from app.utils import auth
+from app.utils.cache.tokens import local_token_cache
+
+APPWRITE_RTT_MS = float(os.getenv("APPWRITE_RTT_MS", 80))
+REQUESTS = int(os.getenv("BENCH_REQUESTS", 200))
+# parallel requests the app makes with one token at launch
+FAN_OUT = int(os.getenv("BENCH_FAN_OUT", 6))
+
+upstream_calls = 0
+
+
+def _fake_jwt(user_id: str) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    claims = {"userId": user_id, "exp": int(time.time()) + 900}
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode(claims)}.signature"
+
+
+def _fake_user(user_id: str) -> User:
+    return User.with_data(
+        {
+            "$id": user_id,
+            "$createdAt": "",
+            "$updatedAt": "",
+            "name": "Benchmark User",
+            "registration": "",
+            "status": True,
+            "labels": [],
+            "passwordUpdate": "",
+            "email": f"{user_id}@student.runshaw.ac.uk",
+            "phone": "",
+            "emailVerification": True,
+            "phoneVerification": False,
+            "mfa": False,
+            "prefs": {},
+            "targets": [],
+            "accessedAt": "",
+        }
+    )
+
+
+async def _stub_appwrite(token: str) -> User:
+    global upstream_calls
+    upstream_calls += 1
+    await asyncio.sleep(APPWRITE_RTT_MS / 1000)
+    return _fake_user("bench123")
+
+
+def _request(token: str) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [(b"authorization", f"Bearer {token}".encode())],
+        }
+    )
+
+
+async def _run(token: str, clear_each_time: bool) -> list[float]:
+    timings = []
+    for _ in range(REQUESTS):
+        if clear_each_time:
+            local_token_cache.clear()
+        start = time.perf_counter()
+        await auth.validateToken(_request(token))
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+async def _run_bursts(token: str) -> int:
+    """Cold-cache launch bursts of FAN_OUT concurrent requests; returns upstream calls made."""
+    global upstream_calls
+    upstream_calls = 0
+    for _ in range(REQUESTS // FAN_OUT):
+        local_token_cache.clear()
+        await asyncio.gather(
+            *(auth.validateToken(_request(token)) for _ in range(FAN_OUT))
+        )
+    return upstream_calls
+
+
+def _report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    print(
+        f"{label:<8} mean={statistics.mean(timings):8.3f}ms "
+        f"p50={timings[len(timings) // 2]:8.3f}ms "
+        f"p99={timings[min(len(timings) - 1, int(len(timings) * 0.99))]:8.3f}ms"
+    )
+
+
+async def main():
+    auth._get_user_from_jwt = _stub_appwrite
+    token = _fake_jwt("bench123")
+
+    uncached = await _run(token, clear_each_time=True)
+    local_token_cache.clear()
+    cached = await _run(token, clear_each_time=False)
+
+    print(f"{REQUESTS} requests, simulated Appwrite RTT {APPWRITE_RTT_MS}ms")
+    _report("uncached", uncached)
+    _report("cached", cached)
+    print(
+        f"saved per request: {statistics.mean(uncached) - statistics.mean(cached):.3f}ms"
+    )
+
+    bursts = REQUESTS // FAN_OUT
+    calls = await _run_bursts(token)
+    print(
+        f"{bursts} cold launch bursts of {FAN_OUT}: {calls} Appwrite calls "
+        f"for {bursts * FAN_OUT} requests"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
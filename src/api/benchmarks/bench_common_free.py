@@ -0,0 +1,102 @@
+"""
+Times finding the common free periods of a group of friends over a full term, with the
+NumPy interval merge used by /api/timetable/common-free against a plain Python sweep
+over the same events.
+
+Each user has LESSONS_PER_DAY random one-hour lessons between 09:00 and 16:00 on every
+weekday of a TERM_WEEKS-week term, and free time is limited to college hours.
+
+Run from src/api with: python -m benchmarks.bench_common_free
+"""
+
+import datetime
+import os
+import random
+import time
+
+os.environ.setdefault("DATABASE_URL", "postgres://localhost:5432/bench")
+os.environ.setdefault("DATABASE_PWD", "")
+
+import numpy as np
+
+from app.utils.db.timetable_events import LONDON
+from app.utils.free_periods import common_free_periods, outside_hours
+
+USERS = int(os.getenv("BENCH_USERS", 10))
+TERM_WEEKS = int(os.getenv("BENCH_TERM_WEEKS", 14))
+LESSONS_PER_DAY = 4
+ROUNDS = int(os.getenv("BENCH_ROUNDS", 50))
+
+TERM_START = LONDON.localize(datetime.datetime(2025, 9, 1))
+TERM_END = TERM_START + datetime.timedelta(weeks=TERM_WEEKS)
+DAY_START = datetime.time(9)
+DAY_END = datetime.time(16)
+
+
+def _synthetic_rows(rng: random.Random) -> list[dict]:
+    """What BUSY_INTERVALS_QUERY returns for the whole group."""
+    rows = []
+    for _ in range(USERS):
+        for offset in range(TERM_WEEKS * 7):
+            day = TERM_START.date() + datetime.timedelta(days=offset)
+            if day.weekday() >= 5:
+                continue
+            for hour in rng.sample(range(9, 16), LESSONS_PER_DAY):
+                start = LONDON.localize(
+                    datetime.datetime.combine(day, datetime.time(hour))
+                ).timestamp()
+                rows.append({"dtstart": start, "dtend": start + 3600})
+    return rows
+
+
+def _numpy(rows: list[dict]) -> list[dict]:
+    busy_starts = np.fromiter((row["dtstart"] for row in rows), float, len(rows))
+    busy_ends = np.fromiter((row["dtend"] for row in rows), float, len(rows))
+    return common_free_periods(
+        busy_starts, busy_ends, TERM_START, TERM_END, DAY_START, DAY_END
+    )
+
+
+def _python(rows: list[dict]) -> list[dict]:
+    closed_starts, closed_ends = outside_hours(TERM_START, TERM_END, DAY_START, DAY_END)
+    intervals = sorted(
+        [(row["dtstart"], row["dtend"]) for row in rows]
+        + list(zip(closed_starts.tolist(), closed_ends.tolist()))
+    )
+    free = []
+    cursor = TERM_START.timestamp()
+    window_end = TERM_END.timestamp()
+    for start, end in intervals:
+        start, end = min(max(start, cursor), window_end), min(end, window_end)
+        if start > cursor:
+            free.append((cursor, start))
+        cursor = max(cursor, end)
+    if cursor < window_end:
+        free.append((cursor, window_end))
+    return [
+        {
+            "start": datetime.datetime.fromtimestamp(start, LONDON).isoformat(),
+            "end": datetime.datetime.fromtimestamp(end, LONDON).isoformat(),
+        }
+        for start, end in free
+    ]
+
+
+def _time(find, rows: list[dict]) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        find(rows)
+    return (time.perf_counter() - start) * 1000 / ROUNDS
+
+
+def main():
+    rows = _synthetic_rows(random.Random(0))
+    assert _numpy(rows) == _python(rows)
+    periods = len(_numpy(rows))
+    print(f"{USERS} users, {TERM_WEEKS}-week term: {len(rows)} events, {periods} free periods")
+    print(f"  numpy merge:   {_time(_numpy, rows):8.2f}ms")
+    print(f"  python sweep:  {_time(_python, rows):8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Builds the in-memory friend graph for a synthetic college-sized population and times
+suggestions, mutual-friend lookups and incremental updates against it.
+
+Users are grouped into classes of CLASS_SIZE, befriending FRIENDS_IN_CLASS classmates
+and FRIENDS_ELSEWHERE random users, so friends-of-friends overlap the way real ones do.
+
+Run from src/api with: python -m benchmarks.bench_friend_graph
+"""
+
+import os
+import random
+import time
+import tracemalloc
+
+os.environ.setdefault("DATABASE_URL", "postgres://localhost:5432/bench")
+os.environ.setdefault("DATABASE_PWD", "")
+
+from app.utils.friend_graph import FriendGraph
+
+USERS = int(os.getenv("BENCH_USERS", 50_000))
+CLASS_SIZE = 25
+FRIENDS_IN_CLASS = 12
+FRIENDS_ELSEWHERE = 8
+SAMPLES = int(os.getenv("BENCH_SAMPLES", 2_000))
+
+
+def _synthetic_friendships(rng: random.Random) -> list[tuple[str, str]]:
+    edges = set()
+    for user in range(USERS):
+        class_start = user - user % CLASS_SIZE
+        classmates = range(class_start, min(class_start + CLASS_SIZE, USERS))
+        picks = rng.sample(classmates, min(FRIENDS_IN_CLASS, len(classmates)))
+        # halved because the other user picks this one back just as often
+        picks += [rng.randrange(USERS) for _ in range(FRIENDS_ELSEWHERE // 2)]
+        for other in picks:
+            if other != user:
+                edges.add((min(user, other), max(user, other)))
+    return [(f"user{a}", f"user{b}") for a, b in edges]
+
+
+def _percentiles(timings: list[float]) -> str:
+    timings = sorted(timings)
+    p50 = timings[len(timings) // 2]
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    return f"p50 {p50 * 1000:7.3f}ms  p99 {p99 * 1000:7.3f}ms"
+
+
+def _time_each(func, args: list[tuple]) -> list[float]:
+    timings = []
+    for call_args in args:
+        start = time.perf_counter()
+        func(*call_args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    rng = random.Random(42)
+    friendships = _synthetic_friendships(rng)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    graph = FriendGraph.build(friendships)
+    build_seconds = time.perf_counter() - start
+    graph_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    users = [f"user{rng.randrange(USERS)}" for _ in range(SAMPLES)]
+    others = [f"user{rng.randrange(USERS)}" for _ in range(SAMPLES)]
+    suggestions = _time_each(graph.suggestions, [(u,) for u in users])
+    mutuals = _time_each(graph.mutual_friends, list(zip(users, others)))
+    adds = _time_each(graph.add_friendship, list(zip(users, others)))
+    removes = _time_each(graph.remove_friendship, list(zip(users, others)))
+
+    print(
+        f"{USERS} users, {len(friendships)} friendships "
+        f"({2 * len(friendships) / USERS:.1f} friends each on average)"
+    )
+    print(f"build:        {build_seconds * 1000:9.1f}ms, {graph_bytes / 1e6:.1f}MB")
+    print(f"suggestions:  {_percentiles(suggestions)}")
+    print(f"mutual:       {_percentiles(mutuals)}")
+    print(f"add edge:     {_percentiles(adds)}")
+    print(f"remove edge:  {_percentiles(removes)}")
+
+
+if __name__ == "__main__":
+    main()
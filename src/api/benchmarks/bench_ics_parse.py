@@ -0,0 +1,102 @@
+"""
+Times parsing a corpus of calendars to timetable JSON in this process, as the sync used
+to, against the pool of worker processes it now uses, at each pool size up to the number
+of cores.
+
+Recorded calendars are read from BENCH_ICS_DIR (every *.ics file in it) if it's set;
+otherwise the corpus is BENCH_CALENDARS synthetic year-long timetables of
+LESSONS_PER_DAY lessons a weekday, which is about the size of a real one.
+
+Run from src/api with: python -m benchmarks.bench_ics_parse
+"""
+
+import datetime
+import multiprocessing
+import os
+import pathlib
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault("DATABASE_URL", "postgres://localhost:5432/bench")
+os.environ.setdefault("DATABASE_PWD", "")
+
+from app.sync import parse_ics
+
+CALENDARS = int(os.getenv("BENCH_CALENDARS", 48))
+MAX_PROCESSES = int(os.getenv("BENCH_MAX_PROCESSES", os.cpu_count() or 1))
+LESSONS_PER_DAY = 4
+
+YEAR_START = datetime.date(2025, 9, 1)
+SUBJECTS = ["Computing", "Maths", "Further Maths", "Physics", "Study Period"]
+
+
+def _synthetic_calendar(rng: random.Random, n: int) -> bytes:
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Runshaw College//EN"]
+    for offset in range(7 * 39):
+        day = YEAR_START + datetime.timedelta(days=offset)
+        if day.weekday() >= 5:
+            continue
+        for hour in sorted(rng.sample(range(8, 15), LESSONS_PER_DAY)):
+            start = datetime.datetime.combine(day, datetime.time(hour))
+            lines += [
+                "BEGIN:VEVENT",
+                f"UID:{n}-{offset}-{hour}@runshaw",
+                f"DTSTART:{start:%Y%m%dT%H%M%S}Z",
+                f"DTEND:{start + datetime.timedelta(hours=1):%Y%m%dT%H%M%S}Z",
+                "DTSTAMP:20250801T000000Z",
+                f"SUMMARY:{rng.choice(SUBJECTS)}",
+                f"LOCATION:{rng.choice('ABCDE')}{rng.randint(1, 30)}",
+                "DESCRIPTION:Teacher(s): Mr Smith",
+                "END:VEVENT",
+            ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines).encode()
+
+
+def _corpus() -> list[bytes]:
+    ics_dir = os.getenv("BENCH_ICS_DIR")
+    if ics_dir:
+        return [path.read_bytes() for path in sorted(pathlib.Path(ics_dir).glob("*.ics"))]
+    rng = random.Random(0)
+    return [_synthetic_calendar(rng, n) for n in range(CALENDARS)]
+
+
+def _time_serial(corpus: list[bytes]) -> float:
+    start = time.perf_counter()
+    for ics_data in corpus:
+        parse_ics(ics_data)
+    return time.perf_counter() - start
+
+
+def _time_pool(corpus: list[bytes], processes: int) -> float:
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("forkserver")
+    ) as executor:
+        # start the workers (and their imports) before the clock does
+        list(executor.map(parse_ics, corpus[:processes]))
+        start = time.perf_counter()
+        list(executor.map(parse_ics, corpus))
+        return time.perf_counter() - start
+
+
+def main():
+    corpus = _corpus()
+    events = sum(ics_data.count(b"BEGIN:VEVENT") for ics_data in corpus)
+    payload = sum(len(parse_ics(ics_data)) for ics_data in corpus)
+    print(
+        f"{len(corpus)} calendars, {events} events, "
+        f"{payload / len(corpus) / 1024:.0f}KiB of JSON each"
+    )
+    serial = _time_serial(corpus)
+    print(f"  in process:      {serial * 1000:8.0f}ms")
+    for processes in range(1, MAX_PROCESSES + 1):
+        pooled = _time_pool(corpus, processes)
+        print(
+            f"  {processes:2d} processes:    {pooled * 1000:8.0f}ms  "
+            f"({serial / pooled:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
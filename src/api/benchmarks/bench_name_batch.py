@@ -0,0 +1,118 @@
+"""
+Measures /api/name/get/batch latency for a user with many friends, on a cold and a warm
+name cache. Redis and Appwrite are replaced by stubs that sleep for REDIS_RTT_MS and
+APPWRITE_RTT_MS per round trip, so the numbers reflect round-trip counts and concurrency.
+
+Run from src/api with: python -m benchmarks.bench_name_batch
+"""
+
+import asyncio
+import os
+import time
+
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("DATABASE_URL", "postgres://localhost:5432/bench")
+os.environ.setdefault("DATABASE_PWD", "")
+
+from app.routers.friends.router import NAME_FETCH_CONCURRENCY, get_names
+from app.utils.models import BatchGetBody
+
+REDIS_RTT_MS = float(os.getenv("REDIS_RTT_MS", 0.5))
+APPWRITE_RTT_MS = float(os.getenv("APPWRITE_RTT_MS", 40))
+FRIENDS = int(os.getenv("BENCH_FRIENDS", 150))
+
+
+class _StubPipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def set(self, key, value, ex=None):
+        self._commands.append((key, value))
+        return self
+
+    async def execute(self):
+        await self._redis.round_trip()
+        for key, value in self._commands:
+            self._redis.data[key] = value
+
+
+class _StubRedis:
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    async def round_trip(self):
+        self.round_trips += 1
+        await asyncio.sleep(REDIS_RTT_MS / 1000)
+
+    async def get(self, key):
+        await self.round_trip()
+        return self.data.get(key)
+
+    async def mget(self, keys):
+        await self.round_trip()
+        return [self.data.get(key) for key in keys]
+
+    async def set(self, key, value, ex=None):
+        await self.round_trip()
+        self.data[key] = value
+
+    def pipeline(self, transaction=True):
+        return _StubPipeline(self)
+
+
+class _StubUser:
+    def __init__(self, user_id):
+        self.name = f"Friend {user_id}"
+
+
+class _StubAppwrite:
+    def __init__(self):
+        self.calls = 0
+
+    async def get_user(self, user_id):
+        self.calls += 1
+        await asyncio.sleep(APPWRITE_RTT_MS / 1000)
+        return _StubUser(user_id)
+
+
+async def _time(body, redis_conn, appwrite) -> float:
+    start = time.perf_counter()
+    await get_names(None, body, None, redis_conn, appwrite)
+    return (time.perf_counter() - start) * 1000
+
+
+async def main():
+    body = BatchGetBody(user_ids=[f"friend{i}" for i in range(FRIENDS)])
+    redis_conn = _StubRedis()
+    appwrite = _StubAppwrite()
+
+    cold = await _time(body, redis_conn, appwrite)
+    cold_round_trips, cold_calls = redis_conn.round_trips, appwrite.calls
+    warm = await _time(body, redis_conn, appwrite)
+
+    print(
+        f"{FRIENDS} friends, Redis RTT {REDIS_RTT_MS}ms, Appwrite RTT {APPWRITE_RTT_MS}ms, "
+        f"concurrency {NAME_FETCH_CONCURRENCY}"
+    )
+    print(
+        f"cold: {cold:9.2f}ms ({cold_round_trips} Redis round trips, {cold_calls} Appwrite calls)"
+    )
+    print(
+        f"warm: {warm:9.2f}ms ({redis_conn.round_trips - cold_round_trips} Redis round trips, "
+        f"{appwrite.calls - cold_calls} Appwrite calls)"
+    )
+    serial_cold = FRIENDS * (2 * REDIS_RTT_MS + APPWRITE_RTT_MS)
+    print(f"serial lookups would take roughly {serial_cold:.2f}ms cold")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+"""
+Compares building timetable responses by decoding the stored JSON and encoding it again
+through JSONResponse (the old path) against splicing the JSON text Postgres returns
+straight into the body, for a single timetable and for a 300-user batch.
+
+Reports CPU time per response and peak memory allocated while building it.
+
+Run from src/api with: python -m benchmarks.bench_timetable_json
+"""
+
+import json
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("DATABASE_URL", "postgres://localhost:5432/bench")
+os.environ.setdefault("DATABASE_PWD", "")
+
+from fastapi.responses import JSONResponse
+
+from app.utils.timetable_json import batch_timetable_response, timetable_response
+
+EVENTS_PER_TIMETABLE = int(os.getenv("BENCH_EVENTS", 600))
+ROUNDS = int(os.getenv("BENCH_ROUNDS", 20))
+
+
+def _synthetic_timetable(user: int) -> dict:
+    return {
+        "version": "2.0",
+        "prodid": "-//Runshaw College//EN",
+        "method": "PUBLISH",
+        "data": [
+            {
+                "type": "VEVENT",
+                "dtstart": {"dt": f"202509{1 + i % 28:02d}T{9 + i % 7:02d}0000"},
+                "dtend": {"dt": f"202509{1 + i % 28:02d}T{10 + i % 7:02d}0000"},
+                "dtstamp": {"dt": "20250801T000000"},
+                "uid": f"{user}-{i}",
+                "created": {"dt": "20250801T000000"},
+                "description": f"Teacher(s): Teacher {i % 40}",
+                "lastModified": {"dt": "20250801T000000"},
+                "location": f"Room B{i % 30}",
+                "sequence": "0",
+                "status": "CONFIRMED",
+                "summary": f"Subject {i % 5} - Lesson",
+                "transp": "OPAQUE",
+            }
+            for i in range(EVENTS_PER_TIMETABLE)
+        ],
+    }
+
+
+# what asyncpg hands back for `SELECT timetable` / `SELECT (timetable -> 'data')::text`
+def _jsonb_text(value) -> str:
+    return json.dumps(value)
+
+
+def _old_single(stored: str):
+    return JSONResponse({"timetable": json.loads(stored)})
+
+
+def _old_batch(rows: list[dict]):
+    return JSONResponse(
+        {row["user_id"]: {"data": json.loads(row["timetable"])["data"]} for row in rows}
+    )
+
+
+def _measure(build) -> tuple[float, float, int]:
+    """(CPU ms per response, peak MB while building one, body size)"""
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        response = build()
+    cpu_ms = (time.process_time() - start) * 1000 / ROUNDS
+
+    tracemalloc.start()
+    response = build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak / 1e6, len(response.body)
+
+
+def _report(label: str, old, new):
+    old_cpu, old_peak, old_size = _measure(old)
+    new_cpu, new_peak, new_size = _measure(new)
+    print(f"{label}:")
+    print(f"  decode/encode: {old_cpu:8.2f}ms CPU, {old_peak:7.2f}MB peak, {old_size} bytes")
+    print(f"  pass-through:  {new_cpu:8.2f}ms CPU, {new_peak:7.2f}MB peak, {new_size} bytes")
+
+
+def main():
+    for users in (1, 300):
+        timetables = {f"user{u}": _synthetic_timetable(u) for u in range(users)}
+        old_rows = [
+            {"user_id": user_id, "timetable": _jsonb_text(timetable)}
+            for user_id, timetable in timetables.items()
+        ]
+        new_rows = [
+            {
+                "user_id": user_id,
+                "version": f"{user_id:0>32}",
+                "data": _jsonb_text(timetable["data"]),
+            }
+            for user_id, timetable in timetables.items()
+        ]
+        user_ids = list(timetables)
+
+        if users == 1:
+            stored = old_rows[0]["timetable"]
+            _report(
+                "single timetable", lambda: _old_single(stored), lambda: timetable_response(stored)
+            )
+        _report(
+            f"batch of {users}",
+            lambda: _old_batch(old_rows),
+            lambda: batch_timetable_response(new_rows, user_ids),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,6 @@ import asyncio
 from datetime import datetime
 import asyncpg
 import os
-import json
 import dotenv
 import onesignal
 from onesignal.api import default_api
@@ -154,60 +153,24 @@ async def prepareDB():
 async def queue_notifications():
     # This function will be called at 08:00 to populate the QUEUED_NOTIFICATIONS list with the student IDs of students who have exams today
     async with DATABASE.acquire() as connection:
-        today = datetime.now().date()
+        # timetable_events is kept in step with the timetables by the API, so today's events
+        # are a range over dtstart rather than a decode of every stored timetable
         rows = await connection.fetch(
             """
-            SELECT * FROM timetables
+            SELECT DISTINCT user_id FROM timetable_events
+            WHERE dtstart >= date_trunc('day', now() AT TIME ZONE 'Europe/London') AT TIME ZONE 'Europe/London'
+            AND dtstart < (date_trunc('day', now() AT TIME ZONE 'Europe/London') + interval '1 day') AT TIME ZONE 'Europe/London'
+            -- exams have a blank name for some reason
+            AND event ->> 'summary' = ''
             """,
         )
-        decoder = json.JSONDecoder()
-
-        def parse_event_dt(dt_str: str) -> datetime:
-            # Accept multiple datetime formats that may appear in timetables
-            for fmt in (
-                "%Y%m%dT%H%M%S",
-                "%Y%m%dT%H%M",
-                "%Y-%m-%dT%H:%M:%S",
-                "%Y-%m-%dT%H:%M",
-            ):
-                try:
-                    return datetime.strptime(dt_str, fmt)
-                except Exception:
-                    continue
-            # fallback to fromisoformat if possible (may raise)
-            try:
-                return datetime.fromisoformat(dt_str)
-            except Exception:
-                raise ValueError(f"Unrecognized datetime format: {dt_str}")
 
         for user in rows:
-            try:
-                raw_tt = user.get("timetable")
-                if isinstance(raw_tt, str):
-                    timetable = decoder.decode(raw_tt)
-                else:
-                    timetable = raw_tt or {}
-            except Exception:
-                continue
-
-            events = (timetable or {}).get("data", [])
-            for event in events:
-                # exams have a blank name for some reason
-                if event.get("summary", None) == "":
-                    try:
-                        raw_dt = event["dtstart"]["dt"]
-                        start_time = parse_event_dt(raw_dt)
-                    except Exception:
-                        continue
-
-                    if start_time.date() == today:
-                        user_id = user.get("user_id")
-                        async with QUEUED_NOTIFICATIONS_LOCK:
-                            if user_id and user_id not in QUEUED_NOTIFICATIONS:
-                                QUEUED_NOTIFICATIONS.append(user_id)
-                                logger.debug("Queued notification for user %s", user_id)
-                        logger.debug("event: %s", event)
-                        break
+            user_id = user.get("user_id")
+            async with QUEUED_NOTIFICATIONS_LOCK:
+                if user_id and user_id not in QUEUED_NOTIFICATIONS:
+                    QUEUED_NOTIFICATIONS.append(user_id)
+                    logger.debug("Queued notification for user %s", user_id)
 
 
 async def runMainLoop():
@@ -1,29 +1,211 @@
 """
 Author: Daniel Benge
 Date: 2025-14-03
-Version: 1.0
-Description: This script is used to fetch the timetable URLs from the database and parse the ICS files to JSON. I'll probably set it up as a daily cron job to keep the database up to date.
+Version: 2.0
+Description: This script is used to fetch the timetable URLs from the database and parse the ICS files to JSON. It runs as a daily cron job to keep the database up to date.
+
+Associations are leased in batches and go through fetch -> parse -> write stages joined
+by bounded queues, so memory stays flat however many users there are,
+up to SYNC_FETCH_CONCURRENCY calendars are downloaded at once over one shared HTTP
+session, and timetables are written in batches rather than one statement per user.
+Parsing is CPU-bound, so it runs in a pool of SYNC_PARSE_PROCESSES worker processes
+(one per core by default); each gets the raw ICS bytes and sends back the timetable
+as a compact JSON string, ready to be written as-is.
+
+Calendars that haven't changed since the last run are skipped: each association keeps
+the ETag, Last-Modified and a SHA-256 of the raw ICS body it was last synced from, so the
+upstream can answer 304, and a body identical to last time isn't parsed or written.
+
+A calendar that fails (to fetch, parse or write) only fails that user. Every outcome is
+recorded in sync_state, and failing users are skipped with exponential backoff from
+SYNC_BACKOFF_BASE_HOURS, then dead-lettered after SYNC_DEAD_LETTER_FAILURES failures in
+a row so broken or expired URLs stop costing an upstream call every night.
+
+Any number of these workers can run at once, on one box or several: each leases batches
+of due associations with FOR UPDATE SKIP LOCKED, so no two work on the same user, and
+exits when nothing is left. A synced user isn't due again for SYNC_INTERVAL_HOURS. A
+lease lasts SYNC_LEASE_SECONDS; if its worker dies first, the batch is reclaimed by
+whichever worker asks next.
+
+Requests to webservices.runshaw.ac.uk go through an adaptive limiter (a copy of the
+API's app/utils/upstream_limiter.py): a token bucket and an AIMD cap on requests in
+flight that speed up while the college answers promptly and halve on a 429, 5xx or
+timeout.
+
+Each run records how long every user's fetch (and the wait for the limiter before it),
+parse and batch write took, how many bytes and events came down and why anything
+failed, as histograms and counters. At the end they're pushed to a Prometheus
+Pushgateway at SYNC_PUSHGATEWAY_URL and/or written in the same text format to
+SYNC_METRICS_FILE (for node_exporter's textfile collector), and a JSON summary of the
+run is saved in sync_runs.
 """
 
-import requests
+import asyncio
+import bisect
+import collections
+import datetime
+import hashlib
 import json
-import uuid
-from icalendar import Calendar
-import psycopg2
+import logging
+import multiprocessing
 import os
+import socket
+import time
+import typing
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote, urlparse
+
+import aiohttp
+import asyncpg
 import dotenv
 import pytz
-from urllib.parse import urlparse
+from icalendar import Calendar
 
 dotenv.load_dotenv()
 
-conn = psycopg2.connect(
-    f"user=postgres password={os.getenv('DATABASE_PWD')} host=localhost"
+DB_CONFIG = {
+    "user": "postgres",
+    "password": os.getenv("DATABASE_PWD"),
+    "host": os.getenv("DATABASE_HOST", "localhost"),
+    "port": 5432,
+}
+
+SYNC_FETCH_CONCURRENCY = int(os.getenv("SYNC_FETCH_CONCURRENCY", 8))
+SYNC_WRITE_BATCH_SIZE = int(os.getenv("SYNC_WRITE_BATCH_SIZE", 100))
+SYNC_PARSE_PROCESSES = int(os.getenv("SYNC_PARSE_PROCESSES", os.cpu_count() or 1))
+SYNC_QUEUE_SIZE = int(os.getenv("SYNC_QUEUE_SIZE", 4 * SYNC_FETCH_CONCURRENCY))
+SYNC_FETCH_TIMEOUT_SECONDS = 10
+SYNC_RATE = float(os.getenv("SYNC_RATE", 5))
+SYNC_MAX_RATE = float(os.getenv("SYNC_MAX_RATE", 20))
+SYNC_BACKOFF_BASE_HOURS = float(os.getenv("SYNC_BACKOFF_BASE_HOURS", 12))
+SYNC_BACKOFF_MAX_DAYS = float(os.getenv("SYNC_BACKOFF_MAX_DAYS", 30))
+SYNC_DEAD_LETTER_FAILURES = int(os.getenv("SYNC_DEAD_LETTER_FAILURES", 6))
+SYNC_INTERVAL_HOURS = float(os.getenv("SYNC_INTERVAL_HOURS", 20))
+SYNC_LEASE_BATCH_SIZE = int(os.getenv("SYNC_LEASE_BATCH_SIZE", 50))
+SYNC_LEASE_SECONDS = int(os.getenv("SYNC_LEASE_SECONDS", 15 * 60))
+SYNC_WORKER_ID = (
+    os.getenv("SYNC_WORKER_ID")
+    or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
 )
+# the Pushgateway keeps every group it's given, so metrics are grouped by something that
+# outlives the run; the random part of the default worker ID would leave one per run
+SYNC_METRICS_INSTANCE = os.getenv("SYNC_WORKER_ID") or socket.gethostname()
+SYNC_PUSHGATEWAY_URL = os.getenv("SYNC_PUSHGATEWAY_URL", "").rstrip("/")
+SYNC_METRICS_FILE = os.getenv("SYNC_METRICS_FILE")
 
 ALLOWED_TIMETABLE_HOSTS = {"webservices.runshaw.ac.uk"}
 ALLOWED_TIMETABLE_PATH = "/timetable.ashx"
 
+# Every write about a user is conditional on this worker still holding their lease on
+# the URL it fetched. Re-associating clears the lease (and another worker may have
+# reclaimed an expired one), so a stale result never lands over a newer sync.
+HOLDS_LEASE = """
+    EXISTS (
+        SELECT 1 FROM timetable_associations
+        WHERE user_id = $1 AND url = $2 AND lease_owner = $3
+    )
+"""
+
+UPSERT_TIMETABLE_QUERY = f"""
+    INSERT INTO timetables (user_id, timetable)
+    SELECT $1, $4::jsonb
+    WHERE {HOLDS_LEASE}
+    ON CONFLICT (user_id)
+    DO UPDATE SET timetable = EXCLUDED.timetable, updated_at = CURRENT_TIMESTAMP
+    WHERE timetables.timetable IS DISTINCT FROM EXCLUDED.timetable
+"""
+
+UPDATE_ICS_VALIDATORS_QUERY = """
+    UPDATE timetable_associations
+    SET ics_etag = $4, ics_last_modified = $5, ics_hash = $6
+    WHERE user_id = $1 AND url = $2 AND lease_owner = $3
+"""
+
+# due associations that nobody holds an unexpired lease on, leased to worker $2 for $3
+# seconds; previous_owner is set when a dead worker's lease is being reclaimed
+LEASE_BATCH_QUERY = """
+    WITH due AS (
+        SELECT a.user_id, a.lease_owner AS previous_owner
+        FROM timetable_associations a
+        LEFT JOIN sync_state s ON s.user_id = a.user_id
+        WHERE (
+            s.user_id IS NULL
+            OR (s.dead_lettered_at IS NULL AND s.next_eligible_at <= CURRENT_TIMESTAMP)
+        )
+        AND (a.lease_expires_at IS NULL OR a.lease_expires_at <= CURRENT_TIMESTAMP)
+        AND NOT EXISTS (
+            SELECT 1 FROM sync_jobs j
+            WHERE j.user_id = a.user_id
+            AND j.status IN ('queued', 'running')
+        )
+        ORDER BY a.id
+        LIMIT $1
+        FOR UPDATE OF a SKIP LOCKED
+    )
+    UPDATE timetable_associations a
+    SET lease_owner = $2,
+        lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => $3)
+    FROM due
+    WHERE a.user_id = due.user_id
+    RETURNING a.user_id, a.url, a.ics_etag, a.ics_last_modified, a.ics_hash,
+        due.previous_owner
+"""
+
+RELEASE_LEASES_QUERY = """
+    UPDATE timetable_associations
+    SET lease_owner = NULL, lease_expires_at = NULL
+    WHERE user_id = ANY($1::text[]) AND lease_owner = $2
+"""
+
+# not due again until $4 seconds from now
+RECORD_SYNC_SUCCESS_QUERY = f"""
+    INSERT INTO sync_state (user_id, last_success_at, next_eligible_at)
+    SELECT $1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + make_interval(secs => $4)
+    WHERE {HOLDS_LEASE}
+    ON CONFLICT (user_id) DO UPDATE SET
+        last_success_at = EXCLUDED.last_success_at,
+        consecutive_failures = 0,
+        next_eligible_at = EXCLUDED.next_eligible_at,
+        dead_lettered_at = NULL
+"""
+
+# the n-th failure in a row waits base ($5) * 2^(n - 1) seconds, up to $6, before
+# another try, and is dead-lettered at the $7th
+RECORD_SYNC_FAILURE_QUERY = f"""
+    INSERT INTO sync_state AS s (
+        user_id, last_error, last_error_at, consecutive_failures, next_eligible_at,
+        dead_lettered_at
+    )
+    SELECT
+        $1, $4, CURRENT_TIMESTAMP, 1, CURRENT_TIMESTAMP + make_interval(secs => $5),
+        CASE WHEN $7 <= 1 THEN CURRENT_TIMESTAMP END
+    WHERE {HOLDS_LEASE}
+    ON CONFLICT (user_id) DO UPDATE SET
+        last_error = EXCLUDED.last_error,
+        last_error_at = EXCLUDED.last_error_at,
+        consecutive_failures = s.consecutive_failures + 1,
+        next_eligible_at = CURRENT_TIMESTAMP
+            + make_interval(secs => least($5 * 2 ^ s.consecutive_failures, $6)),
+        dead_lettered_at = CASE WHEN s.consecutive_failures + 1 >= $7
+            THEN coalesce(s.dead_lettered_at, CURRENT_TIMESTAMP) END
+"""
+
+RECORD_RUN_QUERY = """
+    INSERT INTO sync_runs (worker_id, started_at, summary)
+    VALUES ($1, $2, $3::jsonb)
+"""
+
+# marks the end of a queue's input
+DONE = None
+
+# one halving per this long, however many in-flight requests fail together
+DECREASE_COOLDOWN_SECONDS = 1.0
+MAX_RETRY_AFTER_SECONDS = 60.0
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("sync-engine")
+
 
 def validate_timetable_url(ics_url: str):
     parsed = urlparse(ics_url)
@@ -42,12 +224,210 @@ def validate_timetable_url(ics_url: str):
         raise ValueError("Timetable URL must include an id query parameter")
 
 
-def parse_timetable(ics_url):
-    validate_timetable_url(ics_url)
-    response = requests.get(ics_url, timeout=10, allow_redirects=False)
-    response.raise_for_status()
+# fixed so the same source event gets the same uid on every sync
+EVENT_UID_NAMESPACE = uuid.UUID("be5be16b-7938-436d-8dec-9539e36067e4")
+
+
+def event_uid(component, dtstart: str, dtend: str, seen: set) -> str:
+    """
+    Stable uid for an event: from the calendar's own UID and start time if it has one,
+    otherwise from what the event is. Repeats within one calendar are numbered.
+    """
+    source_uid = component.get("uid")
+    if source_uid:
+        name = f"{source_uid}|{dtstart}"
+    else:
+        name = f"{dtstart}|{dtend}|{component.get('summary')}|{component.get('location')}"
+    base, n = name, 1
+    while name in seen:
+        n += 1
+        name = f"{base}#{n}"
+    seen.add(name)
+    return str(uuid.uuid5(EVENT_UID_NAMESPACE, name))
+
+
+def is_throttled(error: typing.Optional[BaseException]) -> bool:
+    """Whether an error means the upstream wants us to slow down."""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return False
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket plus AIMD concurrency limit for one upstream host. Not tied to an
+    event loop, so a module-level instance can be shared by everything in the process.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        max_rate: float,
+        concurrency: float,
+        max_concurrency: float,
+        min_rate: float = 0.5,
+        min_concurrency: float = 1.0,
+    ) -> None:
+        self.name = name
+        self.min_rate, self.max_rate = min_rate, max_rate
+        self.min_concurrency, self.max_concurrency = min_concurrency, max_concurrency
+        self._rate = rate
+        self._concurrency = concurrency
+        self._tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._waiters: collections.deque = collections.deque()
+        self._successes = 0
+        self._throttled = 0
+
+    def _refill(self, now: float) -> None:
+        # a second's worth of burst at most
+        self._tokens = min(
+            self._tokens + (now - self._refilled_at) * self._rate, max(self._rate, 1.0)
+        )
+        self._refilled_at = now
+
+    async def acquire(self) -> None:
+        while True:
+            if self._in_flight >= int(self._concurrency):
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    # woken just as we were cancelled: pass the turn on
+                    if waiter.done() and not waiter.cancelled():
+                        self._wake_next()
+                    raise
+                finally:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                continue
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+            elif self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+            else:
+                self._tokens -= 1
+                self._in_flight += 1
+                return
+
+    def release(self, error: typing.Optional[BaseException] = None) -> None:
+        self._in_flight -= 1
+        if is_throttled(error):
+            self._throttled += 1
+            self._decrease(error)
+        elif error is None:
+            self._successes += 1
+            # additive increase: about +1 per window's worth of successes
+            self._rate = min(self._rate + 1 / self._rate, self.max_rate)
+            self._concurrency = min(
+                self._concurrency + 1 / self._concurrency, self.max_concurrency
+            )
+        self._wake_next()
+
+    def _wake_next(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _decrease(self, error: BaseException) -> None:
+        now = time.monotonic()
+        retry_after = None
+        if isinstance(error, aiohttp.ClientResponseError) and error.headers:
+            try:
+                retry_after = float(error.headers.get("Retry-After", ""))
+            except ValueError:
+                pass
+        if retry_after:
+            self._paused_until = max(
+                self._paused_until, now + min(retry_after, MAX_RETRY_AFTER_SECONDS)
+            )
+        if now - self._last_decrease < DECREASE_COOLDOWN_SECONDS:
+            return
+        self._last_decrease = now
+        self._rate = max(self._rate / 2, self.min_rate)
+        self._concurrency = max(self._concurrency / 2, self.min_concurrency)
+        logger.warning(
+            f"{self.name} is pushing back ({error!r}); now "
+            f"{self._rate:.2f} req/s, {int(self._concurrency)} at once"
+        )
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        self.release(exc)
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "rate": round(self._rate, 3),
+            "concurrency_limit": int(self._concurrency),
+            "in_flight": self._in_flight,
+            "waiting": len(self._waiters),
+            "paused_for_seconds": round(
+                max(self._paused_until - time.monotonic(), 0.0), 3
+            ),
+            "successes": self._successes,
+            "throttled": self._throttled,
+        }
 
-    cal = Calendar.from_ical(response.text)
+
+runshaw_limiter = AdaptiveLimiter(
+    "webservices.runshaw.ac.uk",
+    SYNC_RATE,
+    SYNC_MAX_RATE,
+    # start low and let it find its way up to what the connector allows
+    min(4, SYNC_FETCH_CONCURRENCY),
+    SYNC_FETCH_CONCURRENCY,
+)
+
+
+async def fetch_ics(session: aiohttp.ClientSession, association: dict) -> bool:
+    """
+    Download the association's calendar into association["body"], with its new
+    validators. Returns False if the upstream says it hasn't changed since last time.
+    """
+    validate_timetable_url(association["url"])
+    headers = {}
+    if association["ics_etag"]:
+        headers["If-None-Match"] = association["ics_etag"]
+    if association["ics_last_modified"]:
+        headers["If-Modified-Since"] = association["ics_last_modified"]
+    queued_at = time.perf_counter()
+    async with runshaw_limiter:
+        started = time.perf_counter()
+        association["wait_seconds"] = started - queued_at
+        try:
+            async with session.get(
+                association["url"], headers=headers, allow_redirects=False
+            ) as response:
+                if response.status == 304:
+                    return False
+                response.raise_for_status()
+                association["body"] = await response.read()
+        finally:
+            association["fetch_seconds"] = time.perf_counter() - started
+    association["etag"] = response.headers.get("ETag")
+    association["last_modified"] = response.headers.get("Last-Modified")
+    association["hash"] = hashlib.sha256(association["body"]).hexdigest()
+    return True
+
+
+def parse_timetable(ics_data: bytes) -> tuple[str, int]:
+    """The timetable as compact JSON, and how many events are in it."""
+    cal = Calendar.from_ical(ics_data)
 
     json_data = {
         "version": "2.0",
@@ -57,6 +437,7 @@ def parse_timetable(ics_url):
     }
 
     london_tz = pytz.timezone("Europe/London")
+    seen_uids = set()
 
     for component in cal.walk():
         if component.name == "VEVENT":
@@ -81,7 +462,12 @@ def parse_timetable(ics_url):
                 "dtstart": {"dt": dtstart.strftime("%Y%m%dT%H%M%S")},
                 "dtend": {"dt": dtend.strftime("%Y%m%dT%H%M%S")},
                 "dtstamp": {"dt": dtstamp.strftime("%Y%m%dT%H%M%S")},
-                "uid": str(uuid.uuid4()),
+                "uid": event_uid(
+                    component,
+                    dtstart.strftime("%Y%m%dT%H%M%S"),
+                    dtend.strftime("%Y%m%dT%H%M%S"),
+                    seen_uids,
+                ),
                 "created": (
                     {
                         "dt": component.get("created")
@@ -109,28 +495,561 @@ def parse_timetable(ics_url):
             }
             json_data["data"].append(event)
 
-    return json.dumps(
-        json_data,
-        indent=0,
+    return json.dumps(json_data, separators=(",", ":")), len(json_data["data"])
+
+
+def describe_error(error: Exception) -> str:
+    return f"{type(error).__name__}: {error}"[:500]
+
+
+def failure_class(error: Exception) -> str:
+    """A short, low-cardinality name for what went wrong, for the failure counters."""
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, aiohttp.ClientResponseError):
+        return "http_429" if error.status == 429 else f"http_{error.status // 100}xx"
+    if isinstance(error, aiohttp.ClientConnectionError):
+        return "connection"
+    if isinstance(error, ValueError):
+        return "invalid"
+    return "other"
+
+
+class Histogram:
+    """A Prometheus-style histogram: counts of observations at or below each bound."""
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        total, cumulative = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((f"{bound:g}", total))
+        return cumulative + [("+Inf", self.count)]
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(self.cumulative()),
+        }
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+            *(
+                f'{self.name}_bucket{{le="{bound}"}} {count}'
+                for bound, count in self.cumulative()
+            ),
+            f"{self.name}_sum {self.sum}",
+            f"{self.name}_count {self.count}",
+        ]
+
+
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class RunStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        # a gauge, not something this run did: associations backing off or dead-lettered
+        # across every worker when the run started
+        self.backing_off_total = 0
+        self.queued = 0
+        # associations taken over from workers whose leases ran out
+        self.reclaimed = 0
+        self.fetched = 0
+        self.parsed = 0
+        self.written = 0
+        # 304s and bodies identical to the last sync
+        self.unchanged = 0
+        self.failed = 0
+        # (stage, failure_class) -> count
+        self.failures = collections.Counter()
+        self.histograms = {
+            histogram.name: histogram
+            for histogram in (
+                Histogram(
+                    "sync_limiter_wait_seconds",
+                    "Time waiting for the upstream limiter before each fetch.",
+                    SECONDS_BUCKETS,
+                ),
+                Histogram(
+                    "sync_fetch_seconds",
+                    "Time to download each calendar once let through.",
+                    SECONDS_BUCKETS,
+                ),
+                Histogram(
+                    "sync_fetch_bytes",
+                    "Size of each downloaded calendar.",
+                    (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6),
+                ),
+                Histogram(
+                    "sync_parse_seconds",
+                    "Time to parse each changed calendar.",
+                    SECONDS_BUCKETS,
+                ),
+                Histogram(
+                    "sync_events",
+                    "Events in each parsed timetable.",
+                    (10, 50, 100, 250, 500, 1000, 2000, 5000),
+                ),
+                Histogram(
+                    "sync_write_batch_seconds",
+                    "Time to commit each batch of results.",
+                    SECONDS_BUCKETS,
+                ),
+            )
+        }
+
+    def observe(self, name: str, value: float):
+        self.histograms[name].observe(value)
+
+    def fail(self, stage: str, error: Exception):
+        self.failed += 1
+        self.failures[(stage, failure_class(error))] += 1
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        done = self.written + self.unchanged
+        return (
+            f"{done}/{self.queued} timetables synced ({self.written} changed, "
+            f"{self.unchanged} unchanged), {self.failed} failed, "
+            f"{self.reclaimed} reclaimed in {elapsed:.1f}s "
+            f"({done / elapsed if elapsed else 0:.1f} users/s); "
+            f"{self.backing_off_total} backing off across all workers"
+        )
+
+    def counts(self) -> dict:
+        return {
+            "queued": self.queued,
+            "fetched": self.fetched,
+            "parsed": self.parsed,
+            "written": self.written,
+            "unchanged": self.unchanged,
+            "failed": self.failed,
+            "reclaimed": self.reclaimed,
+        }
+
+    def as_dict(self) -> dict:
+        """The run summary saved in sync_runs."""
+        return {
+            "worker_id": SYNC_WORKER_ID,
+            "elapsed_seconds": time.perf_counter() - self.started,
+            **self.counts(),
+            "backing_off_total": self.backing_off_total,
+            "failures": [
+                {"stage": stage, "class": cls, "count": count}
+                for (stage, cls), count in sorted(self.failures.items())
+            ],
+            "histograms": {
+                name: histogram.as_dict() for name, histogram in self.histograms.items()
+            },
+            "limiter": runshaw_limiter.stats(),
+        }
+
+    def render_metrics(self) -> str:
+        """The run in the Prometheus text format, as taken by a Pushgateway."""
+        lines = [
+            "# HELP sync_run_seconds How long the run took.",
+            "# TYPE sync_run_seconds gauge",
+            f"sync_run_seconds {time.perf_counter() - self.started}",
+            "# HELP sync_users Users by what happened to them in the run.",
+            "# TYPE sync_users gauge",
+            *(
+                f'sync_users{{outcome="{key}"}} {value}'
+                for key, value in self.counts().items()
+            ),
+            "# HELP sync_backing_off_users Associations backing off or dead-lettered "
+            "across all workers when the run started.",
+            "# TYPE sync_backing_off_users gauge",
+            f"sync_backing_off_users {self.backing_off_total}",
+            "# HELP sync_failures Failed users by stage and class of failure.",
+            "# TYPE sync_failures gauge",
+            *(
+                f'sync_failures{{stage="{stage}",class="{cls}"}} {count}'
+                for (stage, cls), count in sorted(self.failures.items())
+            ),
+            "# HELP sync_limiter Upstream limiter state at the end of the run.",
+            "# TYPE sync_limiter gauge",
+            *(
+                f'sync_limiter{{field="{key}"}} {value}'
+                for key, value in runshaw_limiter.stats().items()
+            ),
+        ]
+        for histogram in self.histograms.values():
+            lines += histogram.render()
+        return "\n".join(lines) + "\n"
+
+
+async def produce(pool: asyncpg.Pool, fetch_queue: asyncio.Queue, stats: RunStats):
+    """
+    Lease batches of due associations into the fetch stage until none are left. Users
+    with an on-demand sync queued or running in the API are left to that job, and
+    users whose last syncs failed wait out their backoff.
+    """
+    async with pool.acquire() as conn:
+        stats.backing_off_total = await conn.fetchval(
+            """
+            SELECT count(*) FROM sync_state
+            WHERE dead_lettered_at IS NOT NULL OR next_eligible_at > CURRENT_TIMESTAMP
+            """
+        )
+    while True:
+        # only lease once there's room, so leases aren't ticking while rows wait here
+        while fetch_queue.full():
+            await asyncio.sleep(0.1)
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                LEASE_BATCH_QUERY,
+                min(SYNC_LEASE_BATCH_SIZE, fetch_queue.maxsize - fetch_queue.qsize()),
+                SYNC_WORKER_ID,
+                SYNC_LEASE_SECONDS,
+            )
+        if not rows:
+            return
+        for row in rows:
+            association = dict(row)
+            if association.pop("previous_owner") is not None:
+                logger.warning(
+                    f"Reclaimed {association['user_id']} from an expired lease"
+                )
+                stats.reclaimed += 1
+            await fetch_queue.put(association)
+            stats.queued += 1
+
+
+async def fetch_worker(
+    session: aiohttp.ClientSession,
+    fetch_queue: asyncio.Queue,
+    parse_queue: asyncio.Queue,
+    write_queue: asyncio.Queue,
+    stats: RunStats,
+):
+    while (association := await fetch_queue.get()) is not DONE:
+        try:
+            modified = await fetch_ics(session, association)
+        except Exception as e:
+            logger.warning(
+                f"Failed to fetch timetable for {association['user_id']}: {e!r}"
+            )
+            stats.fail("fetch", e)
+            association["error"] = describe_error(e)
+            await write_queue.put(association)
+            continue
+        finally:
+            if "fetch_seconds" in association:
+                stats.observe("sync_limiter_wait_seconds", association["wait_seconds"])
+                stats.observe("sync_fetch_seconds", association["fetch_seconds"])
+        stats.fetched += 1
+        if modified:
+            stats.observe("sync_fetch_bytes", len(association["body"]))
+        if modified and association["hash"] != association["ics_hash"]:
+            await parse_queue.put(association)
+        else:
+            # still written, to record the success and keep the validators current
+            stats.unchanged += 1
+            association["timetable"] = None
+            await write_queue.put(association)
+
+
+async def parse_worker(
+    executor: ProcessPoolExecutor,
+    parse_queue: asyncio.Queue,
+    write_queue: asyncio.Queue,
+    stats: RunStats,
+):
+    loop = asyncio.get_running_loop()
+    while (association := await parse_queue.get()) is not DONE:
+        started = time.perf_counter()
+        try:
+            association["timetable"], events = await loop.run_in_executor(
+                executor, parse_timetable, association.pop("body")
+            )
+        except Exception as e:
+            logger.exception(f"Failed to parse timetable for {association['user_id']}")
+            stats.fail("parse", e)
+            association["error"] = describe_error(e)
+            await write_queue.put(association)
+            continue
+        stats.observe("sync_parse_seconds", time.perf_counter() - started)
+        stats.observe("sync_events", events)
+        stats.parsed += 1
+        await write_queue.put(association)
+
+
+async def record_failures(conn: asyncpg.Connection, failures: list[tuple]):
+    """Back off from each (user_id, url, error), dead-lettering repeat failures."""
+    await conn.executemany(
+        RECORD_SYNC_FAILURE_QUERY,
+        [
+            (
+                user_id,
+                url,
+                SYNC_WORKER_ID,
+                error,
+                SYNC_BACKOFF_BASE_HOURS * 3600,
+                SYNC_BACKOFF_MAX_DAYS * 86400,
+                SYNC_DEAD_LETTER_FAILURES,
+            )
+            for user_id, url, error in failures
+        ],
     )
 
 
-query = "SELECT user_id, url FROM timetable_associations;"
+async def write_users(conn: asyncpg.Connection, associations: list[dict]):
+    """
+    Changed timetables, the validators they came from and each user's sync state,
+    with the release of their leases. Run inside a transaction.
+    """
+    succeeded = [
+        association for association in associations if "error" not in association
+    ]
+    changed = [
+        (
+            association["user_id"],
+            association["url"],
+            SYNC_WORKER_ID,
+            association["timetable"],
+        )
+        for association in succeeded
+        if association["timetable"] is not None
+    ]
+    if changed:
+        await conn.executemany(UPSERT_TIMETABLE_QUERY, changed)
+    # 304s have nothing new to store
+    await conn.executemany(
+        UPDATE_ICS_VALIDATORS_QUERY,
+        [
+            (
+                association["user_id"],
+                association["url"],
+                SYNC_WORKER_ID,
+                association["etag"],
+                association["last_modified"],
+                association["hash"],
+            )
+            for association in succeeded
+            if "hash" in association
+        ],
+    )
+    await conn.executemany(
+        RECORD_SYNC_SUCCESS_QUERY,
+        [
+            (
+                association["user_id"],
+                association["url"],
+                SYNC_WORKER_ID,
+                SYNC_INTERVAL_HOURS * 3600,
+            )
+            for association in succeeded
+        ],
+    )
+    await record_failures(
+        conn,
+        [
+            (association["user_id"], association["url"], association["error"])
+            for association in associations
+            if "error" in association
+        ],
+    )
+    await conn.execute(
+        RELEASE_LEASES_QUERY,
+        [association["user_id"] for association in associations],
+        SYNC_WORKER_ID,
+    )
+
+
+def count_changed(associations: list[dict]) -> int:
+    return sum(
+        "error" not in association and association["timetable"] is not None
+        for association in associations
+    )
 
-with conn.cursor() as cursor:
-    cursor.execute(query)
-    for user_id, url in cursor.fetchall():
-        print(f"User ID: {user_id}")
-        jsonTimetable = (parse_timetable(url),)
-        # Convert to a JSON to insert into the database
 
-        cursor.execute(
-            """INSERT INTO timetables (user_id, timetable)
-       VALUES (%s, %s)
-       ON CONFLICT (user_id)
-       DO UPDATE SET timetable = %s, updated_at = CURRENT_TIMESTAMP""",
-            (user_id, jsonTimetable, jsonTimetable),
+async def write_batch(pool: asyncpg.Pool, batch: list[dict], stats: RunStats):
+    """
+    Commit a batch of results in one transaction. If that fails, each user is retried
+    in a transaction of their own, so one bad row (say a user deleted mid-run) doesn't
+    take the rest of the batch down with it.
+    """
+    started = time.perf_counter()
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await write_users(conn, batch)
+        stats.observe("sync_write_batch_seconds", time.perf_counter() - started)
+        stats.written += count_changed(batch)
+        return
+    except Exception:
+        logger.exception(f"Failed to write a batch of {len(batch)}, retrying singly")
+
+    remaining = list(batch)
+    unwritten = []
+    try:
+        async with pool.acquire() as conn:
+            while remaining:
+                association = remaining.pop(0)
+                try:
+                    async with conn.transaction():
+                        await write_users(conn, [association])
+                    stats.written += count_changed([association])
+                except Exception as e:
+                    logger.exception(f"Failed to write {association['user_id']}")
+                    unwritten.append(association)
+                    write_failed(stats, association, e)
+            # a problem on our side isn't the calendar's fault, so it doesn't count
+            # towards dead-lettering: the user is just left due for the next run
+            if unwritten:
+                await conn.execute(
+                    RELEASE_LEASES_QUERY,
+                    [association["user_id"] for association in unwritten],
+                    SYNC_WORKER_ID,
+                )
+    except Exception as e:
+        # no connection at all: their leases run out and they're picked up again
+        logger.exception("Failed to write or release the rest of the batch")
+        for association in remaining:
+            write_failed(stats, association, e)
+    stats.observe("sync_write_batch_seconds", time.perf_counter() - started)
+
+
+def write_failed(stats: RunStats, association: dict, error: Exception):
+    if "error" in association:
+        # already counted as failed upstream
+        return
+    if association["timetable"] is None:
+        # counted as unchanged by the fetch stage, but nothing was saved after all
+        stats.unchanged -= 1
+    stats.fail("write", error)
+
+
+async def write_worker(pool: asyncpg.Pool, write_queue: asyncio.Queue, stats: RunStats):
+    batch = []
+    while (item := await write_queue.get()) is not DONE:
+        batch.append(item)
+        if len(batch) >= SYNC_WRITE_BATCH_SIZE:
+            await write_batch(pool, batch, stats)
+            logger.info(stats.summary())
+            logger.info(f"Limiter: {runshaw_limiter.stats()}")
+            batch = []
+    if batch:
+        await write_batch(pool, batch, stats)
+
+
+async def record_run(pool: asyncpg.Pool, stats: RunStats):
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute(
+                RECORD_RUN_QUERY,
+                SYNC_WORKER_ID,
+                stats.started_at,
+                json.dumps(stats.as_dict()),
+            )
+    except Exception:
+        logger.exception("Failed to save the run summary")
+
+
+async def export_metrics(stats: RunStats):
+    """Hand the run's metrics to Prometheus, however it's set up to collect them."""
+    metrics = stats.render_metrics()
+    if SYNC_METRICS_FILE:
+        # written alongside then renamed, so the collector never reads half a file
+        try:
+            with open(f"{SYNC_METRICS_FILE}.tmp", "w") as metrics_file:
+                metrics_file.write(metrics)
+            os.replace(f"{SYNC_METRICS_FILE}.tmp", SYNC_METRICS_FILE)
+        except OSError:
+            logger.exception(f"Failed to write metrics to {SYNC_METRICS_FILE}")
+    if SYNC_PUSHGATEWAY_URL:
+        # one group per worker, so sharded workers don't overwrite each other
+        url = (
+            f"{SYNC_PUSHGATEWAY_URL}/metrics/job/myrunshaw-sync-engine"
+            f"/instance/{quote(SYNC_METRICS_INSTANCE, safe='')}"
         )
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.put(
+                    url,
+                    data=metrics.encode(),
+                    headers={"Content-Type": "text/plain; version=0.0.4"},
+                    timeout=aiohttp.ClientTimeout(total=SYNC_FETCH_TIMEOUT_SECONDS),
+                ) as response:
+                    response.raise_for_status()
+        except Exception:
+            logger.exception("Failed to push metrics to the Pushgateway")
+
+
+async def sync_all() -> RunStats:
+    stats = RunStats()
+    fetch_queue = asyncio.Queue(SYNC_QUEUE_SIZE)
+    parse_queue = asyncio.Queue(SYNC_QUEUE_SIZE)
+    write_queue = asyncio.Queue(SYNC_QUEUE_SIZE)
+
+    pool = await asyncpg.create_pool(**DB_CONFIG, min_size=2, max_size=3)
+    # forkserver so the parse processes don't inherit the pool's and session's sockets
+    executor = ProcessPoolExecutor(
+        max_workers=SYNC_PARSE_PROCESSES,
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+    try:
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=SYNC_FETCH_TIMEOUT_SECONDS),
+            connector=aiohttp.TCPConnector(limit=SYNC_FETCH_CONCURRENCY),
+        ) as session:
+            fetchers = [
+                asyncio.create_task(
+                    fetch_worker(session, fetch_queue, parse_queue, write_queue, stats)
+                )
+                for _ in range(SYNC_FETCH_CONCURRENCY)
+            ]
+            # one task per process keeps every core busy without queueing bodies
+            # inside the executor, where they'd escape the bounded parse queue
+            parsers = [
+                asyncio.create_task(
+                    parse_worker(executor, parse_queue, write_queue, stats)
+                )
+                for _ in range(SYNC_PARSE_PROCESSES)
+            ]
+            writer = asyncio.create_task(write_worker(pool, write_queue, stats))
+            try:
+                await produce(pool, fetch_queue, stats)
+                for _ in fetchers:
+                    await fetch_queue.put(DONE)
+                await asyncio.gather(*fetchers)
+                for _ in parsers:
+                    await parse_queue.put(DONE)
+                await asyncio.gather(*parsers)
+                await write_queue.put(DONE)
+                await writer
+            except BaseException:
+                for task in (*fetchers, *parsers, writer):
+                    task.cancel()
+                raise
+        await record_run(pool, stats)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        await pool.close()
+    await export_metrics(stats)
+    return stats
+
 
-conn.commit()
-conn.close()
+if __name__ == "__main__":
+    logger.info(f"Sync worker {SYNC_WORKER_ID} starting")
+    logger.info(asyncio.run(sync_all()).summary())
+    logger.info(f"Limiter: {runshaw_limiter.stats()}")
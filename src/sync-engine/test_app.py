@@ -0,0 +1,226 @@
+import asyncio
+import datetime
+import json
+
+import aiohttp
+import asyncpg
+import pytest
+from icalendar import Event
+
+import app
+
+WORKER_ID = "test-worker"
+
+ICS = b"""BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:lesson-1@runshaw
+DTSTART:20250310T090000Z
+DTEND:20250310T100000Z
+DTSTAMP:20250301T000000Z
+SUMMARY:Maths
+LOCATION:A101
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20250310T110000Z
+DTEND:20250310T120000Z
+DTSTAMP:20250301T000000Z
+SUMMARY:Physics
+LOCATION:B202
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20250310T110000Z
+DTEND:20250310T120000Z
+DTSTAMP:20250301T000000Z
+SUMMARY:Physics
+LOCATION:B202
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def make_event(**properties) -> Event:
+    event = Event()
+    for name, value in properties.items():
+        event.add(name, value)
+    return event
+
+
+def test_event_uid_stable():
+    lesson = make_event(uid="lesson-1@runshaw", summary="Maths")
+    first = app.event_uid(lesson, "20250310T090000", "20250310T100000", set())
+    again = app.event_uid(lesson, "20250310T090000", "20250310T100000", set())
+    assert first == again
+    # a moved lesson is a different event
+    moved = app.event_uid(lesson, "20250311T090000", "20250311T100000", set())
+    assert moved != first
+
+    # without a UID the event is named by what it is, and repeats are numbered
+    seen = set()
+    anonymous = make_event(summary="Physics", location="B202")
+    uids = [
+        app.event_uid(anonymous, "20250310T110000", "20250310T120000", seen)
+        for _ in range(3)
+    ]
+    assert len(set(uids)) == 3
+    resynced = set()
+    assert uids == [
+        app.event_uid(anonymous, "20250310T110000", "20250310T120000", resynced)
+        for _ in range(3)
+    ]
+
+
+def test_parse_timetable_uids_survive_resync():
+    timetable, events = app.parse_timetable(ICS)
+    assert events == 3
+    uids = [event["uid"] for event in json.loads(timetable)["data"]]
+    assert len(set(uids)) == 3
+    assert app.parse_timetable(ICS)[0] == timetable
+
+
+def test_histogram_cumulative():
+    histogram = app.Histogram("test_seconds", "Test.", (0.1, 1, 10))
+    for value in (0.05, 0.1, 0.5, 5, 50):
+        histogram.observe(value)
+    # bounds are inclusive, and +Inf counts everything
+    assert histogram.cumulative() == [("0.1", 2), ("1", 3), ("10", 4), ("+Inf", 5)]
+    assert histogram.sum == pytest.approx(55.65)
+    assert 'test_seconds_bucket{le="+Inf"} 5' in histogram.render()
+
+
+def test_failure_class():
+    def http_error(status: int) -> aiohttp.ClientResponseError:
+        return aiohttp.ClientResponseError(None, (), status=status)
+
+    assert app.failure_class(asyncio.TimeoutError()) == "timeout"
+    assert app.failure_class(http_error(429)) == "http_429"
+    assert app.failure_class(http_error(404)) == "http_4xx"
+    assert app.failure_class(http_error(503)) == "http_5xx"
+    assert app.failure_class(aiohttp.ClientConnectionError()) == "connection"
+    assert app.failure_class(ValueError("not a calendar")) == "invalid"
+    assert app.failure_class(RuntimeError()) == "other"
+
+
+class FakeConnection:
+    """Accepts every write except a timetable for a user in `broken`."""
+
+    def __init__(self, broken: set[str]) -> None:
+        self.broken = broken
+        self.released = []
+
+    def transaction(self) -> "FakeConnection":
+        return self
+
+    async def __aenter__(self) -> "FakeConnection":
+        return self
+
+    async def __aexit__(self, *exc_info) -> bool:
+        return False
+
+    async def executemany(self, query: str, args: list[tuple]):
+        if query == app.UPSERT_TIMETABLE_QUERY:
+            for user_id, *_ in args:
+                if user_id in self.broken:
+                    raise asyncpg.ForeignKeyViolationError("user was deleted")
+
+    async def execute(self, query: str, *args):
+        if query == app.RELEASE_LEASES_QUERY:
+            self.released += args[0]
+
+
+class FakePool:
+    def __init__(self, conn: FakeConnection) -> None:
+        self.conn = conn
+
+    def acquire(self) -> FakeConnection:
+        return self.conn
+
+
+def test_run_stats_after_failed_batch():
+    batch = [
+        {"user_id": "changed", "url": "u", "timetable": "{}", "etag": None,
+         "last_modified": None, "hash": "h"},
+        {"user_id": "deleted", "url": "u", "timetable": "{}", "etag": None,
+         "last_modified": None, "hash": "h"},
+        {"user_id": "not-modified", "url": "u", "timetable": None},
+        {"user_id": "bad-calendar", "url": "u", "error": "ValueError: not a calendar"},
+    ]
+    stats = app.RunStats()
+    # as the fetch and parse stages leave them
+    stats.unchanged = 1
+    stats.fail("parse", ValueError("not a calendar"))
+
+    conn = FakeConnection(broken={"deleted"})
+    asyncio.run(app.write_batch(FakePool(conn), batch, stats))
+
+    assert stats.written == 1
+    assert stats.unchanged == 1
+    assert stats.failed == 2
+    assert stats.failures == {("parse", "invalid"): 1, ("write", "other"): 1}
+    # the user whose write failed is let go without counting towards dead-lettering
+    assert conn.released[-1:] == ["deleted"]
+    assert stats.histograms["sync_write_batch_seconds"].count == 1
+
+
+async def connect_or_skip() -> asyncpg.Connection:
+    try:
+        return await asyncpg.connect(**app.DB_CONFIG, timeout=2)
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+        pytest.skip(f"no database to test against: {e!r}")
+
+
+def test_sync_failure_backoff():
+    async def run():
+        conn = await connect_or_skip()
+        try:
+            async with conn.transaction():
+                # shadow the real tables for the length of the transaction
+                await conn.execute(
+                    """
+                    CREATE TEMP TABLE timetable_associations (
+                        user_id TEXT PRIMARY KEY, url TEXT, lease_owner TEXT
+                    ) ON COMMIT DROP;
+                    CREATE TEMP TABLE sync_state (
+                        user_id TEXT PRIMARY KEY,
+                        last_success_at TIMESTAMPTZ,
+                        last_error TEXT,
+                        last_error_at TIMESTAMPTZ,
+                        consecutive_failures INTEGER NOT NULL DEFAULT 0,
+                        next_eligible_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        dead_lettered_at TIMESTAMPTZ
+                    ) ON COMMIT DROP;
+                    INSERT INTO timetable_associations
+                    VALUES ('user', 'u', 'test-worker');
+                    """
+                )
+
+                async def fail(worker_id: str = WORKER_ID):
+                    # 10s base, 25s cap, dead-lettered at the 3rd failure in a row
+                    await conn.execute(
+                        app.RECORD_SYNC_FAILURE_QUERY,
+                        "user", "u", worker_id, "boom", 10.0, 25.0, 3,
+                    )
+                    return await conn.fetchrow(
+                        """
+                        SELECT consecutive_failures,
+                            next_eligible_at - CURRENT_TIMESTAMP AS wait,
+                            dead_lettered_at IS NOT NULL AS dead_lettered
+                        FROM sync_state WHERE user_id = 'user'
+                        """
+                    )
+
+                seconds = datetime.timedelta(seconds=1)
+                assert tuple(await fail()) == (1, 10 * seconds, False)
+                assert tuple(await fail()) == (2, 20 * seconds, False)
+                assert tuple(await fail()) == (3, 25 * seconds, True)
+                # a worker that has lost the lease can't record anything
+                assert tuple(await fail("someone-else")) == (3, 25 * seconds, True)
+
+                await conn.execute(
+                    app.RECORD_SYNC_SUCCESS_QUERY, "user", "u", WORKER_ID, 60.0
+                )
+                assert tuple(await fail()) == (1, 10 * seconds, False)
+        finally:
+            await conn.close()
+
+    asyncio.run(run())